@@ -0,0 +1,160 @@
+# osh
+# Copyright (C) Jack Orenstein <jao@geophile.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""Connections to a resident C{remoteosh} agent.
+
+Running a command on a cluster normally starts C{remoteosh} on each host, through
+ssh, so each command pays for ssh connection setup, starting the Python
+interpreter, and executing C{.oshrc}. An agent, started on a host by C{remoteosh
+--agent ADDRESS [DB_PROFILE]}, stays resident, and runs each pipeline it receives in
+a new thread.
+
+C{ADDRESS} is a port number, (the agent listens on 127.0.0.1), C{HOST:PORT}, or the
+path of a Unix socket. Anyone who can connect to the agent can run commands as the
+agent's user, so an agent listening on a TCP port on a public interface should
+only be used on a trusted network.
+
+A connection carries the same streams as C{remoteosh} standard input and output,
+(see C{osh.wire}), except that the first input object is a dict of the environment
+variables that would be set in the C{remoteosh} command line, (e.g. C{OSH_WIRE}).
+Standard error of the agent is not returned to the client.
+
+A cluster uses its hosts' agents if configured in C{.oshrc}, e.g.
+C{osh.remote.CLUSTER.agent = 7070}. A port number is combined with each host's
+address. If an agent can't be reached, then the command is run through ssh.
+"""
+
+import os
+import socket
+import stat
+
+import spawn
+
+# Listening hosts of agents started with a port number.
+DEFAULT_INTERFACE = '127.0.0.1'
+
+def parse_address(address, host = DEFAULT_INTERFACE):
+    """Returns the socket family and address of an agent. C{address} is a port,
+    C{HOST:PORT}, or the path of a Unix socket. A port is combined with C{host}.
+    """
+    address = str(address)
+    if address.isdigit():
+        return socket.AF_INET, (host, int(address))
+    if ':' in address and address.rsplit(':', 1)[1].isdigit():
+        host, port = address.rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, os.path.expanduser(address)
+
+def listen(address):
+    """Returns a socket listening at C{address}, (see C{parse_address}). A Unix socket
+    is accessible only by its owner.
+    """
+    family, address = parse_address(address)
+    server = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            # Left by an agent that didn't exit cleanly
+            os.remove(address)
+        server.bind(address)
+        os.chmod(address, stat.S_IRUSR | stat.S_IWUSR)
+    else:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(address)
+    server.listen(socket.SOMAXCONN)
+    return server
+
+def connect(address, host):
+    """Returns a socket connected to the agent at C{address} for C{host}, (a host
+    address used if C{address} is a port). Raises C{socket.error} if the agent can't
+    be reached.
+    """
+    family, address = parse_address(address, host)
+    connection = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        connection.connect(address)
+    except:
+        connection.close()
+        raise
+    if family == socket.AF_INET:
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection
+
+class AgentConnection(object):
+    """Runs a command on an agent, as C{osh.spawn.Spawn} runs a command in a process.
+    C{input_provider} and C{out_consumer} are used as by C{Spawn}: input is sent on
+    C{connection}, (returned by C{connect}), and output is read from it.
+    """
+
+    _command = None
+    _connection = None
+    _input_provider = None
+    _out_consumer = None
+    _terminating_exception = None
+    _cancelled = False
+
+    def __init__(self, connection, input_provider, out_consumer):
+        self._command = 'agent(%s)' % (connection.getpeername(),)
+        self._connection = connection
+        self._input_provider = input_provider
+        self._out_consumer = out_consumer
+
+    def __repr__(self):
+        return self._command
+
+    def run(self):
+        spawn.all_processes.append(self)
+        try:
+            try:
+                self._out_consumer.initialize(self._connection.makefile('rb'), self)
+                output = spawn.OutputDispatcher([self._out_consumer])
+                output.start()
+                input_sender = None
+                try:
+                    # Unbuffered, so that input streamed to the agent isn't delayed.
+                    input = self._connection.makefile('wb', 0)
+                    self._input_provider.initialize(input, self)
+                    input_sender = spawn.send_input(self._input_provider)
+                finally:
+                    output.dispatch()
+                if input_sender:
+                    input_sender.join()
+            except Exception, e:
+                self._terminating_exception = e
+        finally:
+            self._connection.close()
+            spawn.all_processes.remove(self)
+
+    def close_input_stream(self):
+        try:
+            self._connection.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+
+    def kill(self):
+        # The agent stops the pipeline when it receives the kill signal, or when the
+        # connection is closed.
+        try:
+            self._input_provider.send_kill(9)
+        except (IOError, socket.error):
+            pass
+        try:
+            self._connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def terminating_exception(self):
+        return self._terminating_exception
@@ -35,6 +35,7 @@ import apiparser
 import core
 import config
 import error
+import loader
 import command
 import command.f
 from builtins import *
@@ -42,16 +43,21 @@ from builtins import *
 # Get symbols defined in .oshrc
 globals().update(core.namespace())
 
+# The function for each command is imported when it is first called, so that
+# importing this module doesn't import every command module.
 def _import_package(package_name):
     package = globals()[package_name]
     for module_name in package.__all__:
-        exec('import %s.%s' % (package_name, module_name))
-        mod = getattr(package, module_name)
-        for element_name in dir(mod):
-            if not element_name.startswith('_'):
-                element = getattr(mod, element_name)
-                if type(element) is types.FunctionType:
-                    globals()[element_name] = element
+        globals()[module_name] = _lazy_command('%s.%s' % (package_name, module_name), module_name)
+
+def _lazy_command(module_name, command_name):
+    def lazy_command(*args, **kwargs):
+        function = getattr(loader.load_module(module_name), command_name)
+        globals()[command_name] = function
+        return function(*args, **kwargs)
+    lazy_command.__name__ = command_name
+    lazy_command.__doc__ = 'See %s.%s' % (module_name, command_name)
+    return lazy_command
 
 def create_commands(package_name, command_names):
     commands = {}
@@ -145,6 +151,13 @@ def debug(verbosity):
     """
     core.verbosity = verbosity
 
+def profile(enabled = True):
+    """Control osh profiling. If C{enabled} is true, then each C{osh()} invocation
+    prints, to stderr, the objects received and sent by each command, the time spent
+    in each command, and the time spent in each function passed to a command.
+    """
+    core.profiling = enabled
+
 
 # Setup
 
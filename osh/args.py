@@ -15,6 +15,8 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
+import copy as _copy
+
 _STATE_ANONYMOUS = 'anonymous'
 _STATE_BEFORE_KEY = 'before_key'
 _STATE_BETWEEN_KEY_AND_VAL = 'between_key_and_val'
@@ -124,6 +126,15 @@ class Args(object):
         else:
             self._anon.append(arg)
 
+    def copy(self, op):
+        """Returns a copy of these arguments, for use by C{op}.
+        """
+        copy = _copy.copy(self)
+        copy._op = op
+        copy._keyval = self._keyval.copy()
+        copy._anon = list(self._anon)
+        return copy
+
     def args_done(self):
         if len(self._anon) < self._min_anon:
             raise ArgException('Too few arguments for %s' % self._op)
@@ -216,6 +227,10 @@ class Args(object):
             if replacement is not val:
                 self._keyval[key] = replacement
         self._anon = [function_store.function_to_reference(arg) for arg in self._anon]
+        # Pipelines passed as args, (e.g. to fork), contain functions too.
+        for arg in self._anon:
+            if hasattr(arg, 'replace_function_by_reference'):
+                arg.replace_function_by_reference(function_store)
 
     def restore_function(self, function_store):
         for key, val in self._keyval.iteritems():
@@ -223,6 +238,9 @@ class Args(object):
             if replacement is not val:
                 self._keyval[key] = replacement
         self._anon = [function_store.reference_to_function(arg) for arg in self._anon]
+        for arg in self._anon:
+            if hasattr(arg, 'restore_function'):
+                arg.restore_function(function_store)
 
     # For use by this module
 
@@ -90,7 +90,7 @@ class _CLIParser(VerboseParser):
                 end
             |
                 FORK/f                  $ op = load_op('fork')
-                                        $ op = op.add_arg(f)
+                                        $ map(op.add_arg, f)
                 begin
                 PIPELINE/p              $ op = op.add_arg(p)
                 (
@@ -106,7 +106,11 @@ class _CLIParser(VerboseParser):
 
         FORK/f -> 
            at
-           string/s                     $ f = s
+           string/s                     $ threadgen = s
+                                        $ f = []
+           (
+               string/flag              $ f.append(flag)
+           )*                           $ f.append(threadgen)
            ;
 
         MERGE/m ->
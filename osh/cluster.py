@@ -27,13 +27,22 @@ class Host(object):
     _identity = None
     _db_profile = None
     _schema = None
+    _idle_timeout = None
+    _compress = None
+    _priority = None
+    _agent = None
 
-    def __init__(self, name, address, user, identity, db_profile):
+    def __init__(self, name, address, user, identity, db_profile,
+                 idle_timeout = None, compress = False, priority = 0, agent = None):
         self._name = name
         self._address = address
         self._user = user
         self._identity = identity
         self._db_profile = db_profile
+        self._idle_timeout = idle_timeout
+        self._compress = compress
+        self._priority = priority
+        self._agent = agent
 
     def __repr__(self):
         if self._schema:
@@ -50,16 +59,22 @@ class Host(object):
     identity = property(lambda self: self._identity)
     db_profile = property(lambda self: self._db_profile)
     schema = property(lambda self: self._schema, _set_schema)
+    idle_timeout = property(lambda self: self._idle_timeout)
+    compress = property(lambda self: self._compress)
+    priority = property(lambda self: self._priority)
+    agent = property(lambda self: self._agent)
 
 class Cluster(object):
 
     _name = None
     _user = None
     _hosts = None
+    _max_hosts = None
 
-    def __init__(self, name, user, hosts, pattern):
+    def __init__(self, name, user, hosts, pattern, max_hosts = None):
         self._name = name
         self._user = user
+        self._max_hosts = max_hosts
         if pattern:
             self._hosts = [host for host in hosts if pattern in host.name]
         else:
@@ -71,6 +86,7 @@ class Cluster(object):
     name = property(lambda self: self._name)
     user = property(lambda self: self._user)
     hosts = property(lambda self: self._hosts)
+    max_hosts = property(lambda self: self._max_hosts)
 
 def cluster_named(cluster_name, pattern = None):
     global _clusters
@@ -82,20 +98,31 @@ def cluster_named(cluster_name, pattern = None):
             config_user = 'root'
         # identity
         config_identity = config.config_value('remote', cluster_name, 'identity')
+        # seconds that an idle ssh connection is kept open for reuse
+        config_idle_timeout = config.config_value('remote', cluster_name, 'idle_timeout')
+        # compression of output from remote hosts
+        config_compress = bool(config.config_value('remote', cluster_name, 'compress'))
+        # number of hosts on which a command runs at one time
+        config_max_hosts = config.config_value('remote', cluster_name, 'max_hosts')
+        # address of a resident remoteosh agent on each host, (see osh.agent)
+        config_agent = config.config_value('remote', cluster_name, 'agent')
         # hosts
         config_hosts = config.config_value('remote', cluster_name, 'hosts')
         if isinstance(config_hosts, list) or isinstance(config_hosts, tuple):
-            hosts = [Host(addr, addr, config_user, config_identity, None)
+            hosts = [Host(addr, addr, config_user, config_identity, None,
+                          config_idle_timeout, config_compress, 0, config_agent)
                      for addr in config_hosts]
         elif isinstance(config_hosts, dict):
             hosts = []
             for name, host_spec in config_hosts.iteritems():
-                addr, db_profile = _parse_host_spec(cluster_name, host_spec)
-                hosts.append(Host(name, addr, config_user, config_identity, db_profile))
+                addr, db_profile, priority = _parse_host_spec(cluster_name, host_spec)
+                hosts.append(Host(name, addr, config_user, config_identity, db_profile,
+                                  config_idle_timeout, config_compress, priority,
+                                  config_agent))
         else:
             return None
         if config_user and hosts:
-            cluster = Cluster(cluster_name, config_user, hosts, pattern)
+            cluster = Cluster(cluster_name, config_user, hosts, pattern, config_max_hosts)
             _clusters[(cluster_name, pattern)] = cluster
         else:
             cluster = None
@@ -114,14 +141,16 @@ def define_cluster(name, user, hosts):
 def _parse_host_spec(cluster_name, host_spec):
     addr = None
     db_profile = None
+    priority = 0
     if isinstance(host_spec, str):
         addr = host_spec
     elif isinstance(host_spec, dict):
         addr = host_spec.get('host', None)
         db_profile = host_spec.get('db_profile', None)
+        priority = host_spec.get('priority', 0)
     if not addr:
         raise Exception(('Error in ~/.oshrc: ' +
                          'host specification in osh.remote.%s.hosts ' +
                          'must be string, or dict specifying keys "host" and ' +
-                         'optionally "db_profile"') % cluster_name)
-    return addr, db_profile
+                         'optionally "db_profile" and "priority"') % cluster_name)
+    return addr, db_profile, priority
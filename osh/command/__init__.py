@@ -24,6 +24,7 @@ in the B{Functions} section of the page.
 
 cli = [
     'agg',
+    'buffer',
     'cat',
     'copyfrom',
     'copyto',
@@ -45,6 +46,7 @@ cli = [
     'select',
     'sh',
     'sort',
+    'split',
     'sql',
     'squish',
     'tail',
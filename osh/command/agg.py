@@ -15,7 +15,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-"""C{agg [-r] [[-g|-c] GROUPING_FUNCTION] INITIAL_VALUE AGGREGATION_FUNCTION}
+"""C{agg [-r] [[-g|-c] GROUPING_FUNCTION] [-a COMBINER] INITIAL_VALUE AGGREGATION_FUNCTION}
 
 Aggregates objects from the input stream. If C{GROUPING_FUNCTION} is omitted, then
 one output object is generated by initializing an accumulator to C{INITIAL_VALUE}
@@ -65,10 +65,27 @@ be computed as follows::
 
 The output stream would be C{(1, 'a', 1), (3, 'a', 2), (3, 'b', 3), (7, 'b', 4)}.
 I.e., the running total is reinitialized to 0 for each group.
+
+If C{agg} follows a command run on a cluster, (e.g. C{osh @fred [ ... ] ^ agg ...}),
+then every input object has to be transferred from the cluster's nodes. This can
+be avoided by specifying C{COMBINER}, a function that combines two accumulators
+into one. The arguments to C{COMBINER} are the elements of one accumulator followed
+by the elements of the other. Each node then computes an accumulator for each group,
+from its own objects, and only those accumulators are transferred, to be combined
+by C{COMBINER}. For example, to sum ages by name across the cluster::
+
+    osh @fred [ sql 'select name, age from person' ] ^ \
+        agg -g 'node, name, age: name' -a 's1, s2: s1 + s2' 0 's, node, name, age: s + age' $
+
+(The first element of each input object identifies the node.) The result must not
+depend on how input objects are divided among the nodes, and C{INITIAL_VALUE} must
+leave an accumulator unchanged when combined with it, (e.g. C{0} for addition).
+C{COMBINER} is not used with C{-c} or C{-r}.
 """
 
 import osh.core
 import osh.args
+import osh.error
 import osh.function
 
 _wrap_if_necessary = osh.core.wrap_if_necessary
@@ -84,7 +101,8 @@ def agg(initial_value,
         aggregator,
         group = None,
         consecutive = None,
-        running = False):
+        running = False,
+        combiner = None):
     """Combine inputs into a smaller number of outputs. If neither C{group} nor
     C{consecutive} is specified, then there is one accumulator, initialized to
     C{initial_value}. The C{aggregator} function is used to combine the current value
@@ -100,7 +118,10 @@ def agg(initial_value,
     representing the aggregate for the entire input stream.) If C{running} is true,
     then each the aggregate value for the group is written out with each input object --
     i.e., the output contains "running totals". In this case, the aggregate values appear
-    before the input values in the output object.
+    before the input values in the output object. C{combiner} combines two accumulators
+    into one, allowing partial aggregates to be computed on the nodes of a cluster,
+    when C{agg} follows C{remote}. The arguments to C{combiner} are the elements of one
+    accumulator followed by the elements of the other.
     """
     args = [initial_value, aggregator]
     if group:
@@ -109,17 +130,23 @@ def agg(initial_value,
         args.append(Option('-c', consecutive))
     if running:
         args.append(Option('-r'))
+    if combiner:
+        args.append(Option('-a', combiner))
     return _Agg().process_args(*args)
 
 class _Agg(osh.core.Op):
 
     _aggregate = None
+    # True for a copy computing partial aggregates, (see partial_aggregate)
+    _partial = False
+    # True if input consists of partial aggregates
+    _combine = False
 
 
     # object interface
 
     def __init__(self):
-        osh.core.Op.__init__(self, 'g:c:r', (2, 2))
+        osh.core.Op.__init__(self, 'g:c:ra:', (2, 2))
 
 
     # BaseOp interface
@@ -144,6 +171,18 @@ class _Agg(osh.core.Op):
             self.usage()
         if grouping_function and consecutive_grouping_function:
             self.usage()
+        elif self._partial:
+            self._aggregate = _PartialAggregate(
+                self,
+                grouping_function,
+                initial_value,
+                aggregation_function)
+        elif self._combine:
+            self._aggregate = _CombiningAggregate(
+                self,
+                grouping_function is not None,
+                initial_value,
+                args.function_arg('-a'))
         elif grouping_function:
             self._aggregate = _GroupingAggregate(
                 self,
@@ -168,9 +207,27 @@ class _Agg(osh.core.Op):
     def receive(self, object):
         self._aggregate.receive(object)
 
+    def receive_batch(self, objects):
+        self._aggregate.receive_batch(objects)
+
     def receive_complete(self):
         self._aggregate.receive_complete()
 
+    def partial_aggregate(self):
+        args = self.args()
+        if args.arg('-a') is None or args.flag('-c') or args.flag('-r'):
+            return None
+        return _split(self)
+
+# Splits command into a partial aggregation, which is returned, and the combination
+# of partial aggregates, done by command.
+def _split(command):
+    partial = command.__class__()
+    partial._args = command.args().copy(partial)
+    partial._partial = True
+    command._combine = True
+    return partial
+
 class _GroupingAggregate(object):
     _running_totals = None
     _command = None
@@ -196,6 +253,27 @@ class _GroupingAggregate(object):
         if self._running_totals:
             self._command.send(_wrap_if_necessary(new_sum,) + tuple_object)
 
+    def receive_batch(self, objects):
+        group_function = self._group_function
+        aggregate_function = self._aggregate_function
+        initial_value = self._initial_value
+        sums = self._sum
+        running = []
+        for object in objects:
+            try:
+                group = group_function(*object)
+                tuple_object = tuple(object)
+                new_sum = aggregate_function(*(tuple(sums.get(group, initial_value)) + tuple_object))
+                sums[group] = _wrap_if_necessary(new_sum)
+                if self._running_totals:
+                    running.append(_wrap_if_necessary(new_sum) + tuple_object)
+            except osh.error.OshKiller:
+                raise
+            except Exception, e:
+                osh.error.exception_handler(e, self._command, object)
+        if running:
+            self._command.send_batch(running)
+
     def receive_complete(self):
         if not self._running_totals:
             for group, sum in self._sum.iteritems():
@@ -233,6 +311,18 @@ class _ConsecutiveGroupingAggregate(object):
         if self._running_totals:
             self._command.send(_wrap_if_necessary(new_sum,) + tuple_object)
 
+    def receive_batch(self, objects):
+        # Groups completed within the batch are sent immediately, (not batched), to
+        # preserve the order of output relative to group boundaries.
+        receive = self.receive
+        for object in objects:
+            try:
+                receive(object)
+            except osh.error.OshKiller:
+                raise
+            except Exception, e:
+                osh.error.exception_handler(e, self._command, object)
+
     def receive_complete(self):
         if (not self._running_totals) and self._group is not None:
             self._command.send(_wrap_if_necessary(self._group) + tuple(self._sum))
@@ -257,7 +347,120 @@ class _NonGroupingAggregate(object):
         if self._running_totals:
             self._command.send(_wrap_if_necessary(new_sum,) + tuple_object)
 
+    def receive_batch(self, objects):
+        aggregate_function = self._aggregate_function
+        sum = self._sum
+        running = []
+        for object in objects:
+            try:
+                tuple_object = tuple(object)
+                sum = _wrap_if_necessary(aggregate_function(*(tuple(sum) + tuple_object)))
+                if self._running_totals:
+                    running.append(sum + tuple_object)
+            except osh.error.OshKiller:
+                raise
+            except Exception, e:
+                osh.error.exception_handler(e, self._command, object)
+        self._sum = sum
+        if running:
+            self._command.send_batch(running)
+
     def receive_complete(self):
         if not self._running_totals:
             self._command.send(self._sum)
         self._command.send_complete()
+
+# Computes partial aggregates, for combination by _CombiningAggregate. Runs in
+# a pipeline copy, (e.g. on a node of a cluster), and is followed by a command
+# that prepends the thread state to each object. The grouping and aggregation
+# functions expect that, so the thread state is prepended to each input object here
+# too. Output objects are (group, accumulator) pairs, (group is None if there is no
+# grouping function).
+class _PartialAggregate(object):
+    _command = None
+    _thread_state = None
+    _group_function = None
+    _initial_value = None
+    _aggregate_function = None
+    _sum = None
+
+    def __init__(self, command, group_function, initial_value, aggregate_function):
+        self._command = command
+        self._thread_state = (command.thread_state,)
+        self._group_function = group_function
+        self._initial_value = initial_value
+        self._aggregate_function = aggregate_function
+        self._sum = {}
+
+    def receive(self, object):
+        self.receive_batch([object])
+
+    def receive_batch(self, objects):
+        thread_state = self._thread_state
+        group_function = self._group_function
+        aggregate_function = self._aggregate_function
+        initial_value = self._initial_value
+        sums = self._sum
+        for object in objects:
+            try:
+                input = thread_state + tuple(object)
+                if group_function:
+                    group = group_function(*input)
+                else:
+                    group = None
+                sum = tuple(sums.get(group, initial_value))
+                sums[group] = _wrap_if_necessary(aggregate_function(*(sum + input)))
+            except osh.error.OshKiller:
+                raise
+            except Exception, e:
+                osh.error.exception_handler(e, self._command, object)
+
+    def receive_complete(self):
+        if self._sum:
+            self._command.send_batch(self._sum.items())
+        self._command.send_complete()
+
+# Combines partial aggregates from _PartialAggregate. Input objects are
+# (thread state, group, accumulator).
+class _CombiningAggregate(object):
+    _command = None
+    _grouping = None
+    _initial_value = None
+    _combine_function = None
+    _sum = None
+
+    def __init__(self, command, grouping, initial_value, combine_function):
+        self._command = command
+        self._grouping = grouping
+        self._initial_value = initial_value
+        self._combine_function = combine_function
+        self._sum = {}
+
+    def receive(self, object):
+        self.receive_batch([object])
+
+    def receive_batch(self, objects):
+        combine_function = self._combine_function
+        sums = self._sum
+        for object in objects:
+            try:
+                thread_state, group, partial_sum = object
+                sum = sums.get(group, None)
+                if sum is None:
+                    sums[group] = partial_sum
+                else:
+                    sums[group] = _wrap_if_necessary(combine_function(*(tuple(sum) +
+                                                                        tuple(partial_sum))))
+            except osh.error.OshKiller:
+                raise
+            except Exception, e:
+                osh.error.exception_handler(e, self._command, object)
+
+    def receive_complete(self):
+        if self._grouping:
+            if self._sum:
+                self._command.send_batch([_wrap_if_necessary(group) + tuple(sum)
+                                          for group, sum in self._sum.iteritems()])
+        else:
+            self._command.send(self._sum.get(None, self._initial_value))
+        self._command.send_complete()
@@ -0,0 +1,185 @@
+# osh
+# Copyright (C) Jack Orenstein <jao@geophile.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""C{buffer [-n CAPACITY]}
+
+Input objects are sent to the output stream unchanged. Commands downstream of
+C{buffer} run in a separate thread, so that an upstream command, (e.g. C{cat}
+or C{sql}), can continue producing output while downstream commands are
+busy, (e.g. C{out} writing to a file). Up to C{CAPACITY} objects are held by
+C{buffer} while waiting to be processed downstream. When that many objects
+are held, upstream commands wait. The default capacity is given by the
+configuration parameter C{osh.buffer.capacity}, or 10000 if not specified.
+
+If the configuration parameter C{osh.buffer.auto} is true, then a C{buffer}
+is inserted automatically following a generator that reads from a file,
+a database, or another process, (e.g. C{cat}, C{sql}, C{sh}).
+"""
+
+import collections
+import threading
+
+import osh.args
+import osh.config
+import osh.core
+import osh.error
+
+Option = osh.args.Option
+
+DEFAULT_CAPACITY = 10000
+
+# Time in seconds that the upstream thread waits before checking again. Waiting
+# without a timeout blocks ctrl-c.
+_WAIT = 1.0
+
+# CLI
+def _buffer():
+    return _Buffer()
+
+# API
+def buffer(capacity = None):
+    """Input objects are sent to the output stream unchanged. Downstream commands
+    run in a separate thread. Up to C{capacity} objects are held while waiting to be
+    processed downstream.
+    """
+    args = []
+    if capacity is not None:
+        args.append(Option('-n', capacity))
+    return _Buffer().process_args(*args)
+
+class _Buffer(osh.core.Op):
+
+    _capacity = None
+    _batches = None
+    _size = None
+    _condition = None
+    _consumer = None
+    _error = None
+    _error_raised = False
+
+
+    # object interface
+
+    def __init__(self):
+        osh.core.Op.__init__(self, 'n:', (0, 0))
+
+
+    # BaseOp interface
+
+    def doc(self):
+        return __doc__
+
+    def setup(self):
+        args = self.args()
+        capacity = args.int_arg('-n')
+        if capacity is None:
+            capacity = osh.config.config_value('buffer.capacity')
+            if capacity is None:
+                capacity = DEFAULT_CAPACITY
+            else:
+                capacity = int(capacity)
+        if capacity < 1 or args.has_next():
+            self.usage()
+        self._capacity = capacity
+        self._batches = collections.deque()
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def receive(self, object):
+        self._put([object])
+
+    def receive_batch(self, objects):
+        self._put(objects)
+
+    def receive_complete(self):
+        if self._consumer is None:
+            self.send_complete()
+        else:
+            # None tells the consumer that there is no more input.
+            self._put(None)
+            while self._consumer.isAlive():
+                self._consumer.join(_WAIT)
+            self._consumer = None
+            error = self._error
+            if error:
+                if not self._error_raised:
+                    self._error_raised = True
+                    raise error
+                if not isinstance(error, osh.error.OshKiller):
+                    # The error has been handled upstream. Complete downstream
+                    # commands, as would be done without a buffer.
+                    self.send_complete()
+
+
+    # For use by this class
+
+    # Called by the upstream thread. Objects are queued for the consumer thread.
+    # If the consumer has failed, (e.g. raised DownstreamDone), then its exception
+    # is raised here, to be handled upstream.
+    def _put(self, objects):
+        if self._consumer is None:
+            self._consumer = threading.Thread(target = self._consume)
+            self._consumer.setDaemon(True)
+            self._consumer.start()
+        n = objects and len(objects) or 0
+        condition = self._condition
+        condition.acquire()
+        try:
+            while (self._error is None and
+                   self._size > 0 and
+                   self._size + n > self._capacity):
+                condition.wait(_WAIT)
+            if self._error:
+                if objects is None:
+                    # receive_complete raises the error, if necessary.
+                    return
+                self._error_raised = True
+                raise self._error
+            self._batches.append(objects)
+            self._size += n
+            condition.notifyAll()
+        finally:
+            condition.release()
+
+    # Runs in the consumer thread. Objects are sent downstream.
+    def _consume(self):
+        condition = self._condition
+        try:
+            while True:
+                condition.acquire()
+                try:
+                    while not self._batches:
+                        condition.wait()
+                    objects = self._batches.popleft()
+                    if objects is not None:
+                        self._size -= len(objects)
+                        condition.notifyAll()
+                finally:
+                    condition.release()
+                if objects is None:
+                    break
+                self.send_batch(objects)
+            self.send_complete()
+        except Exception, e:
+            condition.acquire()
+            try:
+                self._error = e
+                self._batches.clear()
+                self._size = 0
+                condition.notifyAll()
+            finally:
+                condition.release()
@@ -59,20 +59,30 @@ class _Cat(osh.core.Generator):
         if not self._filename:
             self.usage()
 
+    def io_bound(self):
+        return True
+
 
     # Generator interface
 
     def execute(self):
+        batch_size = osh.core.batch_size
         file = open(self._filename, 'r')
         try:
+            batch = []
             eof = False
             while not eof:
                 line = file.readline()
                 if line:
                     if line.endswith('\n'):
                         line = line[:-1]
-                    self.send(line)
+                    batch.append((line,))
+                    if len(batch) >= batch_size:
+                        self.send_batch(batch)
+                        batch = []
                 else:
                     eof = True
+            if batch:
+                self.send_batch(batch)
         finally:
             file.close()
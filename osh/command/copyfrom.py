@@ -15,7 +15,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-"""C{copyfrom [-Crpx] FILES LOCAL_DIR}
+"""C{copyfrom [-Crpxdt] FILES LOCAL_DIR}
 
 Copies C{FILES} from each node of a cluster to
 C{LOCAL_DIR}. The cluster is identified using remote execution syntax, for
@@ -41,16 +41,29 @@ C{copyfrom} is implemented using C{scp}, and the following C{scp} flags are supp
     - C{-C}: enable compression.
     - C{-r}: recursive copy
     - C{-p}: preserve modification times, access times, and modes.
+
+If C{-d} is specified, then only files that differ from those already in the
+target directory are copied. Files are compared by size and md5 digest, computed
+on each node by C{remoteosh}.
+
+If C{-t} is specified, then progress is tracked in a table showing, for each
+node, the number of files checked and copied, and the throughput. Otherwise,
+with verbosity 1 or more, the same information is printed for each node as its
+copy completes. The number of nodes copied from at one time can be limited, e.g.
+C{osh @fred -m 10 [ copyfrom ... ]}.
 """
 
 import os
+import time
 
 import osh.args
 import osh.core
 import osh.spawn
+import osh.transfer
 
 Spawn = osh.spawn.Spawn
 Option = osh.args.Option
+collect_lines = osh.spawn.collect_lines
 
 # CLI
 def _copyfrom():
@@ -58,14 +71,17 @@ def _copyfrom():
 
 # API
 def copyfrom(files, local_dir,
-             compress = False, recursive = False, preserve = False, no_subdirs = False):
+             compress = False, recursive = False, preserve = False, no_subdirs = False,
+             delta = False, track = False):
     """Copies C{files} from each node of the specified C{cluster} to C{local_dir}.
     If C{no_subdirs} is False, then a subdirectory under C{local_dir} is created for
     each node of the cluster and the files from a node are copied to that node's subdirectory.
     If C{no_subdirs} is true, then C{cluster} must be a single-node cluster, no subdirectory
     is created, and files are copied directly into C{local_dir}. Compression is used
     for copying if C{compress} is True. Directories are copied recursively if C{recursive} is
-    True. File attributes are preserved if C{preserve} is True.
+    True. File attributes are preserved if C{preserve} is True. If C{delta} is True,
+    then only files that differ from those in the target directory are copied.
+    Progress is displayed in a table if C{track} is True.
     """
     args = []
     if compress:
@@ -76,6 +92,11 @@ def copyfrom(files, local_dir,
         args.append(Option('-p'))
     if no_subdirs:
         args.append(Option('-x'))
+    if delta:
+        args.append(Option('-d'))
+    if track:
+        args.append(Option('-t'))
+    args.extend([files, local_dir])
     return _CopyFrom().process_args(*args)
 
 class _CopyFrom(osh.core.RunLocal):
@@ -85,30 +106,39 @@ class _CopyFrom(osh.core.RunLocal):
     _local_dir = None
     _file = None
     _scp_options = None
+    _file_scp_options = None
     _use_subdirs = None
+    _recursive = None
+    _delta = None
 
 
     # object interface
     
     def __init__(self):
-        osh.core.RunLocal.__init__(self, 'Crpx', (2, 2))
+        osh.core.RunLocal.__init__(self, 'Crpxdt', (2, 2))
 
     # BaseOp interface
     
     def doc(self):
         return __doc__
 
+    def create_command_state(self, oshthreads):
+        return osh.transfer.Progress('copyfrom',
+                                     [thread.state for thread in oshthreads],
+                                     self.args().flag('-t'))
+
     def setup(self):
         args = self.args()
         scp_options = ''
         for option in 'Crp':
             if args.flag('-' + option):
                 scp_options += option
-        if scp_options:
-            self._scp_options = '-' + scp_options
-        else:
-            self._scp_options = ''
+        self._scp_options = _scp_options(scp_options)
+        # For copying individual files
+        self._file_scp_options = _scp_options(scp_options.replace('r', ''))
         self._use_subdirs = not args.flag('-x')
+        self._recursive = args.flag('-r')
+        self._delta = args.flag('-d')
         if args.has_next():
             self._file = args.next_string()
         if args.has_next():
@@ -122,6 +152,7 @@ class _CopyFrom(osh.core.RunLocal):
 
     def execute(self):
         host = self.thread_state
+        progress = self.command_state()
         target_dir = self._local_dir
         if self._use_subdirs:
             target_dir += '/' + host.name
@@ -129,25 +160,75 @@ class _CopyFrom(osh.core.RunLocal):
             os.makedirs(target_dir)
         except OSError:
             pass
-        _copydown(host.user,
-                  host.identity,
-                  host.address,
-                  self._file,
-                  target_dir,
-                  self._scp_options)
-
-def _copydown(user, identity, host, file, local_dir, options):
-    if identity:
-        scp_command = 'scp %s -i %s %s@%s:%s %s' % (options,
-                                                    identity,
-                                                    user,
-                                                    host,
-                                                    file,
-                                                    local_dir)
+        progress.start()
+        try:
+            start = time.time()
+            if self._delta:
+                self.copy_changed(host, target_dir, progress, start)
+            else:
+                errors = _copydown(host.user,
+                                   host.identity,
+                                   host.address,
+                                   self._file,
+                                   target_dir,
+                                   self._scp_options,
+                                   host.idle_timeout)
+                if errors:
+                    progress.error(host, ' '.join(errors))
+                progress.copied(host, None, None, None, time.time() - start)
+        finally:
+            progress.stop()
+
+    # For use by this class
+
+    def copy_changed(self, host, target_dir, progress, start):
+        remote_digests = osh.transfer.remote_digests(host, [self._file], self._recursive)
+        progress.checked(host, len(remote_digests))
+        # Group changed files by local directory, so that each directory takes one scp.
+        changed = {}
+        bytes = 0
+        for path, (relative_path, size, digest) in remote_digests.items():
+            local_path = os.path.join(target_dir, relative_path)
+            if not (os.path.isfile(local_path) and
+                    os.path.getsize(local_path) == size and
+                    osh.transfer.digest(local_path) == digest):
+                changed.setdefault(os.path.dirname(local_path), []).append(path)
+                bytes += size
+        errors = []
+        for local_dir, paths in sorted(changed.items()):
+            try:
+                os.makedirs(local_dir)
+            except OSError:
+                pass
+            errors.extend(_copydown(host.user,
+                                    host.identity,
+                                    host.address,
+                                    sorted(paths),
+                                    local_dir,
+                                    self._file_scp_options,
+                                    host.idle_timeout))
+        if errors:
+            progress.error(host, ' '.join(errors))
+        progress.copied(host,
+                        len(remote_digests),
+                        sum([len(paths) for paths in changed.values()]),
+                        bytes,
+                        time.time() - start)
+
+# Returns lines written to stderr by scp.
+def _copydown(user, identity, host, files, local_dir, options, idle_timeout):
+    if isinstance(files, str):
+        files = [files]
+    scp_command = 'scp %s %s %s %s' % (options,
+                                       osh.spawn.ssh_options(user, identity, host, idle_timeout),
+                                       ' '.join(['%s@%s:%s' % (user, host, file) for file in files]),
+                                       local_dir)
+    errors = []
+    Spawn(scp_command, None, None, collect_lines(errors)).run()
+    return errors
+
+def _scp_options(options):
+    if options:
+        return '-' + options
     else:
-        scp_command = 'scp %s %s@%s:%s %s' % (options,
-                                              user,
-                                              host,
-                                              file,
-                                              local_dir)
-    Spawn(scp_command, None, None, None).run()
+        return ''
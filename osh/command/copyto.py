@@ -15,7 +15,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-"""C{copyto [-rpC] FILE ... REMOTE_DIR}
+"""C{copyto [-rpCdt] [-f FANOUT] FILE ... REMOTE_DIR}
 
 Copies C{FILE}s to C{REMOTE_DIR} on each node of a cluster.
 The cluster is identified using remote execution syntax, for example::
@@ -29,24 +29,59 @@ are supported:
     - C{-C}: enable compression.
     - C{-r}: recursive copy
     - C{-p}: preserve modification times, access times, and modes.
+
+If C{-d} is specified, then only files that differ from those already on a node
+are copied. Files are compared by size and md5 digest, computed on each node by
+C{remoteosh}.
+
+If C{-f} is specified, then nodes that already have the files copy them to
+other nodes: The files are copied from the local host to C{FANOUT} nodes, and
+each node copies them to C{FANOUT} more nodes, after its own copy completes.
+This requires each node to be able to C{scp} to the others, as the cluster's
+user. If copying from a node fails, then the files are copied from the local
+host instead.
+
+If C{-t} is specified, then progress is tracked in a table showing, for each
+node, the number of files checked and copied, and the throughput. Otherwise,
+with verbosity 1 or more, the same information is printed for each node as its
+copy completes. The number of nodes copied to at one time can be limited, e.g.
+C{osh @fred -m 10 [ copyto ... ]}.
 """
 
+import os
+import threading
+import time
+
+import osh.args
 import osh.core
 import osh.spawn
+import osh.transfer
+import osh.util
 
+Option = osh.args.Option
 Spawn = osh.spawn.Spawn
+collect_lines = osh.spawn.collect_lines
 
 # CLI
 def _copyto():
     return _CopyTo()
 
 # API
-def copyto(files, compress = False, recursive = False, preserve = False):
+def copyto(files,
+           compress = False,
+           recursive = False,
+           preserve = False,
+           delta = False,
+           fanout = None,
+           track = False):
     """Copies files to each node of the specified C{cluster}. The last elements
     of C{files} is the target directory on each node. The preceding elements are
     the local files to be copied. Compression is used  for copying if C{compress}
     is True. Directories are copied recursively if C{recursive} is
-    True. File attributes are preserved if C{preserve} is True.
+    True. File attributes are preserved if C{preserve} is True. If C{delta} is
+    True, then only files that differ from those on a node are copied. If
+    C{fanout} is specified, then nodes that have the files copy them to
+    C{fanout} other nodes. Progress is displayed in a table if C{track} is True.
     """
     args = []
     if compress:
@@ -55,6 +90,13 @@ def copyto(files, compress = False, recursive = False, preserve = False):
         args.append(Option('-r'))
     if preserve:
         args.append(Option('-p'))
+    if delta:
+        args.append(Option('-d'))
+    if fanout:
+        args.append(Option('-f', fanout))
+    if track:
+        args.append(Option('-t'))
+    args.extend(files)
     return _CopyTo().process_args(*args)
 
 class _CopyTo(osh.core.RunLocal):
@@ -64,12 +106,17 @@ class _CopyTo(osh.core.RunLocal):
     _remote_dir = None
     _files = None
     _scp_options = None
+    _file_scp_options = None
+    _recursive = None
+    _delta = None
+    _fanout = None
+    _track = None
 
 
     # object interface
     
     def __init__(self):
-        osh.core.RunLocal.__init__(self, 'rpC', (2, None))
+        osh.core.RunLocal.__init__(self, 'rpCdf:t', (2, None))
 
 
     # BaseOp interface
@@ -77,16 +124,24 @@ class _CopyTo(osh.core.RunLocal):
     def doc(self):
         return __doc__
 
+    def create_command_state(self, oshthreads):
+        return _CopyToState(self.args().flag('-t'), [thread.state for thread in oshthreads])
+
     def setup(self):
         args = self.args()
         scp_options = ''
         for option in 'Crp':
             if args.flag('-' + option):
                 scp_options += option
-        if scp_options:
-            self._scp_options = '-' + scp_options
-        else:
-            self._scp_options = ''
+        self._scp_options = _scp_options(scp_options)
+        # For copying individual files
+        self._file_scp_options = _scp_options(scp_options.replace('r', ''))
+        self._recursive = args.flag('-r')
+        self._delta = args.flag('-d')
+        self._fanout = args.int_arg('-f')
+        if self._fanout is not None and self._fanout < 1:
+            self.usage()
+        self._track = args.flag('-t')
         files = args.remaining()
         if len(files) < 2:
             self.usage()
@@ -99,23 +154,203 @@ class _CopyTo(osh.core.RunLocal):
 
     def execute(self):
         host = self.thread_state
-        _copyup(self._files,
-                host.user,
-                host.identity,
-                host.address,
-                self._remote_dir,
-                self._scp_options)
-
-def _copyup(files, user, identity, host, remote_dir, options):
+        state = self.command_state()
+        state.progress.start()
+        try:
+            self.copy(host, state)
+        finally:
+            state.progress.stop()
+
+    # For use by this class
+
+    def copy(self, host, state):
+        start = time.time()
+        local_files = state.local_files(self._files, self._recursive)
+        if self._delta:
+            remote_digests = osh.transfer.remote_digests(
+                host,
+                [self.remote_path(relative_path) for path, relative_path in local_files])
+            state.progress.checked(host, len(local_files))
+            changed = [(path, relative_path) for path, relative_path in local_files
+                       if (remote_digests.get(self.remote_path(relative_path), (None,))[1:] !=
+                           state.local_digest(path))]
+        else:
+            changed = local_files
+        source = state.source(host, self._fanout)
+        errors = []
+        if changed:
+            if source:
+                errors = self.relay(source, host, changed)
+                if errors:
+                    state.progress.error(host, 'copy from %s failed: %s' %
+                                         (source.name, ' '.join(errors)))
+            if errors or not source:
+                errors = self.copy_from_local(host, changed)
+                if errors:
+                    state.progress.error(host, ' '.join(errors))
+        state.finished(host, not errors)
+        if errors:
+            changed = []
+        state.progress.copied(host,
+                              len(local_files),
+                              len(changed),
+                              sum([state.local_size(path) for path, relative_path in changed]),
+                              time.time() - start)
+
+    def copy_from_local(self, host, changed):
+        if self._delta:
+            errors = []
+            for dir, paths in self.group_by_dir(host, changed):
+                errors.extend(_copyup(paths, host.user, host.identity, host.address, dir,
+                                      self._file_scp_options, host.idle_timeout))
+            return errors
+        else:
+            return _copyup(self._files, host.user, host.identity, host.address,
+                           self._remote_dir, self._scp_options, host.idle_timeout)
+
+    # Copy files from source, a node that already has them, by running scp there.
+    def relay(self, source, host, changed):
+        if self._delta:
+            groups = [(dir, [self.remote_path(relative_path) for relative_path in relative_paths])
+                      for dir, relative_paths in self.group_by_dir(host, changed, False)]
+            options = self._file_scp_options
+        else:
+            # The top-level files, (not the contents of directories copied with -r).
+            groups = [(self._remote_dir,
+                       [os.path.join(self._remote_dir, os.path.basename(path.rstrip('/')))
+                        for path in self._files])]
+            options = self._scp_options
+        errors = []
+        for dir, paths in groups:
+            command = 'scp -q -o StrictHostKeyChecking=no %s %s %s@%s:%s' % (options,
+                                                                            ' '.join(paths),
+                                                                            host.user,
+                                                                            host.address,
+                                                                            dir)
+            output, command_errors = osh.util.ssh(source.user, source.identity, source.address,
+                                                  command, source.idle_timeout)
+            errors.extend(command_errors)
+        return errors
+
+    # Returns (remote directory, [path]) for the changed files, creating remote
+    # subdirectories as needed. Paths are local if local is true, otherwise
+    # relative.
+    def group_by_dir(self, host, changed, local = True):
+        groups = {}
+        for path, relative_path in changed:
+            dir = os.path.dirname(self.remote_path(relative_path))
+            groups.setdefault(dir, []).append(local and path or relative_path)
+        subdirs = [dir for dir in groups if dir != self._remote_dir.rstrip('/')]
+        if subdirs:
+            osh.util.ssh(host.user, host.identity, host.address,
+                         'mkdir -p %s' % ' '.join(sorted(subdirs)), host.idle_timeout)
+        return sorted(groups.items())
+
+    def remote_path(self, relative_path):
+        return os.path.join(self._remote_dir, relative_path)
+
+# Shared by the threads of a copyto: Local files, their digests, progress tracking,
+# and the fan-out tree. Nodes are placed in the tree as they start, so a node's
+# source, (its parent in the tree), has always started earlier.
+
+class _CopyToState(object):
+
+    _progress = None
+    _lock = None
+    _local_files = None
+    _local_digests = None
+    _local_sizes = None
+    _tree = None
+    _finished = None
+
+    def __init__(self, track, hosts):
+        self._progress = osh.transfer.Progress('copyto', hosts, track)
+        self._lock = threading.Condition()
+        self._local_digests = {}
+        self._local_sizes = {}
+        self._tree = []
+        self._finished = {}
+
+    progress = property(lambda self: self._progress)
+
+    def local_files(self, paths, recursive):
+        self._lock.acquire()
+        try:
+            if self._local_files is None:
+                self._local_files = list(osh.transfer.files(paths, recursive))
+            return self._local_files
+        finally:
+            self._lock.release()
+
+    def local_size(self, path):
+        self._lock.acquire()
+        try:
+            size = self._local_sizes.get(path, None)
+            if size is None:
+                size = self._local_sizes[path] = os.path.getsize(path)
+            return size
+        finally:
+            self._lock.release()
+
+    # Returns (size, digest) of a local file, computed once.
+    def local_digest(self, path):
+        self._lock.acquire()
+        try:
+            digest = self._local_digests.get(path, None)
+            if digest is None:
+                digest = (self.local_size(path), osh.transfer.digest(path))
+                self._local_digests[path] = digest
+            return digest
+        finally:
+            self._lock.release()
+
+    # Returns the node to copy from, or None to copy from the local host. If
+    # the source hasn't finished, waits for it. A source whose copy failed is
+    # not used.
+    def source(self, host, fanout):
+        if not fanout:
+            return None
+        self._lock.acquire()
+        try:
+            position = len(self._tree)
+            self._tree.append(host)
+            parent = position / fanout - 1
+            if parent < 0:
+                return None
+            source = self._tree[parent]
+            while source not in self._finished:
+                self._lock.wait(0.1)
+            if self._finished[source]:
+                return source
+            else:
+                return None
+        finally:
+            self._lock.release()
+
+    def finished(self, host, succeeded):
+        self._lock.acquire()
+        try:
+            self._finished[host] = succeeded
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+
+# Returns lines written to stderr by scp.
+def _copyup(files, user, identity, host, remote_dir, options, idle_timeout):
     if isinstance(files, list) or isinstance(files, tuple):
         files = ' '.join(files)
-    if identity:
-        scp_command = 'scp %s -i %s %s %s@%s:%s' % (options,
-                                                    identity,
-                                                    files,
-                                                    user,
-                                                    host,
-                                                    remote_dir)
+    scp_command = 'scp %s %s %s %s@%s:%s' % (options,
+                                             osh.spawn.ssh_options(user, identity, host, idle_timeout),
+                                             files,
+                                             user,
+                                             host,
+                                             remote_dir)
+    errors = []
+    Spawn(scp_command, None, None, collect_lines(errors)).run()
+    return errors
+
+def _scp_options(options):
+    if options:
+        return '-' + options
     else:
-        scp_command = 'scp %s %s %s@%s:%s' % (options, files, user, host, remote_dir)
-    Spawn(scp_command, None, None, None).run()
+        return ''
@@ -15,11 +15,17 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-"""C{f FUNCTION}
+"""C{f [-j N [-p] [-u]] FUNCTION}
 
 The result obtained by applying C{FUNCTION} to an input sequence is
 written as output.
 
+If C{-j} is specified, then C{FUNCTION} is applied by C{N} worker threads in
+parallel. If C{-p} is also specified, then the workers are child processes
+instead of threads, (which is useful for CPU-bound functions). Output is in
+the same order as input unless C{-u} is specified, in which case output
+is written as soon as it is available.
+
 B{Example}: If input contains the sequences C{(1, 2), (3, 4), (5, 6)}
 then this command::
 
@@ -30,19 +36,35 @@ generates the output C{(3,), (7,), (11,)}.
 
 import types
 
+import osh.args
+import osh.error
 import osh.function
 import osh.core
+import osh.workerpool
+
+Option = osh.args.Option
+
+_wrap_if_necessary = osh.core.wrap_if_necessary
 
 # CLI
 def _f():
     return _F()
 
 # API
-def f(function):
+def f(function, parallelism = None, processes = False, unordered = False):
     """The result obtained by applying C{FUNCTION} to an input sequence is
-    written as output.
+    written as output. If C{parallelism} is specified, then C{function} is
+    applied by that many worker threads, (or child processes if C{processes}
+    is true). Output is in input order unless C{unordered} is true.
     """
-    return _F().process_args(function)
+    args = [function]
+    if parallelism is not None:
+        args.append(Option('-j', parallelism))
+        if processes:
+            args.append(Option('-p'))
+        if unordered:
+            args.append(Option('-u'))
+    return _F().process_args(*args)
 
 # f can be used as a generator (function with no args) or
 # downstream. That's why receive and execute are both defined.
@@ -50,12 +72,16 @@ def f(function):
 class _F(osh.core.Generator):
 
     _function = None
+    _parallelism = None
+    _processes = None
+    _ordered = None
+    _workers = None
 
 
     # object interface
 
     def __init__(self):
-        osh.core.Generator.__init__(self, '', (1, 1))
+        osh.core.Generator.__init__(self, 'j:pu', (1, 1))
 
 
     # BaseOp interface
@@ -68,13 +94,87 @@ class _F(osh.core.Generator):
         self._function = args.next_function()
         if self._function is None or args.has_next():
             self.usage()
+        self._parallelism = args.int_arg('-j')
+        self._processes = args.flag('-p')
+        self._ordered = not args.flag('-u')
+        if self._parallelism is None:
+            if self._processes or not self._ordered:
+                self.usage()
+        elif self._parallelism < 1:
+            self.usage()
 
     def receive(self, object):
+        if self._parallelism:
+            self._submit([object])
+            return
         # core ensures that we get a tuple (see wrap_if_necessary)
         self.send(self._function(*object))
 
+    def receive_batch(self, objects):
+        if self._parallelism:
+            self._submit(objects)
+            return
+        function = self._function
+        output = []
+        for object in objects:
+            try:
+                output.append(_wrap_if_necessary(function(*object)))
+            except osh.error.OshKiller:
+                raise
+            except Exception, e:
+                osh.error.exception_handler(e, self, object)
+        if output:
+            self.send_batch(output)
+
+    def receive_complete(self):
+        workers = self._workers
+        if workers:
+            self._workers = None
+            try:
+                self._send_results(workers.drain())
+            finally:
+                workers.close()
+        self.send_complete()
+
+    def fusion_stage(self):
+        if self._parallelism:
+            return None
+        return ('f', self._function)
+
 
     # Generator interface
 
     def execute(self):
         self.send(self._function())
+
+
+    # For use by this class
+
+    def _submit(self, objects):
+        workers = self._workers
+        if workers is None:
+            workers = osh.workerpool.WorkerPool(osh.workerpool.apply_function(self._function),
+                                                self._parallelism,
+                                                self._processes,
+                                                self._ordered)
+            self._workers = workers
+        try:
+            n = workers.chunk_size(len(objects))
+            for i in xrange(0, len(objects), n):
+                self._send_results(workers.submit(objects[i:i + n]))
+        except:
+            self._workers = None
+            workers.close(True)
+            raise
+
+    def _send_results(self, completed):
+        output = []
+        for objects, results in completed:
+            for i in xrange(len(objects)):
+                ok, value = results[i]
+                if ok:
+                    output.append(_wrap_if_necessary(value))
+                else:
+                    osh.error.exception_handler(value, self, objects[i])
+        if output:
+            self.send_batch(output)
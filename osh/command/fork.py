@@ -16,18 +16,78 @@
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 """For API usage only, (for CLI use C{osh @FORK [ ... ]} syntax instead.)
+
+A local fork runs each copy of the pipeline in a thread. For CPU-bound
+pipelines, C{osh @FORK -p [ ... ]} (API: C{fork(..., processes = True)})
+runs each copy in a child process instead, so that the copies run in
+parallel on multiple cores. Output is pickled and sent to the parent process
+through a pipe. Process execution can be made the default for local forks
+by setting C{osh.fork.processes = True} in C{.oshrc}.
+
+For a cluster, C{osh @CLUSTER -z [ ... ]} (API: C{fork(..., compress = True)})
+compresses the output of each remote host while it is transferred. This is
+useful on slow network connections. Compression can be made the default for a
+cluster by setting C{osh.remote.CLUSTER.compress = True} in C{.oshrc}. With
+verbosity 1 or more, the number of bytes of output from each host, before and
+after compression, is printed when the host's command completes.
+
+Input to a fork can be distributed among the threads, (API: C{fork(..., scatter =
+...)}), e.g. C{osh ... ^ @CLUSTER -s rr [ ... ]}. Each input object is sent to one
+thread, (or host, or child process), and is input to the command running there. The
+value of C{-s} determines how objects are distributed:
+
+    - C{rr}: Round-robin.
+
+    - C{queue}: Each thread takes objects from a shared queue when it is ready for
+      more input, so that faster threads process more objects.
+
+    - A function: Objects with the same value of the function are sent to the same
+      thread.
+
+(C{split} distributes input among local threads without labelling output with the
+thread.)
+
+The number of threads running at one time can be limited, e.g. C{osh @CLUSTER -m 50
+[ ... ]}, (API: C{fork(..., max_threads = 50)}). For a cluster, a limit can be
+specified in C{.oshrc}, e.g. C{osh.remote.CLUSTER.max_hosts = 50}. The command
+starts on another thread when one finishes. Hosts start in order of decreasing
+priority, (specified in C{.oshrc} by the key C{priority} of a host, default 0), and
+otherwise in the order of the cluster's hosts. The limit is not applied with a
+C{merge_key}, or with C{-s} other than C{queue}, since these require all threads to
+run at once. With verbosity 1 or more, the start of each thread and the number of
+threads still waiting, and the running time of each thread, are printed.
+
+Output from threads being merged, (API: C{fork(..., merge_key = ...)}), is buffered
+until the merge is ready for it. Threads producing output quickly can buffer more
+than slow threads, up to a total of 100000 objects, (beyond one batch per thread).
+With verbosity 1 or more, the number of objects from each thread, the time that the
+merge waited for the thread's output, and the time that the thread waited for buffer
+space, are printed when the merge completes.
 """
 
+import cPickle
+import itertools
+import os
+import Queue
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
 import types
 
+import osh.agent
 import osh.args
 import osh.cluster
+import osh.config
 import osh.core
 import osh.error
 import osh.function
 import osh.oshthread
 import osh.spawn
 import osh.util
+import osh.wire
 import merge
 
 LineOutputConsumer = osh.spawn.LineOutputConsumer
@@ -42,7 +102,13 @@ def _fork():
     return _Fork()
 
 # API
-def fork(threadgen, command, merge_key = None):
+def fork(threadgen,
+         command,
+         merge_key = None,
+         processes = False,
+         compress = False,
+         scatter = None,
+         max_threads = None):
     """Creates threads and executes C{command} on each. The number of threads is determined
     by C{threadgen}. If C{threadgen} is an integer, then the specified number of threads is created,
     and each thread has an integer label, from 0 through C{threadgen} - 1. If C{threadgen} is
@@ -53,17 +119,35 @@ def fork(threadgen, command, merge_key = None):
     identifies the host, (whose type is C{osh.cluster.Host}). If C{merge_key} is specified, then
     the inputs of each thread are expected to be ordered by the C{merge_key}. The sequences
     from the threads
-    are then merged into a single sequence using the C{merge_key}.
+    are then merged into a single sequence using the C{merge_key}. If C{processes} is true,
+    and C{threadgen} does not specify a cluster, then C{command} is executed
+    in child processes instead of threads. If C{compress} is true,
+    and C{threadgen} specifies a cluster, then output from each host is compressed while
+    it is transferred. If C{scatter} is specified, then input objects are distributed
+    among the threads, (or hosts), and are input to C{command}. C{scatter} is C{'rr'}
+    (round-robin), C{'queue'} (threads take objects from a shared queue), or a
+    function, (objects with the same value of the function are sent to the same
+    thread). If C{max_threads} is specified, then at most that many threads run
+    at one time.
     """
     import osh.apiparser
     op = _Fork()
     if isinstance(command, osh.core.Op):
         command = [command]
     pipeline = osh.apiparser._sequence_op(command)
+    args = []
+    if processes:
+        args.append(Option('-p'))
+    if compress:
+        args.append(Option('-z'))
+    if scatter:
+        args.append(Option('-s', scatter))
+    if max_threads:
+        args.append(Option('-m', max_threads))
+    args.extend([threadgen, pipeline])
     if merge_key:
-        return op.process_args(threadgen, pipeline, merge_key)
-    else:
-        return op.process_args(threadgen, pipeline)
+        args.append(merge_key)
+    return op.process_args(*args)
 
 class _Fork(osh.core.Generator):
 
@@ -74,11 +158,19 @@ class _Fork(osh.core.Generator):
     _merge_key = None
     _function_store = None
     _cluster_required = None
+    _processes = None
+    _compress = None
+    _scatter = None
+    _max_threads = None
+    _scheduler = None
+    _started = False
+    _completed = False
+    _attach_thread_state = True
 
     # object interface
     
-    def __init__(self):
-        osh.core.Generator.__init__(self, '', (2, 3))
+    def __init__(self, flag_spec = 'pzs:m:', anon_range = (2, 3)):
+        osh.core.Generator.__init__(self, flag_spec, anon_range)
         self._function_store = FunctionStore()
         self._cluster_required = False
 
@@ -93,12 +185,52 @@ class _Fork(osh.core.Generator):
         threadgen = args.next()
         self._pipeline = args.next()
         self._merge_key = args.next()
+        self._processes = args.flag('-p') or osh.config.config_value('fork.processes')
+        self._compress = args.flag('-z')
+        self._max_threads = args.int_arg('-m')
+        if self._max_threads is not None and self._max_threads < 1:
+            self.usage()
         cluster, thread_ids = self.thread_ids(threadgen)
-        self.setup_pipeline(cluster)
+        if self._max_threads is None and cluster:
+            self._max_threads = cluster.max_hosts
+        scatter = args.arg('-s')
+        if scatter and cluster and self._pipeline.run_local():
+            self.usage()
+        self.setup_pipeline(cluster, scatter)
         self.setup_threads(thread_ids)
         self.setup_shared_state()
+        if scatter:
+            self.setup_scatter(scatter)
+        # Merging and scattering (other than through a queue) need all threads to run.
+        if self._merge_key or (scatter and scatter != 'queue'):
+            self._max_threads = None
+
+    def receive(self, object):
+        if self._scatter:
+            self.receive_batch([object])
+        else:
+            osh.core.Generator.receive(self, object)
+
+    def receive_batch(self, objects):
+        if self._scatter:
+            if not self._started:
+                self.start_threads()
+            if not self._scatter.put(objects):
+                # All hosts have finished, so no more input is needed.
+                self.receive_complete()
+                raise osh.error.DownstreamDone()
+        else:
+            osh.core.Generator.receive_batch(self, objects)
 
     def receive_complete(self):
+        if self._scatter:
+            if self._completed:
+                return
+            self._completed = True
+            if not self._started:
+                self.start_threads()
+            self._scatter.done()
+            self.wait_for_threads()
         for thread in self._threads:
             thread.pipeline.receive_complete()
 
@@ -106,16 +238,10 @@ class _Fork(osh.core.Generator):
     # generator interface
 
     def execute(self):
-        for thread in self._threads:
-            thread.pipeline.setup()
-            thread.pipeline.set_receiver(self._receiver)
-            thread.start()
-        for thread in self._threads:
-            while thread.isAlive():
-                thread.join(0.1)
-            thread_termination = thread.terminating_exception
-            if thread_termination:
-                osh.error.exception_handler(thread_termination, self, None, thread)
+        self.start_threads()
+        # With scatter, threads run until input is complete.
+        if not self._scatter:
+            self.wait_for_threads()
 
     # For use by this package
 
@@ -159,15 +285,62 @@ class _Fork(osh.core.Generator):
         except:
             self.usage()
 
-    def setup_pipeline(self, cluster):
+    def setup_pipeline(self, cluster, scatter = None):
         if cluster and not self._pipeline.run_local():
+            if self._merge_key is None:
+                self.push_down_aggregation()
             remote_op = _Remote()
-            remote_op.process_args(self._pipeline)
+            if self._compress:
+                remote_op.process_args(Option('-z'), self._pipeline)
+            else:
+                remote_op.process_args(self._pipeline)
             self._pipeline = osh.core.Pipeline()
             self._pipeline.append_op(remote_op)
-        self._pipeline.append_op(_AttachThreadState())
+        elif cluster is None and self._processes:
+            process_op = _LocalProcess()
+            process_op.process_args(self._pipeline)
+            self._pipeline = osh.core.Pipeline()
+            self._pipeline.append_op(process_op)
+        elif scatter:
+            # Each thread's pipeline takes input from the scatter.
+            self._pipeline = osh.core.Pipeline(_ScatterInput()).append_op(self._pipeline)
+        if self._attach_thread_state:
+            self._pipeline.append_op(_AttachThreadState())
         self._pipeline.append_op(merge.merge(self._merge_key))
 
+    # If the next command is an aggregation that can be split, (see
+    # BaseOp.partial_aggregate), then the partial aggregation is appended to the
+    # pipeline, so that it is computed on each host, and only partial aggregates are
+    # transferred.
+    def push_down_aggregation(self):
+        downstream = self._next_op
+        if downstream:
+            partial = downstream.partial_aggregate()
+            if partial:
+                self._pipeline.append_op(partial)
+
+    def setup_scatter(self, scatter):
+        if scatter not in ('rr', 'queue'):
+            scatter = create_function(scatter)
+        self._scatter = _Scatter(self, scatter, [thread.state for thread in self._threads])
+        for thread in self._threads:
+            thread.pipeline.ops().next().set_scatter(self._scatter)
+
+    def start_threads(self):
+        self._started = True
+        for thread in self._threads:
+            thread.pipeline.setup()
+            thread.pipeline.set_receiver(self._receiver)
+        self._scheduler = _Scheduler(self._threads, self._max_threads or len(self._threads))
+        self._scheduler.start()
+
+    def wait_for_threads(self):
+        self._scheduler.wait()
+        for thread in self._threads:
+            thread_termination = thread.terminating_exception
+            if thread_termination:
+                osh.error.exception_handler(thread_termination, self, None, thread)
+
     def setup_threads(self, thread_ids):
         pipeline_copier = _PipelineCopier(self)
         # Use FunctionStore to hide functions during pipeline copying
@@ -191,6 +364,86 @@ class _Fork(osh.core.Generator):
                 pipeline_copy_op = pipeline_copy_iterator.next()
                 pipeline_copy_op.set_command_state(command_state)
                         
+# Starts the threads of a fork, keeping at most max_running threads running, and
+# starting a waiting thread when a running one finishes. Waiting threads are started
+# in order of decreasing priority, (the priority of a Host), and otherwise in order.
+
+class _Scheduler(object):
+
+    _max_running = None
+    _waiting = None
+    _running = None
+    _start_times = None
+    _runtimes = None
+    _condition = None
+
+    def __init__(self, threads, max_running):
+        self._max_running = max_running
+        self._waiting = sorted(threads, key = lambda thread: -_priority(thread.state))
+        self._running = 0
+        self._start_times = {}
+        self._runtimes = []
+        self._condition = threading.Condition()
+
+    # Number of threads that have not started.
+    queue_depth = property(lambda self: len(self._waiting))
+
+    # (thread state, running time in seconds) for each thread that has finished, in
+    # order of completion.
+    runtimes = property(lambda self: self._runtimes)
+
+    def start(self):
+        self._condition.acquire()
+        try:
+            self._admit()
+        finally:
+            self._condition.release()
+
+    # Waits for all threads to finish.
+    def wait(self):
+        self._condition.acquire()
+        try:
+            while self._waiting or self._running:
+                # Timeout, so that the main thread can be interrupted
+                self._condition.wait(0.1)
+        finally:
+            self._condition.release()
+
+    # For use by this class
+
+    # Caller must hold the lock.
+    def _admit(self):
+        while self._waiting and self._running < self._max_running:
+            thread = self._waiting.pop(0)
+            self._running += 1
+            self._start_times[thread] = time.time()
+            if osh.core.verbosity >= 1:
+                print >>sys.stderr, ('%s: started, %s waiting' %
+                                     (_thread_name(thread.state), len(self._waiting)))
+            thread.set_completion_callback(self._finished)
+            thread.start()
+
+    # Called in the thread that finished.
+    def _finished(self, thread):
+        self._condition.acquire()
+        try:
+            self._running -= 1
+            runtime = time.time() - self._start_times[thread]
+            self._runtimes.append((thread.state, runtime))
+            if osh.core.verbosity >= 1:
+                print >>sys.stderr, ('%s: finished in %.3f sec' %
+                                     (_thread_name(thread.state), runtime))
+            self._admit()
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+def _priority(thread_state):
+    return getattr(thread_state, 'priority', 0)
+
+def _thread_name(thread_state):
+    return getattr(thread_state, 'name', thread_state)
+
 class _PipelineCopier(object):
 
     _fork = None
@@ -203,6 +456,31 @@ class _PipelineCopier(object):
         self._fork._function_store.restore_functions(copy)
         return copy
 
+# First command of a local thread's pipeline, with fork -s. Generates the objects
+# that the scatter passes to the thread.
+class _ScatterInput(osh.core.Generator):
+
+    _scatter = None
+
+    def __init__(self):
+        osh.core.Generator.__init__(self, '', (0, 0))
+
+    def setup(self):
+        pass
+
+    def execute(self):
+        thread_state = self.thread_state
+        try:
+            for objects in self._scatter.batches(thread_state):
+                self.send_batch(objects)
+        finally:
+            self._scatter.close(thread_state)
+
+    # for use by _Fork
+
+    def set_scatter(self, scatter):
+        self._scatter = scatter
+
 class _AttachThreadState(osh.core.Op):
 
     _thread_state = None
@@ -218,6 +496,118 @@ class _AttachThreadState(osh.core.Op):
             object = tuple(object)
         self.send(self._thread_state + object)
 
+    def receive_batch(self, objects):
+        thread_state = self._thread_state
+        self.send_batch([thread_state + tuple(object) for object in objects])
+
+# Distributes input to a fork among its threads, for fork -s. Input is passed to
+# each thread through a bounded queue, so that a slow thread slows down the input.
+# In queue mode, all threads share one queue.
+
+_SCATTER_QUEUE_SIZE = 4
+_SCATTER_BATCH_SIZE = 100
+_SCATTER_WAIT = 0.1
+
+class _Scatter(object):
+
+    _fork = None
+    _mode = None
+    _thread_states = None
+    _queues = None
+    _open = None
+    _next = None
+
+    def __init__(self, fork, mode, thread_states):
+        self._fork = fork
+        self._mode = mode
+        self._thread_states = thread_states
+        n = len(thread_states)
+        if mode == 'queue':
+            self._queues = [Queue.Queue(_SCATTER_QUEUE_SIZE * n)]
+        else:
+            self._queues = [Queue.Queue(_SCATTER_QUEUE_SIZE) for i in xrange(n)]
+        self._open = [True] * n
+        self._next = 0
+
+    # For use by _Fork
+
+    # Returns false if all threads have stopped taking input.
+    def put(self, objects):
+        mode = self._mode
+        if mode == 'queue':
+            for i in xrange(0, len(objects), _SCATTER_BATCH_SIZE):
+                self._put(0, objects[i:i + _SCATTER_BATCH_SIZE])
+        else:
+            n = len(self._queues)
+            if mode == 'rr':
+                # Continue the rotation from the previous batch.
+                start = self._next
+                self._next = (start + len(objects)) % n
+                parts = [None] * n
+                for i in xrange(n):
+                    parts[(start + i) % n] = objects[i::n]
+            else:
+                parts = [[] for i in xrange(n)]
+                for object in objects:
+                    try:
+                        parts[hash(mode(*object)) % n].append(object)
+                    except osh.error.OshKiller:
+                        raise
+                    except Exception, e:
+                        osh.error.exception_handler(e, self._fork, object)
+            for i in xrange(n):
+                if parts[i]:
+                    self._put(i, parts[i])
+        return True in self._open
+
+    def done(self):
+        if self._mode == 'queue':
+            for i in xrange(len(self._thread_states)):
+                self._put(0, None)
+        else:
+            for i in xrange(len(self._queues)):
+                self._put(i, None)
+
+    # For use by _Remote, _ScatterInput and _LocalProcess
+
+    def batches(self, thread_state):
+        i = self._thread_states.index(thread_state)
+        queue = self._queues[0 if self._mode == 'queue' else i]
+        while self._open[i]:
+            objects = queue.get()
+            if objects is None or not self._open[i]:
+                return
+            yield objects
+
+    def close(self, thread_state):
+        i = self._thread_states.index(thread_state)
+        self._open[i] = False
+        if self._mode != 'queue':
+            # Wake up a thread waiting for input, (e.g. the thread sending input to a
+            # child process that has exited).
+            try:
+                self._queues[i].put_nowait(None)
+            except Queue.Full:
+                pass
+
+    # For use by this class
+
+    # Objects for a thread that has stopped taking input are discarded.
+    def _put(self, i, objects):
+        queue = self._queues[i]
+        while self._taking_input(i):
+            try:
+                queue.put(objects, True, _SCATTER_WAIT)
+                return
+            except Queue.Full:
+                pass
+
+    def _taking_input(self, i):
+        if self._mode == 'queue':
+            return True in self._open
+        else:
+            return self._open[i]
+
 # osh needs to copy pipelines to support forks. 
 # 1. Pickling: doesn't handle functions.
 # 2. Marshaling: doesn't handle recursive structures. Pipelines are recursive due to BaseOp.parent.
@@ -290,11 +680,13 @@ class _Remote(osh.core.Generator):
     # state
 
     _pipeline = None
+    _compress = None
+    _scatter = None
 
     # object interface
     
     def __init__(self):
-        osh.core.Generator.__init__(self, '', (1, 1))
+        osh.core.Generator.__init__(self, 'z', (1, 1))
 
     # BaseOp interface
     
@@ -302,36 +694,327 @@ class _Remote(osh.core.Generator):
         return __doc__
 
     def setup(self):
-        self._pipeline = self.args().next()
+        args = self.args()
+        self._compress = args.flag('-z')
+        self._pipeline = args.next()
 
     # generator interface
 
     def execute(self):
         host = self.thread_state
-        process = Spawn(
-            self._remote_command(host.address, host.user, host.identity, host.db_profile),
-            ObjectInputProvider(lambda stream, object: _dump(stream, object),
-                                [osh.core.verbosity, self._pipeline, self.thread_state]),
-            ObjectOutputConsumer(lambda object: _consume_remote_stdout(self, host, object)),
-            LineOutputConsumer(lambda line: _consume_remote_stderr(self, host, line)))
-        process.run()
+        stats = osh.wire.WireStats()
+        inputs = [osh.core.verbosity, self._pipeline, self.thread_state]
+        environment = self._environment(self._compress or host.compress)
+        connection = None
+        if host.agent:
+            connection = self._connect_to_agent(host)
+        if connection:
+            # The agent receives the environment variables as the first input.
+            header = dict([(name, str(value)) for name, value in environment])
+            inputs.insert(0, header)
+        scatter = self._scatter
+        if scatter:
+            # Input is streamed while the remote pipeline runs.
+            inputs = itertools.chain(inputs, scatter.batches(host), [None])
+        input_provider = ObjectInputProvider(lambda stream, object: _dump(stream, object),
+                                             inputs)
+        out_consumer = ObjectOutputConsumer(
+            lambda object: _consume_remote_stdout(self, host, object), stats)
+        if connection:
+            process = osh.agent.AgentConnection(connection, input_provider, out_consumer)
+        else:
+            process = Spawn(
+                self._remote_command(host.address, host.user, host.identity, host.db_profile,
+                                     host.idle_timeout, environment),
+                input_provider,
+                out_consumer,
+                LineOutputConsumer(lambda line: _consume_remote_stderr(self, host, line)))
+        try:
+            process.run()
+        finally:
+            if scatter:
+                scatter.close(host)
+        if osh.core.verbosity >= 1:
+            print >>sys.stderr, ('%s: output %s bytes, transferred %s bytes' %
+                                 (host.name, stats.raw_bytes, stats.wire_bytes))
         if process.terminating_exception():
             raise process.terminating_exception()
 
+    # for use by _Fork
+
+    def set_scatter(self, scatter):
+        self._scatter = scatter
+
     # for use by this class
 
-    def _remote_command(self, host, user, identity, db_profile):
-        buffer = [_REMOTE_EXECUTABLE]
+    # Returns the environment variables for remoteosh, as (name, value) pairs: Request
+    # the framed object stream, (see osh.wire), and compression. An older remoteosh
+    # ignores the requests.
+    def _environment(self, compress):
+        environment = [(osh.wire.ENV_VAR, osh.wire.VERSION)]
+        if compress:
+            environment.append((osh.wire.COMPRESS_ENV_VAR, 1))
+        if self._scatter:
+            environment.append((osh.wire.INPUT_ENV_VAR, 1))
+        return environment
+
+    # Returns a connection to the host's agent, (see osh.agent), or None if the
+    # agent can't be reached.
+    def _connect_to_agent(self, host):
+        try:
+            return osh.agent.connect(host.agent, host.address)
+        except socket.error, e:
+            if osh.core.verbosity >= 1:
+                print >>sys.stderr, ('%s: agent at %s unavailable, using ssh (%s)' %
+                                     (host.name, host.agent, e))
+            return None
+
+    def _remote_command(self, host, user, identity, db_profile, idle_timeout, environment):
+        buffer = ['env']
+        for name, value in environment:
+            buffer.append('%s=%s' % (name, value))
+        buffer.append(_REMOTE_EXECUTABLE)
         if db_profile:
             buffer.append(db_profile)
         remote_command = ' '.join(buffer)
-        if identity:
-            ssh_command = 'ssh %s -l %s -i %s %s' % (host,
-                                                     user,
-                                                     identity,
-                                                     remote_command)
-        else:
-            ssh_command = 'ssh %s -l %s %s' % (host,
-                                               user,
-                                               remote_command)
-        return ssh_command
+        return 'ssh %s -l %s %s %s' % (host,
+                                       user,
+                                       osh.spawn.ssh_options(user, identity, host, idle_timeout),
+                                       remote_command)
+
+# Local execution in child processes
+
+# Parent's ends of pipes carrying scattered input to child processes. A child closes
+# all of them, so that each child sees the end of its input when the parent closes
+# the pipe. _fork_lock serializes creating these pipes and forking.
+_input_fds = set()
+_fork_lock = threading.Lock()
+
+class _LocalProcess(osh.core.Generator):
+
+    # state
+
+    _pipeline = None
+    _scatter = None
+
+    # object interface
+
+    def __init__(self):
+        osh.core.Generator.__init__(self, '', (1, 1))
+
+    # BaseOp interface
+
+    def doc(self):
+        return __doc__
+
+    def setup(self):
+        self._pipeline = self.args().next()
+
+    # generator interface
+
+    def execute(self):
+        thread_state = self.thread_state
+        input_sender = None
+        _fork_lock.acquire()
+        try:
+            read_fd, write_fd = os.pipe()
+            child_input_fd = None
+            if self._scatter:
+                child_input_fd, input_fd = os.pipe()
+                _input_fds.add(input_fd)
+            # Don't let the child inherit unwritten output
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                for fd in _input_fds:
+                    os.close(fd)
+                _run_in_child(self._pipeline, thread_state, write_fd, child_input_fd)
+            os.close(write_fd)
+            if child_input_fd is not None:
+                os.close(child_input_fd)
+        finally:
+            _fork_lock.release()
+        child = _ChildProcess(pid)
+        osh.spawn.all_processes.append(child)
+        if self._scatter:
+            input_sender = threading.Thread(target = self._send_input,
+                                            args = (input_fd, thread_state))
+            input_sender.setDaemon(True)
+            input_sender.start()
+        input = os.fdopen(read_fd, 'rb')
+        try:
+            try:
+                while True:
+                    try:
+                        objects = cPickle.load(input)
+                    except EOFError:
+                        break
+                    if isinstance(objects, osh.error.PickleableException):
+                        exception = objects.recreate_exception()
+                        osh.error.exception_handler(exception,
+                                                    objects.command_description(),
+                                                    objects.input(),
+                                                    thread_state)
+                    else:
+                        self.send_batch(objects)
+            except osh.error.DownstreamDone:
+                child.kill()
+                raise
+        finally:
+            input.close()
+            child.wait()
+            osh.spawn.all_processes.remove(child)
+            if input_sender:
+                self._scatter.close(thread_state)
+                input_sender.join()
+
+    # for use by _Fork
+
+    def set_scatter(self, scatter):
+        self._scatter = scatter
+
+    # for use by this class
+
+    # Runs in its own thread, sending the objects that the scatter passes to this
+    # thread to the child process.
+    def _send_input(self, fd, thread_state):
+        output = os.fdopen(fd, 'wb')
+        try:
+            try:
+                for objects in self._scatter.batches(thread_state):
+                    cPickle.dump(objects, output, cPickle.HIGHEST_PROTOCOL)
+                    output.flush()
+            except IOError:
+                # The child has exited
+                pass
+        finally:
+            self._scatter.close(thread_state)
+            _fork_lock.acquire()
+            try:
+                _input_fds.discard(fd)
+                try:
+                    output.close()
+                except IOError:
+                    pass
+            finally:
+                _fork_lock.release()
+
+class _ChildProcess(object):
+
+    _pid = None
+
+    def __init__(self, pid):
+        self._pid = pid
+
+    def kill(self):
+        try:
+            os.kill(self._pid, signal.SIGKILL)
+        except OSError:
+            # Already gone
+            pass
+
+    def wait(self):
+        try:
+            os.waitpid(self._pid, 0)
+        except OSError:
+            pass
+
+# Runs in the child process, and does not return. If input_fd is not None, then the
+# pipeline's input is read from it.
+def _run_in_child(pipeline, thread_state, fd, input_fd = None):
+    status = 0
+    try:
+        try:
+            output = _PickleOutput(os.fdopen(fd, 'wb'))
+            osh.error.set_exception_handler(output.dump_exception)
+            if input_fd is not None:
+                pipeline.prepend_op(_Unpickler(os.fdopen(input_fd, 'rb')))
+            pipeline.set_thread_state(thread_state)
+            pipeline.append_op(_Pickler(output))
+            pipeline.setup()
+            pipeline.execute()
+            pipeline.receive_complete()
+            output.close()
+        except:
+            traceback.print_exc()
+            status = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+# Writes pickled output to the parent process. Commands within the child may run
+# in multiple threads, (e.g. a nested fork), so writes are serialized.
+class _PickleOutput(object):
+
+    _file = None
+    _lock = None
+
+    def __init__(self, file):
+        self._file = file
+        self._lock = threading.Lock()
+
+    def dump(self, objects):
+        self._lock.acquire()
+        try:
+            cPickle.dump(objects, self._file, cPickle.HIGHEST_PROTOCOL)
+            self._file.flush()
+        finally:
+            self._lock.release()
+
+    def dump_exception(self, exception, op, input, thread = None):
+        self.dump(osh.error.PickleableException(str(op), input, exception))
+
+    def close(self):
+        self._file.close()
+
+# First command of a pipeline running in a child process, with fork -s. Generates
+# the lists of objects sent by the parent process.
+class _Unpickler(osh.core.Generator):
+
+    _input = None
+
+    def __init__(self, input):
+        osh.core.Generator.__init__(self, '', (0, 0))
+        self._input = input
+
+    def setup(self):
+        pass
+
+    def execute(self):
+        input = self._input
+        try:
+            while True:
+                try:
+                    objects = cPickle.load(input)
+                except EOFError:
+                    break
+                self.send_batch(objects)
+        finally:
+            input.close()
+
+# Last command of a pipeline running in a child process. Objects are sent to the
+# parent process in lists, (which are passed on by send_batch).
+class _Pickler(osh.core.Op):
+
+    _output = None
+
+    def __init__(self, output):
+        osh.core.Op.__init__(self, '', (0, 0))
+        self._output = output
+
+    def setup(self):
+        pass
+
+    def receive(self, object):
+        self._output.dump([object])
+
+    def receive_batch(self, objects):
+        self._output.dump(objects)
+
+    def receive_complete(self):
+        pass
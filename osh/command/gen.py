@@ -82,7 +82,10 @@ class _Gen(osh.core.Generator):
     # Generator interface
     
     def execute(self):
-        if self._count is None:
+        batch_size = osh.core.batch_size
+        if batch_size > 1:
+            self._execute_batched(batch_size)
+        elif self._count is None:
             n = 0
             while True:
                 self._format_and_send(n)
@@ -93,9 +96,27 @@ class _Gen(osh.core.Generator):
 
     # For use by this class
 
+    def _execute_batched(self, batch_size):
+        if self._count is None:
+            n = 0
+            while True:
+                self._format_and_send_batch(n, n + batch_size)
+                n += batch_size
+        else:
+            end = self._start + self._count
+            for x in xrange(self._start, end, batch_size):
+                self._format_and_send_batch(x, min(x + batch_size, end))
+
     def _format_and_send(self, x):
         if self._format is None:
             self.send(x)
         else:
             self.send(self._format % x)
+
+    def _format_and_send_batch(self, start, end):
+        format = self._format
+        if format is None:
+            self.send_batch([(x,) for x in xrange(start, end)])
+        else:
+            self.send_batch([(format % x,) for x in xrange(start, end)])
         
@@ -23,6 +23,7 @@ is ignored. N must be an integer.
 """
 
 import osh.core
+import osh.error
 
 # CLI
 def _head():
@@ -39,6 +40,7 @@ class _Head(osh.core.Op):
 
     _n = None
     _received = None
+    _done = None
 
 
     # object interface
@@ -56,9 +58,43 @@ class _Head(osh.core.Op):
         args = self.args()
         self._n = args.next_int()
         self._received = 0
+        self._done = False
 
     def receive(self, object):
+        if self._done:
+            raise osh.error.DownstreamDone()
         self._received += 1
         delta = self._n - self._received
         if delta >= 0:
             self.send(object)
+        if delta <= 0:
+            self._finish()
+
+    def receive_batch(self, objects):
+        if self._done:
+            raise osh.error.DownstreamDone()
+        remaining = self._n - self._received
+        self._received += len(objects)
+        if remaining > 0:
+            if len(objects) > remaining:
+                objects = objects[:remaining]
+            self.send_batch(objects)
+        if self._received >= self._n:
+            self._finish()
+
+    def receive_complete(self):
+        if not self._done:
+            self._done = True
+            self.send_complete()
+
+    def fusion_stage(self):
+        return ('head', self._n)
+
+    # For use by this class
+
+    # All the output has been sent, so complete downstream commands now, and tell
+    # upstream commands to stop.
+    def _finish(self):
+        self._done = True
+        self.send_complete()
+        raise osh.error.DownstreamDone()
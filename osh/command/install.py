@@ -151,14 +151,16 @@ class _Install(osh.core.RunLocal):
             output, errors = ssh(self.user(),
                                  host.identity,
                                  host.address,
-                                 "python -c 'import sys; print (sys.prefix,) + sys.version_info[0:2]'")
+                                 "python -c 'import sys; print (sys.prefix,) + sys.version_info[0:2]'",
+                                 host.idle_timeout)
             package_dir = self.package_dir()
             install_dir = self.install_dir(eval(output[0])) + '/' + package_dir
             if package_dir != '':
                 ssh(self.user(),
                     host.identity,
                     host.address,
-                    'mkdir -p %s' % install_dir)                     
+                    'mkdir -p %s' % install_dir,
+                    host.idle_timeout)
             ui.ok(host.name, stage)
             # Copy files
             stage = 2
@@ -170,7 +172,7 @@ class _Install(osh.core.RunLocal):
                 sources = ' '.join(self._modules)
             else:
                 assert False
-            scp(self.user(), host.identity, host.address, flags, sources, install_dir)
+            scp(self.user(), host.identity, host.address, flags, sources, install_dir, host.idle_timeout)
             ui.ok(host.name, stage)
         except:
             (exc_type, exc_value, exc_traceback) = sys.exc_info()
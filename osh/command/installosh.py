@@ -122,12 +122,14 @@ class _InstallOsh(osh.core.RunLocal):
             ssh(host.user,
                 host.identity,
                 host.address,
-                '"rm -rf %s"' % _REMOTE_STAGING_DIR)
+                '"rm -rf %s"' % _REMOTE_STAGING_DIR,
+                host.idle_timeout)
             # Create remote install directory
             ssh(host.user,
                 host.identity,
                 host.address,
-                '"mkdir %s"' % _REMOTE_STAGING_DIR)
+                '"mkdir %s"' % _REMOTE_STAGING_DIR,
+                host.idle_timeout)
             ui.ok(host.name, stage)
             # Copy package to remote install directory
             stage += 1
@@ -136,7 +138,8 @@ class _InstallOsh(osh.core.RunLocal):
                 host.address,
                 None,
                 '/tmp/%s' % _DISTRIBUTION_FILENAME,
-                _REMOTE_STAGING_DIR)
+                _REMOTE_STAGING_DIR,
+                host.idle_timeout)
             ui.ok(host.name, stage)
             # Copy remoteinstall script to remote install directory
             stage += 1
@@ -145,11 +148,13 @@ class _InstallOsh(osh.core.RunLocal):
                 host.address,
                 None,
                 '%s/command/%s' % (self._local_osh_dir, _REMOTE_INSTALL_SCRIPT),
-                _REMOTE_STAGING_DIR)
+                _REMOTE_STAGING_DIR,
+                host.idle_timeout)
             ssh(host.user,
                 host.identity,
                 host.address,
-                'chmod a+x %s/%s' % (_REMOTE_STAGING_DIR, _REMOTE_INSTALL_SCRIPT))
+                'chmod a+x %s/%s' % (_REMOTE_STAGING_DIR, _REMOTE_INSTALL_SCRIPT),
+                host.idle_timeout)
             ui.ok(host.name, stage)
             # Run remoteinstall script
             stage += 1
@@ -160,21 +165,24 @@ class _InstallOsh(osh.core.RunLocal):
                                       _REMOTE_INSTALL_SCRIPT,
                                       _REMOTE_STAGING_DIR,
                                       _DISTRIBUTION_FILENAME,
-                                      self._remote_install_dir))
+                                      self._remote_install_dir),
+                host.idle_timeout)
             ui.ok(host.name, stage)
             # Copy config file to home directory unless one already exists
             stage += 1
             ls_oshrc, errors = ssh(host.user,
                                    host.identity,
                                    host.address,
-                                   '"ls /%s/%s"' % (host.user, _CONFIG_FILE))
+                                   '"ls /%s/%s"' % (host.user, _CONFIG_FILE),
+                                   host.idle_timeout)
             if len(ls_oshrc) == 0:
                 scp(host.user,
                     host.identity,
                     host.address,
                     None,
                     self._config_file,
-                    '~')
+                    '~',
+                    host.idle_timeout)
             ui.ok(host.name, stage)
         except:
             (exc_type, exc_value, exc_traceback) = sys.exc_info()
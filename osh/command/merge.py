@@ -20,6 +20,7 @@ import threading
 
 import osh.args
 import osh.core
+import osh.error
 import osh.priorityqueue
 
 # import osh.trace
@@ -63,6 +64,9 @@ class _Merge(osh.core.Op):
         self.command_state().add(self.thread_state, object)
         # trace('%s: receive %s done' % (self, object))
 
+    def receive_batch(self, objects):
+        self.command_state().add_batch(self.thread_state, objects)
+
     def receive_complete(self):
         # trace('%s: receive_complete' % self)
         self.command_state().done(self.thread_state)
@@ -91,13 +95,17 @@ class _MergeState(osh.priorityqueue.PriorityQueue):
     def setup(self, merge_op):
         if self._merger  is None:
             if merge_op._key:
-                self._merger = _PriorityQueueMerger(merge_op, len(self._oshthreads))
+                self._merger = _PriorityQueueMerger(merge_op,
+                                                    [thread.state for thread in self._oshthreads])
             else:
                 self._merger = _VanillaMerger(merge_op, len(self._oshthreads))
 
     def add(self, threadid, object):
         self._merger.add(self._thread_to_source[threadid], object)
 
+    def add_batch(self, threadid, objects):
+        self._merger.add_batch(self._thread_to_source[threadid], objects)
+
     def done(self, threadid):
         self._merger.done(self._thread_to_source[threadid])
 
@@ -111,6 +119,10 @@ class _Merger(object):
     def add(self, source, object):
         assert False
 
+    def add_batch(self, source, objects):
+        for object in objects:
+            self.add(source, object)
+
     def done(self, source):
         assert False
 
@@ -124,26 +136,46 @@ class _VanillaMerger(_Merger):
         self._lock = threading.RLock()
         self._active_sources = n_sources
     
+    # Sources are in different threads. Downstream commands aren't thread-safe, so
+    # only one source at a time can send.
+
     def add(self, source, object):
-        self._merge_op.send(object)
+        self._lock.acquire()
+        try:
+            self._merge_op.send(object)
+        finally:
+            self._lock.release()
+
+    def add_batch(self, source, objects):
+        self._lock.acquire()
+        try:
+            self._merge_op.send_batch(objects)
+        finally:
+            self._lock.release()
 
     def done(self, source):
         self._lock.acquire()
-        self._active_sources -= 1
-        if self._active_sources == 0:
-            self._merge_op.send_complete()
-        self._lock.release()
+        try:
+            self._active_sources -= 1
+            if self._active_sources == 0:
+                self._merge_op.send_complete()
+        finally:
+            self._lock.release()
 
 class _PriorityQueueMerger(_Merger):
 
     _priority_queue = None
     _consumer = None
+    _sources = None
     _n_sources = None
     _n_done = None
     
-    def __init__(self, merge_op, n_sources):
+    # sources: thread state of each source
+    def __init__(self, merge_op, sources):
         _Merger.__init__(self, merge_op)
-        self._priority_queue = osh.priorityqueue.PriorityQueue(merge_op.key, n_sources)
+        n_sources = len(sources)
+        self._priority_queue = osh.priorityqueue.HeapPriorityQueue(merge_op.key, n_sources)
+        self._sources = sources
         self._n_sources = n_sources
         self._n_done = 0
         self._consumer = _PriorityQueueConsumer(merge_op, self._priority_queue)
@@ -151,17 +183,35 @@ class _PriorityQueueMerger(_Merger):
 
     def add(self, source, object):
         # trace('%s: merge %s source %s, add %s' % (self, self._merge_op, source, object))
-        self._priority_queue.add(source, object)
+        try:
+            self._priority_queue.add(source, object)
+        except osh.priorityqueue.PriorityQueueClosedException:
+            raise osh.error.DownstreamDone()
         # trace('%s: merge %s source %s, add %s finished' % (self, self._merge_op, source, object))
 
+    def add_batch(self, source, objects):
+        try:
+            self._priority_queue.add_batch(source, objects)
+        except osh.priorityqueue.PriorityQueueClosedException:
+            raise osh.error.DownstreamDone()
+
     def done(self, source):
         # trace('%s: merge %s source %s, done' % (self, self._merge_op, source))
-        self._priority_queue.done(source)
+        try:
+            self._priority_queue.done(source)
+        except osh.priorityqueue.PriorityQueueClosedException:
+            pass
         # trace('%s: merge %s source %s, done finished' % (self, self._merge_op, source))
         self._n_done += 1
         if self._n_done == self._n_sources:
             while self._consumer.isAlive():
                 self._consumer.join(1.0)
+            if osh.core.verbosity >= 1:
+                stats = self._priority_queue.stats()
+                for i in xrange(self._n_sources):
+                    print >>sys.stderr, ('%s: merge %s' %
+                                         (getattr(self._sources[i], 'name', self._sources[i]),
+                                          stats[i]))
         
 class _PriorityQueueConsumer(threading.Thread):
 
@@ -177,9 +227,13 @@ class _PriorityQueueConsumer(threading.Thread):
     def run(self):
         # trace('%s: run' % self)
         merge = self._merge_op
-        for x in self._priority_queue:
-            # trace('%s: send %s' % (self, x))
-            merge.send(x)
-            # trace('%s: send %s done' % (self, x))
-        # trace('%s: send complete' % self)
-        merge.send_complete()
+        try:
+            for x in self._priority_queue:
+                # trace('%s: send %s' % (self, x))
+                merge.send(x)
+                # trace('%s: send %s done' % (self, x))
+            # trace('%s: send complete' % self)
+            merge.send_complete()
+        except osh.error.DownstreamDone:
+            # Unblock the threads adding to the queue. Their next add raises DownstreamDone.
+            self._priority_queue.close()
@@ -36,6 +36,7 @@ import sys
 
 import osh.args
 import osh.core
+import osh.error
 
 Option = osh.args.Option
 
@@ -115,6 +116,37 @@ class _Out(osh.core.Op):
             self._output = sys.stdout
     
     def receive(self, object):
+        formatted_object = self._format_object(object)
+        # Relying on print to provide the \n appears to result in a race condition.
+        print >> self._output, '%s\n' % formatted_object,
+        self._output.flush()
+        if not self._terminal:
+            self.send(object)
+
+    def receive_batch(self, objects):
+        lines = []
+        output = []
+        for object in objects:
+            try:
+                lines.append('%s\n' % self._format_object(object))
+                output.append(object)
+            except osh.error.OshKiller:
+                raise
+            except Exception, e:
+                osh.error.exception_handler(e, self, object)
+        print >> self._output, ''.join(lines),
+        self._output.flush()
+        if output and not self._terminal:
+            self.send_batch(output)
+
+    def receive_complete(self):
+        if self._output != sys.stdout:
+            self._output.close()
+        self.send_complete()
+
+    # For use by this class
+
+    def _format_object(self, object):
         if self._format:
             try:
                 formatted_object = self._format % object
@@ -138,16 +170,7 @@ class _Out(osh.core.Op):
                     formatted_object = '(' + ', '.join([_quote_if_needed(x) for x in object]) + ')'
             else:
                 formatted_object = str(object)
-        # Relying on print to provide the \n appears to result in a race condition.
-        print >> self._output, '%s\n' % formatted_object,
-        self._output.flush()
-        if not self._terminal:
-            self.send(object)
-
-    def receive_complete(self):
-        if self._output != sys.stdout:
-            self._output.close()
-        self.send_complete()
+        return formatted_object
 
 def _quote_if_needed(x):
     if x is None:
@@ -148,6 +148,17 @@ class ProgressTrackingUI(object):
                   '*' * column.width())
         self._lock.release()
 
+    def set(self, row_label, column_number, text):
+        # Shows text, (e.g. a count), in a cell, truncated to the column's width.
+        self.check_started()
+        self._lock.acquire()
+        row = self._rows[row_label]
+        column = self._columns[column_number]
+        self.draw(self.row_base() + row.position(),
+                  column.offset(),
+                  text[:column.width()].rjust(column.width()))
+        self._lock.release()
+
     def error(self, row_label, column_number, message):
         self.check_started()
         self._lock.acquire()
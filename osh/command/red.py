@@ -81,6 +81,13 @@ be computed as follows::
     ... ^ red -r -g 'x, y: x' 0 'sum, x, y: sum + y' ^ ...
 
 The output stream would be C{(1, 'a', 1), (3, 'a', 2), (3, 'b', 3), (7, 'b', 4)}.
+
+If C{red} (without C{-r}) follows a command run on a cluster, (e.g.
+C{osh @fred [ ... ] ^ red . . +}), then each node of the cluster reduces its own
+objects, and only the results are transferred, to be combined using the same
+C{BINARY_FUNCTION}s. For this reason, each C{BINARY_FUNCTION} should be associative
+and commutative, (as C{+}, C{*}, C{max} and C{min} are), so that the result does
+not depend on how objects are divided among the nodes.
 """
 
 import osh.core
@@ -92,6 +99,8 @@ create_function = osh.function._create_function
 Option = osh.args.Option
 _GroupingAggregate = agg._GroupingAggregate
 _NonGroupingAggregate = agg._NonGroupingAggregate
+_PartialAggregate = agg._PartialAggregate
+_CombiningAggregate = agg._CombiningAggregate
 
 # CLI
 def _red():
@@ -122,6 +131,10 @@ def red(binary_functions, running = False):
 class _Red(osh.core.Op):
 
     _aggregate = None
+    # True for a copy computing partial aggregates, (see partial_aggregate)
+    _partial = False
+    # True if input consists of partial aggregates
+    _combine = False
     
     # object interface
 
@@ -155,6 +168,7 @@ class _Red(osh.core.Op):
         functions = [create_function(functions[p]) for p in data_positions]
         initial_value = (None,) * n_data
         if n_group == 0:
+            grouper = None
             def aggregator(*t):
                 if t[:n_data] == initial_value:
                     # all None => first item, need to initialize accumulator
@@ -163,10 +177,6 @@ class _Red(osh.core.Op):
                     accumulator = tuple([functions[p](t[p], t[n_data + p])
                                          for p in xrange(n_data)])
                 return accumulator
-            self._aggregate = _NonGroupingAggregate(self,
-                                                    running,
-                                                    initial_value,
-                                                    aggregator)
         else:
             def grouper(*t):
                 return tuple([t[p] for p in group_positions])
@@ -179,6 +189,25 @@ class _Red(osh.core.Op):
                     accumulator = tuple([functions[p](t[p], t[n_data + data_positions[p]])
                                          for p in xrange(n_data)])
                 return accumulator
+        if self._partial:
+            self._aggregate = _PartialAggregate(self,
+                                                grouper,
+                                                initial_value,
+                                                aggregator)
+        elif self._combine:
+            def combiner(*t):
+                return tuple([functions[p](t[p], t[n_data + p])
+                              for p in xrange(n_data)])
+            self._aggregate = _CombiningAggregate(self,
+                                                  grouper is not None,
+                                                  initial_value,
+                                                  combiner)
+        elif grouper is None:
+            self._aggregate = _NonGroupingAggregate(self,
+                                                    running,
+                                                    initial_value,
+                                                    aggregator)
+        else:
             self._aggregate = _GroupingAggregate(self,
                                                  running,
                                                  grouper,
@@ -188,6 +217,13 @@ class _Red(osh.core.Op):
     def receive(self, object):
         self._aggregate.receive(object)
 
+    def receive_batch(self, objects):
+        self._aggregate.receive_batch(objects)
+
     def receive_complete(self):
         self._aggregate.receive_complete()
 
+    def partial_aggregate(self):
+        if self.args().flag('-r'):
+            return None
+        return agg._split(self)
@@ -21,16 +21,22 @@
 import fork
 
 # API
-def remote(cluster, command, merge_key = None):
+def remote(cluster, command, merge_key = None, compress = False, scatter = None,
+           max_hosts = None):
     """Executes C{command} remotely on each node of C{cluster}. Execution on all nodes is
     done in parallel. If C{merge_key} is specified, then
     the inputs of each thread are expected to be ordered by the C{merge_key}. The sequences
     from the threads
-    are then merged into a single sequence using the C{merge_key}.
+    are then merged into a single sequence using the C{merge_key}. If C{compress} is true,
+    then output from each node is compressed while it is transferred. If C{scatter} is
+    specified, then input objects are distributed among the nodes, (see C{fork}). If
+    C{max_hosts} is specified, then C{command} runs on at most that many nodes at one
+    time.
     (This function is identical to C{fork}, except that the first argument is required to
     identify a cluster.)
     """
-    op = fork.fork(cluster, command, merge_key)
+    op = fork.fork(cluster, command, merge_key, compress = compress, scatter = scatter,
+                   max_threads = max_hosts)
     op._set_cluster_required(True)
     return op
         
@@ -15,49 +15,92 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-"""C{sh COMMAND}
+"""C{sh [-b [-l MAX_LENGTH]] [-c] [-j JOBS] COMMAND}
 
 Spawns a process and executes C{COMMAND}.  Occurrences of formatting
 directives (e.g. C{%s}) will be replaced by input values.  Each line
 of C{stdout} is sent to the output stream. Each line of C{stderr} is
 handled by the osh stderr handler, (the default handler prints to
 osh's stderr).
+
+Normally, a process is spawned for each input. If C{-b} is specified, then
+inputs are collected into argument lists, as by C{xargs}: The values of
+the inputs, quoted for the shell, replace C{%s}, or are appended to C{COMMAND}
+if there is no C{%s}. A command is run when its length would exceed
+C{MAX_LENGTH}, (default 65536), and when input ends.
+
+If C{-c} is specified, then commands are run by a shell that keeps running,
+instead of by a new process each time. The shell reads commands from its
+standard input, so a command's standard input is C{/dev/null}. C{-j}
+specifies the number of such shells, (default 1), and implies C{-c}. With
+more than one shell, commands run in parallel, and the output of different
+commands may be interleaved, (but not the output of one command).
 """
 
+import os
+import pipes
+
+import osh.args
 import osh.core
 import osh.error
 import osh.spawn
 import osh.util
 
+Option = osh.args.Option
 Spawn = osh.spawn.Spawn
+Coprocess = osh.spawn.Coprocess
+OutputDispatcher = osh.spawn.OutputDispatcher
 LineOutputConsumer = osh.spawn.LineOutputConsumer
 remove_crlf = osh.util.remove_crlf
 
+# Maximum length of a command with an argument list, (-b).
+DEFAULT_MAX_LENGTH = 65536
+
 # CLI
 def _sh():
     return _Sh()
 
 # API
-def sh(command):
+def sh(command, batch = False, max_length = None, coprocess = False, jobs = None):
     """Spawns a process and executes C{command}.  Occurrences of formatting
     directives (e.g. C{%s}) will be replaced by input values.  Each line
     of C{stdout} is sent to the output stream. Each line of C{stderr} is
     handled by the osh stderr handler, (the default handler prints to
-    osh's stderr).
+    osh's stderr). If C{batch} is true, then inputs are collected into
+    argument lists of commands, of length up to C{max_length}. If C{coprocess}
+    is true, then commands are run by a shell that keeps running, instead of
+    a new process each time. C{jobs} specifies the number of shells, running
+    commands in parallel, and implies C{coprocess}.
     """
-    return _Sh().process_args(command)
+    args = []
+    if batch:
+        args.append(Option('-b'))
+    if max_length is not None:
+        args.append(Option('-l', max_length))
+    if coprocess:
+        args.append(Option('-c'))
+    if jobs is not None:
+        args.append(Option('-j', jobs))
+    args.append(command)
+    return _Sh().process_args(*args)
 
 class _Sh(osh.core.Generator):
 
     # state
 
     _command = None
+    _batch = False
+    _max_length = None
+    _jobs = None
+    # Quoted input values for the next command, (-b)
+    _arguments = None
+    _shells = None
 
 
     # object interface
     
     def __init__(self):
-        osh.core.Generator.__init__(self, '', (1, 1))
+        osh.core.Generator.__init__(self, 'bl:cj:', (1, 1))
 
 
     # BaseOp interface
@@ -67,6 +110,16 @@ class _Sh(osh.core.Generator):
 
     def setup(self):
         args = self.args()
+        self._batch = args.flag('-b')
+        self._max_length = args.int_arg('-l')
+        if self._max_length is None:
+            self._max_length = DEFAULT_MAX_LENGTH
+        self._jobs = args.int_arg('-j')
+        if self._jobs is None and args.flag('-c'):
+            self._jobs = 1
+        if (self._jobs is not None and self._jobs < 1) or self._max_length < 1:
+            self.usage()
+        self._arguments = []
         if args.has_next():
             self._command = args.next_string()
             if args.has_next():
@@ -75,8 +128,26 @@ class _Sh(osh.core.Generator):
             self.usage()
 
     def receive(self, object):
-        boundCommand = self._bind(object)
-        self._execute_command(boundCommand, object)
+        if self._batch:
+            if type(object) != tuple:
+                object = (object,)
+            arguments = [pipes.quote(str(value)) for value in object]
+            if (self._arguments and
+                len(self._bind_arguments(self._arguments + arguments)) > self._max_length):
+                self._run_batch()
+            self._arguments.extend(arguments)
+        else:
+            self._run(self._bind(object), object)
+
+    def receive_complete(self):
+        if self._arguments:
+            self._run_batch()
+        if self._shells:
+            self._shells.finish()
+        self.send_complete()
+
+    def io_bound(self):
+        return True
 
     # remote compile-time interface
 
@@ -100,6 +171,26 @@ class _Sh(osh.core.Generator):
             command = command.replace('%s', str(value), 1)
         return command
 
+    def _bind_arguments(self, arguments):
+        arguments = ' '.join(arguments)
+        if '%s' in self._command:
+            return self._command.replace('%s', arguments, 1)
+        else:
+            return '%s %s' % (self._command, arguments)
+
+    def _run_batch(self):
+        command = self._bind_arguments(self._arguments)
+        self._arguments = []
+        self._run(command, None)
+
+    def _run(self, command, input):
+        if self._jobs:
+            if self._shells is None:
+                self._shells = _Shells(self, self._jobs)
+            self._shells.run(command, input)
+        else:
+            self._execute_command(command, input)
+
     def _execute_command(self, command, input):
         process = Spawn(command,
                         None,
@@ -109,3 +200,142 @@ class _Sh(osh.core.Generator):
                                                                         self,
                                                                         input)))
         process.run()
+        termination = process.terminating_exception()
+        if isinstance(termination, osh.error.DownstreamDone):
+            raise termination
+
+# Shells that keep running, (-c, -j). A command is written to an idle shell, followed
+# by a command printing a delimiter, which marks the end of the command's output. All
+# the shells' output is dispatched by the thread running sh, so output is sent
+# downstream by that thread.
+
+class _Shells(object):
+
+    _shells = None
+    _output = None
+
+    def __init__(self, sh, n):
+        self._shells = [_Shell(sh) for i in xrange(n)]
+        consumers = []
+        for shell in self._shells:
+            consumers.extend(shell.consumers())
+        self._output = OutputDispatcher(consumers)
+        self._output.start()
+
+    def run(self, command, input):
+        self._output.dispatch(lambda: self._idle() is not None)
+        self._check_shells()
+        shell = self._idle()
+        if shell is None:
+            raise Exception('sh: shell exited before running: %s' % command)
+        shell.run(command, input)
+
+    def finish(self):
+        try:
+            self._output.dispatch(lambda: not [shell for shell in self._shells if shell.busy()])
+            for shell in self._shells:
+                shell.close_input_stream()
+            self._output.dispatch()
+        finally:
+            for shell in self._shells:
+                shell.wait()
+        self._check_shells()
+
+    # For use by this class
+
+    def _idle(self):
+        for shell in self._shells:
+            if not shell.busy() and shell.running():
+                return shell
+        return None
+
+    # Raises DownstreamDone, after stopping the shells, if a shell's output was
+    # rejected downstream.
+    def _check_shells(self):
+        for shell in self._shells:
+            termination = shell.terminating_exception()
+            if isinstance(termination, osh.error.DownstreamDone):
+                for shell in self._shells:
+                    shell.kill()
+                self._output.dispatch()
+                for shell in self._shells:
+                    shell.wait()
+                raise termination
+
+class _Shell(object):
+
+    _sh = None
+    _process = None
+    _delimiter = None
+    _busy = False
+    _input = None
+    _running = True
+
+    def __init__(self, sh):
+        self._sh = sh
+        self._delimiter = '--osh-%s--' % os.urandom(8).encode('hex')
+        self._process = Coprocess('exec /bin/sh',
+                                  _ShellOutputConsumer(self),
+                                  LineOutputConsumer(lambda line:
+                                                         osh.error.stderr_handler(line,
+                                                                                  sh,
+                                                                                  self._input)))
+
+    def consumers(self):
+        return self._process.consumers()
+
+    def busy(self):
+        return self._busy
+
+    def running(self):
+        return self._running
+
+    def run(self, command, input):
+        self._busy = True
+        self._input = input
+        # The command runs in a subshell, as if by a new shell, and can't read the
+        # commands that follow.
+        self._process.write('(%s\n) </dev/null\necho %s\n' % (command, self._delimiter))
+
+    def close_input_stream(self):
+        self._process.close_input_stream()
+
+    def wait(self):
+        self._process.wait()
+
+    def kill(self):
+        self._process.kill()
+
+    def terminating_exception(self):
+        return self._process.terminating_exception()
+
+    # For use by _ShellOutputConsumer
+
+    def line(self, line):
+        delimiter = self._delimiter + '\n'
+        if line.endswith(delimiter):
+            # Output of the command that didn't end with a newline precedes the delimiter.
+            line = line[:-len(delimiter)]
+            if line:
+                self._sh.send(remove_crlf(line))
+            self._busy = False
+        else:
+            self._sh.send(remove_crlf(line))
+
+    def exited(self):
+        self._running = False
+        self._busy = False
+
+class _ShellOutputConsumer(LineOutputConsumer):
+
+    _shell = None
+
+    def __init__(self, shell):
+        LineOutputConsumer.__init__(self, shell.line)
+        self._shell = shell
+
+    def finish(self):
+        try:
+            LineOutputConsumer.finish(self)
+        finally:
+            self._shell.exited()
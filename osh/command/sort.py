@@ -15,31 +15,95 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-"""C{sort [FUNCTION]}
+"""C{sort [-m MAX_OBJECTS] [-j N] [-k K [-g GROUP]] [FUNCTION]}
 
 Input objects are sorted before being written to output.  If
 C{FUNCTION} is not provided then input objects are sorted using the
 default ordering (i.e., based on the C{cmp} function).
 
-If C{FUNCTION} is provided, then sorting is done by applying C{cmp} to
-values obtained by applying C{FUNCTION} to the input objects.
+If C{FUNCTION} is provided, then sorting is done by comparing the
+values obtained by applying C{FUNCTION} to the input objects. C{FUNCTION}
+is applied once to each object. Objects with equal values are output in
+input order.
+
+At most C{MAX_OBJECTS} input objects are kept in memory, (default
+1000000, or the value of C{osh.sort.max_objects} in C{.oshrc}). Larger
+inputs are sorted in runs of C{MAX_OBJECTS} objects, which are written to
+temporary files, (in the directory given by C{TMPDIR}), and the runs are
+merged. If C{-j} is specified, then runs are sorted and written by C{N}
+child processes, in parallel with the input of the next run. Up to
+C{N} runs are in memory at once.
+
+If C{-k} is specified, then only the first C{K} objects of the sorted
+input are output, (as by C{sort ... ^ head K}), and only C{K} objects are
+kept in memory. If C{-g} is also specified, then the first C{K} objects
+are output for each value of the function C{GROUP}, (applied to input
+objects), in sorted order. E.g., this command outputs the three largest
+files of each user::
+
+    ... ^ sort -k 3 -g 'user, path, size: user' 'user, path, size: -size'
+
+A sort followed directly by C{head K} keeps only C{K} objects in memory,
+as if C{-k K} had been specified.
 """
 
+import cPickle
+import heapq
+import operator
+import os
+import signal
+import sys
+import tempfile
+
+import osh.args
+import osh.config
 import osh.core
+import osh.function
+import osh.wire
+
+Option = osh.args.Option
+
+create_function = osh.function._create_function
+
+# Objects kept in memory if not specified by -m or .oshrc
+DEFAULT_MAX_OBJECTS = 1000000
+
+# Runs merged at once. Runs beyond this are merged into a run first.
+MAX_MERGED_RUNS = 64
+
+# Objects passed at once to the writer of a run
+_WRITE_BATCH = 1000
+
+# Marks the end of a run
+_END = object()
 
 # CLI
 def _sort():
     return _Sort()
 
 # API
-def sort(function = None):
+def sort(function = None, max_objects = None, parallelism = None, top = None, group = None):
     """Input objects are sorted before being written to output. If
     C{function} is not provided then input objects are sorted using the
     default ordering (i.e., based on the C{cmp} function).
-    If C{function} is provided, then sorting is done by applying C{cmp} to
+    If C{function} is provided, then sorting is done by comparing the
     values obtained by applying C{function} to the input objects.
+    Objects with equal values are output in input order. If there are more
+    than C{max_objects} objects, then sorted runs are written to temporary files
+    and merged. If C{parallelism} is specified, then runs are sorted by that many
+    child processes. If C{top} is specified, then only the first C{top} objects of
+    the sorted input are output, for each value of the function C{group} if
+    specified.
     """
     args = []
+    if max_objects:
+        args.append(Option('-m', max_objects))
+    if parallelism:
+        args.append(Option('-j', parallelism))
+    if top:
+        args.append(Option('-k', top))
+    if group:
+        args.append(Option('-g', group))
     if function:
         args.append(function)
     return _Sort().process_args(*args)
@@ -48,12 +112,18 @@ class _Sort(osh.core.Op):
 
     _key = None
     _list = None
+    _max_objects = None
+    _parallelism = None
+    _runs = None # paths of files containing sorted runs, in input order
+    _writers = None # _RunWriters that haven't finished, in input order
+    _top = None # _Top, if only the first objects are output
+    _received = False
 
 
     # object interface
 
     def __init__(self):
-        osh.core.Op.__init__(self, '', (0, 1))
+        osh.core.Op.__init__(self, 'm:j:k:g:', (0, 1))
 
 
     # BaseOp interface
@@ -63,24 +133,309 @@ class _Sort(osh.core.Op):
 
     def setup(self):
         args = self.args()
+        self._max_objects = (args.int_arg('-m') or
+                             osh.config.config_value('sort.max_objects') or
+                             DEFAULT_MAX_OBJECTS)
+        self._parallelism = args.int_arg('-j')
+        if self._max_objects < 1 or (self._parallelism is not None and self._parallelism < 1):
+            self.usage()
+        top = args.int_arg('-k')
+        group = args.arg('-g')
+        if (top is not None and top < 1) or (group and top is None):
+            self.usage()
         if args.has_next():
             self._key = args.next_function()
         if args.has_next():
             self.usage()
+        if top:
+            self._top = _Top(self._key, top, group and create_function(group))
         self._list = []
+        self._runs = []
+        self._writers = []
     
     def receive(self, object):
+        if not self._received:
+            self._first_receive()
+        if self._top:
+            self._top.add(object)
+            return
         self._list.append(object)
+        if len(self._list) >= self._max_objects:
+            self._spill()
+
+    def receive_batch(self, objects):
+        if not self._received:
+            self._first_receive()
+        if self._top:
+            add = self._top.add
+            for object in objects:
+                add(object)
+            return
+        self._list.extend(objects)
+        if len(self._list) >= self._max_objects:
+            self._spill()
     
     def receive_complete(self):
+        try:
+            if self._top:
+                for object in self._top.objects():
+                    self.send(object)
+            elif self._runs or self._writers:
+                self._spill()
+                while self._writers:
+                    self._runs.append(self._writers.pop(0).wait())
+                while len(self._runs) > MAX_MERGED_RUNS:
+                    # Merging the earliest runs keeps objects with equal keys in input order.
+                    merged = _write_run(_merge(self._key, self._runs[:MAX_MERGED_RUNS], True))
+                    _remove(self._runs[:MAX_MERGED_RUNS])
+                    self._runs[:MAX_MERGED_RUNS] = [merged]
+                for object in _merge(self._key, self._runs):
+                    self.send(object)
+            else:
+                _sort_list(self._key, self._list)
+                for object in self._list:
+                    self.send(object)
+        finally:
+            for writer in self._writers:
+                writer.kill()
+            _remove(self._runs)
+        self.send_complete()
+
+    # For use by this class
+
+    # If the next command is head, then only as many objects as it passes on need to
+    # be kept. (Commands are set up before input arrives.)
+    def _first_receive(self):
+        self._received = True
+        next = self._next_op
+        if self._top is None and next is not None:
+            stage = next.fusion_stage()
+            if stage and stage[0] == 'head' and stage[1] > 0:
+                self._top = _Top(self._key, stage[1], None)
+
+    # Sorts the objects in memory as a run, and writes it to a file.
+    def _spill(self):
+        objects = self._list
+        self._list = []
+        if not objects:
+            return
+        if self._parallelism:
+            if len(self._writers) == self._parallelism:
+                self._runs.append(self._writers.pop(0).wait())
+            self._writers.append(_RunWriter(self._key, objects))
+        else:
+            self._runs.append(_write_run(_sorted_run(self._key, objects)))
+
+# Keeps the first k objects in sorted order, (of each group, if there is a group
+# function), using a heap whose first entry is the last object kept. Ties are
+# broken by input order, so the objects kept are those that a stable sort would put
+# first.
+class _Top(object):
+
+    _key = None
+    _k = None
+    _group = None
+    _heaps = None # group -> heap of _Kept
+    _count = 0
+
+    def __init__(self, key, k, group):
+        self._key = key
+        self._k = k
+        self._group = group
+        self._heaps = {}
+
+    def add(self, object):
         key = self._key
         if key:
-            # Attach the keys, sort by the key, then detach the key.
-            self._list = [(key(*object), object) for object in self._list]
-            self._list.sort(lambda x, y: cmp(x[0], y[0]))
-            self._list = [t[1] for t in self._list]
+            key = key(*object)
         else:
-            self._list.sort()
-        for object in self._list:
-            self.send(object)
-        self.send_complete()
+            key = object
+        if self._group:
+            group = self._group(*object)
+        else:
+            group = None
+        heap = self._heaps.get(group)
+        if heap is None:
+            heap = self._heaps[group] = []
+        self._count += 1
+        if len(heap) < self._k:
+            heapq.heappush(heap, _Kept(key, self._count, object))
+        elif key < heap[0].key:
+            # The new object follows the last one kept in input order, so it replaces
+            # that object only if its key is smaller.
+            heapq.heapreplace(heap, _Kept(key, self._count, object))
+
+    def objects(self):
+        kept = []
+        for heap in self._heaps.itervalues():
+            kept.extend(heap)
+        kept.sort(key = lambda kept: (kept.key, kept.position))
+        return [kept.object for kept in kept]
+
+# Ordered so that the last object in sorted order is at the top of a heap.
+class _Kept(object):
+
+    __slots__ = ['key', 'position', 'object']
+
+    def __init__(self, key, position, object):
+        self.key = key
+        self.position = position
+        self.object = object
+
+    def __lt__(self, other):
+        return (other.key, other.position) < (self.key, self.position)
+
+def _sort_list(key, objects):
+    if key:
+        objects.sort(key = lambda object: key(*object))
+    else:
+        objects.sort()
+
+# Returns the objects sorted, as (key, object) if there is a key, so that the keys
+# don't have to be computed again when runs are merged.
+def _sorted_run(key, objects):
+    if key:
+        run = [(key(*object), object) for object in objects]
+        run.sort(key = operator.itemgetter(0))
+        return run
+    else:
+        objects.sort()
+        return objects
+
+# Sorts a run and writes it to a file in a child process. The child has a copy of
+# the objects, so they don't need to be sent to it.
+class _RunWriter(object):
+
+    _pid = None
+    _result = None
+
+    def __init__(self, key, objects):
+        read_fd, write_fd = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            _write_run_in_child(key, objects, write_fd)
+        os.close(write_fd)
+        self._pid = pid
+        self._result = os.fdopen(read_fd, 'rb')
+
+    # Returns the path of the file containing the run.
+    def wait(self):
+        try:
+            try:
+                ok, value = cPickle.load(self._result)
+            except EOFError:
+                ok, value = False, Exception('sort process %s died' % self._pid)
+        finally:
+            self._result.close()
+            os.waitpid(self._pid, 0)
+        if not ok:
+            raise value
+        return value
+
+    def kill(self):
+        try:
+            os.kill(self._pid, signal.SIGKILL)
+        except OSError:
+            pass
+        try:
+            path = self.wait()
+            _remove([path])
+        except Exception:
+            pass
+
+# Runs in the child process of a _RunWriter, and does not return. Sends (True, path)
+# or (False, exception) to the parent.
+def _write_run_in_child(key, objects, fd):
+    status = 0
+    try:
+        try:
+            result = os.fdopen(fd, 'wb')
+            try:
+                outcome = (True, _write_run(_sorted_run(key, objects)))
+            except Exception, e:
+                outcome = (False, e)
+            try:
+                data = cPickle.dumps(outcome, cPickle.HIGHEST_PROTOCOL)
+            except Exception:
+                # An exception that can't be pickled
+                data = cPickle.dumps((False, Exception('%s: %s' % (e.__class__.__name__, e))),
+                                     cPickle.HIGHEST_PROTOCOL)
+            result.write(data)
+            result.close()
+        except:
+            import traceback
+            traceback.print_exc()
+            status = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+# Writes objects to a temporary file, in frames as by osh.wire, and returns the
+# file's path.
+def _write_run(objects):
+    fd, path = tempfile.mkstemp(prefix = 'osh-sort-')
+    file = os.fdopen(fd, 'wb')
+    try:
+        writer = osh.wire.FrameWriter(file, flush_interval = None)
+        batch = []
+        for object in objects:
+            batch.append(object)
+            if len(batch) == _WRITE_BATCH:
+                writer.write(batch)
+                batch = []
+        writer.write(batch)
+        writer.flush()
+    finally:
+        file.close()
+    return path
+
+# Generates the contents of the sorted runs in the given files, (written by
+# _sorted_run), in order. Entries of the heap are (key, run, object), or (object,
+# run) if there is no key, so that objects with equal keys are generated in run
+# order. If decorated is true, then objects are generated as (key, object).
+def _merge(key, paths, decorated = False):
+    files = [open(path, 'rb') for path in paths]
+    try:
+        runs = [osh.wire.read_objects(file) for file in files]
+        if key:
+            entry = lambda run, (key, object): (key, run, object)
+            if decorated:
+                output = lambda (key, run, object): (key, object)
+            else:
+                output = operator.itemgetter(2)
+        else:
+            entry = lambda run, object: (object, run)
+            output = operator.itemgetter(0)
+        heap = []
+        for run in xrange(len(runs)):
+            contents = next(runs[run], _END)
+            if contents is not _END:
+                heap.append(entry(run, contents))
+        heapq.heapify(heap)
+        heappop = heapq.heappop
+        heapreplace = heapq.heapreplace
+        while heap:
+            top = heap[0]
+            yield output(top)
+            run = top[1]
+            contents = next(runs[run], _END)
+            if contents is _END:
+                heappop(heap)
+            else:
+                heapreplace(heap, entry(run, contents))
+    finally:
+        for file in files:
+            file.close()
+
+def _remove(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,102 @@
+# osh
+# Copyright (C) Jack Orenstein <jao@geophile.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""C{split [-p] N [KEY] PIPELINE}
+
+Distributes input objects among C{N} copies of C{PIPELINE}, running
+in parallel, and merges their output. This is the inverse of
+merging. If C{KEY} is specified, then objects are distributed by the
+hash of C{KEY} applied to each object, so that objects with the same
+key go to the same copy. Otherwise, objects are distributed
+round-robin. For example, this command parses the lines of a file in
+eight threads, and aggregates the lines with the same first field in
+one thread:
+
+    C{osh cat bigfile ^ split 8 'line: line.split()[0]' [ f parse ^ agg ... ] $}
+
+Each copy runs in a thread. With C{-p}, each copy runs in a child
+process instead, so that CPU-bound pipelines run on multiple cores.
+Output objects are not labelled with the copy that produced them,
+(compare C{fork -s}), and the order of output from different copies
+is not preserved.
+"""
+
+import osh.args
+import osh.config
+import osh.core
+
+import fork
+
+Option = osh.args.Option
+
+# CLI
+def _split():
+    return _Split()
+
+# API
+def split(n, command, key = None, processes = False):
+    """Distributes input objects among C{n} copies of C{command}, running in parallel,
+    and merges their output. If C{key} is specified, then objects with the same value
+    of C{key} are sent to the same copy. Otherwise, objects are distributed
+    round-robin. If C{processes} is true, then each copy runs in a child process
+    instead of a thread.
+    """
+    import osh.apiparser
+    if isinstance(command, osh.core.Op):
+        command = [command]
+    pipeline = osh.apiparser._sequence_op(command)
+    args = []
+    if processes:
+        args.append(Option('-p'))
+    args.append(n)
+    if key:
+        args.append(key)
+    args.append(pipeline)
+    return _Split().process_args(*args)
+
+class _Split(fork._Fork):
+
+    _attach_thread_state = False
+
+    # object interface
+
+    def __init__(self):
+        fork._Fork.__init__(self, 'p', (2, 3))
+
+    # BaseOp interface
+
+    def doc(self):
+        return __doc__
+
+    def setup(self):
+        args = self.args()
+        n = args.next()
+        key = args.next()
+        self._pipeline = args.next()
+        if self._pipeline is None:
+            key, self._pipeline = None, key
+        if not isinstance(self._pipeline, osh.core.Pipeline):
+            self.usage()
+        self._processes = args.flag('-p') or osh.config.config_value('fork.processes')
+        cluster, thread_ids = self.thread_ids(n)
+        if cluster or not isinstance(n, int) and not n.isdigit():
+            self.usage()
+        scatter = key or 'rr'
+        self.setup_pipeline(None, scatter)
+        self.setup_threads(thread_ids)
+        self.setup_shared_state()
+        self.setup_scatter(scatter)
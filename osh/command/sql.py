@@ -33,6 +33,7 @@ import os
 
 import osh.loader
 import osh.core
+import osh.error
 
 # CLI
 def _sql():
@@ -141,6 +142,9 @@ class _Sql(osh.core.Generator):
             schema = self.thread_state.schema
             self._db_type.run_update(self._connection, set_schema_query % schema, [])
 
+    def io_bound(self):
+        return True
+
 
     # Generator interface
 
@@ -161,10 +165,14 @@ class _Sql(osh.core.Generator):
     # For use by this class
 
     def _execute_query(self, inputs):
-        for row in self._db_type.run_query(self._connection,
-                                           self._query,
-                                           inputs):
-            self.send(row)
+        rows = self._db_type.run_query(self._connection, self._query, inputs)
+        try:
+            for row in rows:
+                self.send(row)
+        except osh.error.DownstreamDone:
+            # Discard the rest of the query result.
+            rows.close()
+            raise
 
 class _DBType(object):
     
@@ -43,11 +43,17 @@ class DBAPI(osh.command.sql._DBType):
             connection.commit()
             yield rowcount
         else:
-            rows = cursor.fetchmany()
-            while len(rows) > 0:
-                for row in rows:
-                    yield row
+            try:
                 rows = cursor.fetchmany()
+                while len(rows) > 0:
+                    for row in rows:
+                        yield row
+                    rows = cursor.fetchmany()
+            except GeneratorExit:
+                # Caller closed the generator without reading all rows. Close the
+                # cursor so that the database can release the result.
+                cursor.close()
+                raise
 
     def close_connection(self, connection):
         connection.close()
@@ -51,6 +51,10 @@ class _Stdin(osh.core.Generator):
     def doc(self):
         return __doc__
 
+    def io_bound(self):
+        return True
+
+
     # Generator interface
 
     def execute(self):
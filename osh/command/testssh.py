@@ -75,7 +75,8 @@ class _TestSSH(osh.core.RunLocal):
 
     def execute(self):
         host = self.thread_state
-        output, errors = ssh(host.user, host.identity, host.address, 'echo hello')
+        output, errors = ssh(host.user, host.identity, host.address, 'echo hello',
+                             host.idle_timeout)
         for line in output:
             self.send(remove_crlf(line))
         for line in errors:
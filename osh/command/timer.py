@@ -114,19 +114,23 @@ class _Timer(osh.core.Generator):
         # the time between completion of downstream computing (invoked by self.send)
         # and the next timer event.
         self._metronome.start()
-        while not self._done:
-            self._lock.acquire()
-            while self._now is None:
-                # If the timeout is omitted from the wait call, then ctrl-c
-                # cannot interrupt. The threading module implements wait
-                # differently if a timeout is specified, waking up periodically.
-                self._lock.wait(1.0)
-            now = self._now
-            if (not self._tupleoutput):
-                now = time.mktime(now)
-            self._now = None
-            self._lock.release()
-            self.send(now)
+        try:
+            while not self._done:
+                self._lock.acquire()
+                while self._now is None:
+                    # If the timeout is omitted from the wait call, then ctrl-c
+                    # cannot interrupt. The threading module implements wait
+                    # differently if a timeout is specified, waking up periodically.
+                    self._lock.wait(1.0)
+                now = self._now
+                if (not self._tupleoutput):
+                    now = time.mktime(now)
+                self._now = None
+                self._lock.release()
+                self.send(now)
+        finally:
+            # Stop the metronome, e.g. if send raised DownstreamDone.
+            self._done = True
 
     # For use by this module
 
@@ -167,6 +171,6 @@ class _Metronome(threading.Thread):
         self.setDaemon(True)
 
     def run(self):
-        while True:
+        while not self._timer._done:
             self._timer.register_tick()
             time.sleep(self._interval)
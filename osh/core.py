@@ -48,6 +48,23 @@ sys.setcheckinterval(100)
 verbosity = None
 default_db_profile = None
 
+# If true, Command.execute profiles each command and prints a table of the
+# results to stderr. (See the profiler module.)
+profiling = False
+
+# Number of objects that generators group into a single send_batch call.
+# A value of 1 turns batching off.
+batch_size = 1000
+
+# If true, runs of consecutive f, select and head commands with string functions
+# are compiled into a single command. (See the fusion module.)
+fusion = True
+
+# If true, a buffer command is inserted following each I/O-bound generator, so that
+# the generator and downstream commands run in separate threads. Also enabled by
+# osh.buffer.auto = True in .oshrc. (See the buffer command.)
+auto_buffer = False
+
 def wrap_if_necessary(object):
     if not(isinstance(object, tuple) or isinstance(object, list)):
         object = (object,)
@@ -120,7 +137,8 @@ class BaseOp(object):
 
     def send(self, object):
         """Called by a command class to send an object of command output to
-        the next command.
+        the next command. Raises error.DownstreamDone if downstream commands
+        will not accept any more input.
         """
         try:
             if self._receiver:
@@ -130,6 +148,18 @@ class BaseOp(object):
         except Exception, e:
             error.exception_handler(e, self._receiver, object)
 
+    def send_batch(self, objects):
+        """Called by a command class to send a list of objects of command output
+        to the next command. Each object in the list must be a tuple or list.
+        """
+        try:
+            if self._receiver:
+                self._receiver.receive_batch(objects)
+        except error.OshKiller:
+            raise
+        except Exception, e:
+            error.exception_handler(e, self._receiver, objects)
+
     def send_complete(self):
         """Called by a command class to indicate that there will
         be no more output from the command.
@@ -147,6 +177,19 @@ class BaseOp(object):
         """
         pass
 
+    def receive_batch(self, objects):
+        """Implemented by a command class to process a list of input objects.
+        The default implementation passes each object to receive.
+        """
+        receive = self.receive
+        for object in objects:
+            try:
+                receive(object)
+            except error.OshKiller:
+                raise
+            except Exception, e:
+                error.exception_handler(e, self, object)
+
     def receive_complete(self):
         """Implemented by a command class to do any cleanup required
         after all input has been received.
@@ -156,6 +199,27 @@ class BaseOp(object):
     def run_local(self):
         return False
 
+    def fusion_stage(self):
+        """Returns a description of this command for use by the fusion module,
+        or None if this command cannot be fused with its neighbors. Called after setup.
+        """
+        return None
+
+    def io_bound(self):
+        """Returns True if this command spends most of its time waiting for input,
+        (e.g. from a file, a database or another process). A buffer may then be
+        placed downstream, (see auto_buffer).
+        """
+        return False
+
+    def partial_aggregate(self):
+        """Returns a command that computes a partial aggregate of this command's input,
+        to be run upstream, (e.g. on each host of a cluster), or None if this command
+        can't be split in this way. Called before setup. If a command is returned, then
+        this command's input will be the partial aggregates, which it combines.
+        """
+        return None
+
     # BaseOp compile-time interface
     
     def connect(self, new_op):
@@ -305,6 +369,8 @@ class Pipeline(BaseOp):
             op = op._next_op
 
     def setup(self):
+        if auto_buffer or config_value('buffer.auto'):
+            self._insert_buffers()
         op = self._first_op
         while op:
             op.setup()
@@ -314,10 +380,18 @@ class Pipeline(BaseOp):
             else:
                 op._receiver = self._pipeline_receiver()
             op = next
+        if profiling:
+            import profiler
+            profiler.instrument(self)
+        elif fusion:
+            import fusion as _fusion
+            _fusion.fuse(self)
 
     def execute(self):
         try:
             self._first_op.execute()
+        except error.DownstreamDone:
+            pass
         except error.OshKiller:
             raise
         except Exception, e:
@@ -326,8 +400,16 @@ class Pipeline(BaseOp):
     def receive(self, object):
         self._first_op.receive(object)
 
+    def receive_batch(self, objects):
+        self._first_op.receive_batch(objects)
+
     def receive_complete(self):
-        self._first_op.receive_complete()
+        try:
+            self._first_op.receive_complete()
+        except error.DownstreamDone:
+            # Commands downstream of the one that raised DownstreamDone have already
+            # been completed. Commands upstream of it don't need to be.
+            pass
 
     def run_local(self):
         run_local = True
@@ -376,6 +458,19 @@ class Pipeline(BaseOp):
 
     # For use by this class
 
+    # Inserts a buffer after each I/O-bound command that isn't already followed by one.
+    def _insert_buffers(self):
+        from command import buffer
+        op = self._first_op
+        while op:
+            next = op._next_op
+            if next and op.io_bound() and not isinstance(next, buffer._Buffer):
+                inserted = buffer.buffer()
+                inserted._next_op = next
+                inserted.set_parent(self)
+                op._next_op = inserted
+            op = next
+
     def _pipeline_receiver(self):
         receiver = self._next_op
         if not receiver:
@@ -446,6 +541,9 @@ class Command(object):
 
     def execute(self):
         original_ctrl_c_handler = signal.signal(signal.SIGINT, _ctrl_c_handler)
+        if profiling:
+            import profiler
+            profiler.start()
         try:
             try:
                 # Prepare for execution
@@ -462,6 +560,9 @@ class Command(object):
         finally:
             if original_ctrl_c_handler is not None:
                 signal.signal(signal.SIGINT, original_ctrl_c_handler)
+            if profiling:
+                profiler.stop()
+                profiler.report(sys.stderr)
 
     def pipeline(self):
         return self._pipeline
@@ -473,9 +574,17 @@ class Command(object):
 #
 
 _namespace = oshrc_symbols.copy()
+
+# Incremented whenever the namespace changes. (Compiled functions are cached per version.)
+_namespace_version = 0
         
 def add_to_namespace(key, value):
+    global _namespace_version
     _namespace[key] = value
+    _namespace_version += 1
 
 def namespace():
     return _namespace
+
+def namespace_version():
+    return _namespace_version
@@ -47,7 +47,8 @@ class PickleableException(object):
         self._command_description = command_description
         self._input = input
         self._exception_args = exception.args
-        self._exception_type_name = str(exception.__class__)
+        exception_class = exception.__class__
+        self._exception_type_name = '%s.%s' % (exception_class.__module__, exception_class.__name__)
         self._exception_message = str(exception)
 
     def __str__(self):
@@ -87,6 +88,16 @@ class OshKiller(Exception):
     def __str__(self):
         return str(self.cause)
 
+# Raised by a command that will not accept any more input, (e.g. head, after N
+# objects have been received). Upstream commands stop generating output, since
+# nobody will read it. Pipeline.execute and Pipeline.receive_complete
+# treat this as normal termination.
+
+class DownstreamDone(OshKiller):
+
+    def __init__(self):
+        OshKiller.__init__(self, 'downstream done')
+
 
 # exception_handler is a function with these arguments:
 # - exception: The exception being handled. In case of a remote exception, this exception
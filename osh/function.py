@@ -40,6 +40,17 @@ import core
 _LAMBDA = 'lambda '
 _LAMBDA_COLON = 'lambda:'
 
+# Compiled function specs, shared by all Functions created with the default namespace.
+# Maps (function spec, namespace version) to (lambda expression, code, namespace).
+# Evaluating the code (which creates the function object) is all that remains to be
+# done per Function, so a fork with many threads compiles each spec once.
+_cache = {}
+_CACHE_SIZE = 1000
+
+# (namespace version, namespace) for the latest namespace version. The namespace is
+# core.__dict__ updated with core.namespace().
+_shared_namespace = (None, None)
+
 # "Private" name (with leading underscore) so that epydoc doesn't document the class
 class _Function(object):
     """Represents a function for use by osh commands with function arguments,
@@ -47,6 +58,8 @@ class _Function(object):
     """
     
     _function_spec = None
+    _lambda_expression = None
+    _namespace = None
     _function = None
     _function_id = None
 
@@ -61,11 +74,22 @@ class _Function(object):
             self._function = function_spec
         else:
             self._function_spec = function_spec
-            lambda_expression = self.parse(function_spec.strip())
-            # Create a namespace including symbols defined by the current osh invocation.
-            namespace = copy.copy(namespace)
-            namespace.update(core.namespace())
-            self._function = eval(lambda_expression, namespace)
+            if namespace is core.__dict__:
+                key = (function_spec, core.namespace_version())
+                compiled = _cache.get(key, None)
+                if compiled is None:
+                    compiled = _compile(function_spec) + (_namespace(),)
+                    if len(_cache) >= _CACHE_SIZE:
+                        _cache.clear()
+                    _cache[key] = compiled
+                self._lambda_expression, code, self._namespace = compiled
+            else:
+                self._lambda_expression, code = _compile(function_spec)
+                # Create a namespace including symbols defined by the current osh invocation.
+                namespace = copy.copy(namespace)
+                namespace.update(core.namespace())
+                self._namespace = namespace
+            self._function = eval(code, self._namespace)
 
     def __repr__(self):
         return 'function(%s)' % self._function_spec
@@ -73,30 +97,55 @@ class _Function(object):
     def __call__(self, *args): # args = None):
         return self._function(*args)
 
+    def lambda_expression(self):
+        """Returns the lambda expression (a string starting with 'lambda') that this
+        function was created from, or None if the function was not specified by a string.
+        """
+        return self._lambda_expression
+
+    def namespace(self):
+        return self._namespace
+
+    def code(self):
+        return self._function.func_code
+
     def parse(self, function_spec):
-        # If the function spec starts with a lambda, then just use it as is.
-        # Otherwise, it could be:
-        # - function with arg list, e.g. "x, y: x + y"
-        # - zero-arg list with colon, e.g. ": processes()"
-        # - zero-arg list without colon, e.g. "processes()"
-        # Try prepending "lambda:" and "lambda" until there's
-        # no syntax error. Crude but effective.
-        if function_spec.startswith(_LAMBDA) or function_spec.startswith(_LAMBDA_COLON):
-            # ok as is
-            pass
-        else:
-            fixed_function_spec = '%s: %s' % (_LAMBDA, function_spec)
-            try:
-                eval(fixed_function_spec)
-                function_spec = fixed_function_spec
-            except:
-                fixed_function_spec = '%s %s' % (_LAMBDA, function_spec)
-                try:
-                    eval(fixed_function_spec)
-                    function_spec = fixed_function_spec
-                except:
-                    raise NotAFunctionException('Illegal function spec: %s' % function_spec)
-        return function_spec
+        return _parse(function_spec)[0]
+
+# Returns (lambda expression, code), where evaluating code yields the function.
+def _compile(function_spec):
+    return _parse(function_spec.strip())
+
+def _parse(function_spec):
+    # If the function spec starts with a lambda, then just use it as is.
+    # Otherwise, it could be:
+    # - function with arg list, e.g. "x, y: x + y"
+    # - zero-arg list with colon, e.g. ": processes()"
+    # - zero-arg list without colon, e.g. "processes()"
+    # Try prepending "lambda:" and "lambda" until there's
+    # no syntax error. Crude but effective.
+    if function_spec.startswith(_LAMBDA) or function_spec.startswith(_LAMBDA_COLON):
+        candidates = [function_spec]
+    else:
+        candidates = ['%s: %s' % (_LAMBDA, function_spec),
+                      '%s %s' % (_LAMBDA, function_spec)]
+    for candidate in candidates:
+        try:
+            return candidate, compile(candidate, '<osh function>', 'eval')
+        except SyntaxError:
+            if len(candidates) == 1:
+                raise
+    raise NotAFunctionException('Illegal function spec: %s' % function_spec)
+
+def _namespace():
+    global _shared_namespace
+    version = core.namespace_version()
+    shared_version, namespace = _shared_namespace
+    if shared_version != version:
+        namespace = copy.copy(core.__dict__)
+        namespace.update(core.namespace())
+        _shared_namespace = (version, namespace)
+    return namespace
 
 class NotAFunctionException(Exception):
 
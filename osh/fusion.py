@@ -0,0 +1,320 @@
+# osh
+# Copyright (C) Jack Orenstein <jao@geophile.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""Compiles runs of consecutive stateless commands into a single command.
+
+A pipeline such as C{f 'x: (x, x*2)' ^ select 'x, y: y > 10' ^ f 'x, y: x + y'}
+calls three functions, unpacks each object three times, and does three sends
+per object. Fusion generates one Python function for the whole run, with the
+lambda expressions of the commands inlined, and replaces the run by a single
+command that applies the generated function to each batch of input.
+
+A command takes part in fusion if its C{fusion_stage} method returns one of:
+    - C{('f', function)}
+    - C{('select', function)}
+    - C{('head', n)}
+
+Functions must have been specified as strings (so that their source is available),
+and their arguments must be plain identifiers. An C{f} at the start of a pipeline
+is a generator and is not fused. A run is broken wherever inlining could change
+the meaning of an expression, e.g. an expression refers to a global with the same
+name as an argument of another function in the run.
+
+Fusion is done by C{Pipeline.setup} if C{osh.core.fusion} is true. With verbosity 1,
+fused commands show up in the printed pipeline. With verbosity 2, each fused run
+and its generated source is printed to stderr.
+"""
+
+import re
+import sys
+
+import core
+import error
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Names generated by fusion start with this prefix.
+_PREFIX = '_osh_'
+
+# Builtins whose behavior depends on the local namespace, which is different
+# in a fused function.
+_SCOPE_SENSITIVE = set(['locals', 'vars', 'dir', 'eval', 'execfile'])
+
+def fuse(pipeline):
+    """Replaces each run of two or more fusible commands in C{pipeline} by a single
+    command. C{pipeline} must have been set up.
+    """
+    previous = None
+    run = None
+    op = pipeline._first_op
+    while op:
+        stage = _Stage.create(op, previous is None)
+        if stage and run and run.accepts(stage):
+            run.append(stage)
+        else:
+            if run:
+                run.fuse(pipeline)
+            if stage:
+                run = _Run(previous, stage)
+            else:
+                run = None
+        previous = op
+        op = op._next_op
+    if run:
+        run.fuse(pipeline)
+
+class _Stage(object):
+
+    op = None
+    kind = None
+    n = None
+    function = None
+    args = None
+    expression = None
+    bound = None
+    free = None
+
+    def __init__(self, op, kind):
+        self.op = op
+        self.kind = kind
+
+    # Returns None if op can't be fused.
+    def create(op, first):
+        description = op.fusion_stage()
+        if description is None:
+            return None
+        kind, argument = description
+        if kind == 'head':
+            stage = _Stage(op, kind)
+            stage.n = argument
+            stage.bound = set()
+            stage.free = set()
+            return stage
+        if kind == 'f' and first:
+            return None
+        lambda_expression = argument.lambda_expression()
+        if lambda_expression is None:
+            return None
+        # lambda_expression is 'lambda ARGS: EXPRESSION'. If ARGS are all identifiers,
+        # then the first colon separates ARGS from EXPRESSION.
+        colon = lambda_expression.find(':')
+        args = [arg.strip() for arg in lambda_expression[len('lambda'):colon].split(',')]
+        for arg in args:
+            if not _IDENTIFIER.match(arg) or arg.startswith(_PREFIX):
+                return None
+        if len(set(args)) < len(args):
+            return None
+        code = argument.code()
+        free = set()
+        bound = set()
+        if not _collect_names(code, free, bound):
+            return None
+        if free & _SCOPE_SENSITIVE:
+            return None
+        for name in free | bound:
+            if name.startswith(_PREFIX):
+                return None
+        stage = _Stage(op, kind)
+        stage.function = argument
+        stage.args = args
+        stage.expression = lambda_expression[colon + 1:]
+        stage.bound = bound
+        stage.free = free
+        return stage
+
+    create = staticmethod(create)
+
+class _Run(object):
+
+    _previous = None
+    _stages = None
+    _bound = None
+    _free = None
+    _namespace = None
+
+    def __init__(self, previous, stage):
+        self._previous = previous
+        self._stages = []
+        self._bound = set()
+        self._free = set()
+        self.append(stage)
+
+    def accepts(self, stage):
+        if stage.function:
+            if self._namespace is not None and self._namespace is not stage.function.namespace():
+                return False
+        return not (stage.free & self._bound or self._free & stage.bound)
+
+    def append(self, stage):
+        self._stages.append(stage)
+        self._bound |= stage.bound
+        self._free |= stage.free
+        if stage.function and self._namespace is None:
+            self._namespace = stage.function.namespace()
+
+    def fuse(self, pipeline):
+        stages = self._stages
+        if len(stages) < 2:
+            return
+        source = _generate(stages)
+        namespace = dict(self._namespace or core.__dict__)
+        exec source in namespace
+        fused = _Fused(stages, namespace['_osh_fused'])
+        first = stages[0].op
+        last = stages[-1].op
+        fused._next_op = last._next_op
+        fused._receiver = last._receiver
+        fused.set_parent(pipeline)
+        if self._previous:
+            assert self._previous._next_op is first
+            self._previous._next_op = fused
+            self._previous._receiver = fused
+        else:
+            assert pipeline._first_op is first
+            pipeline._first_op = fused
+        if core.verbosity >= 2:
+            print >>sys.stderr, 'fused: %s' % fused
+            print >>sys.stderr, source
+
+class _Fused(core.BaseOp):
+
+    _stages = None
+    _function = None
+    _counts = None
+    _heads = None
+    _done = False
+
+
+    # object interface
+
+    def __init__(self, stages, function):
+        core.BaseOp.__init__(self)
+        self._stages = stages
+        self._function = function
+        self._counts = [0] * len(stages)
+        self._heads = [(i, stages[i].n) for i in xrange(len(stages)) if stages[i].kind == 'head']
+
+    def __repr__(self):
+        return 'fused<%s>(%s)' % (id(self), ' ^ '.join([str(stage.op) for stage in self._stages]))
+
+
+    # BaseOp interface
+
+    def doc(self):
+        return __doc__
+
+    def replace_function_by_reference(self, function_store):
+        for stage in self._stages:
+            stage.op.replace_function_by_reference(function_store)
+
+    def restore_function(self, function_store):
+        for stage in self._stages:
+            stage.op.restore_function(function_store)
+
+    def setup(self):
+        pass
+
+    def receive(self, object):
+        if self._done:
+            raise error.DownstreamDone()
+        for output in self._apply([object]):
+            self.send(output)
+        self._check_heads()
+
+    def receive_batch(self, objects):
+        if self._done:
+            raise error.DownstreamDone()
+        output = self._apply(objects)
+        if output:
+            self.send_batch(output)
+        self._check_heads()
+
+    def receive_complete(self):
+        if not self._done:
+            self._done = True
+            self.send_complete()
+
+
+    # For use by this class
+
+    def _apply(self, objects):
+        return self._function(objects, self._counts, self._handle_exception,
+                              (tuple, list), error.OshKiller)
+
+    def _handle_exception(self, exception, stage, input):
+        error.exception_handler(exception, self._stages[stage].op, input)
+
+    # Once a head stage has passed on all the objects it will, nothing more can
+    # get through. Complete downstream commands and tell upstream commands to stop,
+    # as head does.
+    def _check_heads(self):
+        for i, n in self._heads:
+            if self._counts[i] >= n:
+                self._done = True
+                self.send_complete()
+                raise error.DownstreamDone()
+
+# Adds names read by code (globals and attributes) to free, and local variables
+# (arguments, and list comprehension variables) to bound. Returns False if code
+# contains a closure over its local variables. A closure would see the variables
+# of the fused function, which are reassigned for each object.
+def _collect_names(code, free, bound):
+    if code.co_cellvars:
+        return False
+    free.update(code.co_names)
+    bound.update(code.co_varnames)
+    for constant in code.co_consts:
+        if hasattr(constant, 'co_code'):
+            if not _collect_names(constant, free, set()):
+                return False
+    return True
+
+def _generate(stages):
+    buffer = ['def _osh_fused(_osh_objects, _osh_counts, _osh_handler, _osh_sequence, _osh_killer):',
+              '    _osh_output = []',
+              '    _osh_append = _osh_output.append',
+              '    for _osh_x in _osh_objects:',
+              '        try:']
+    indent = ' ' * 12
+    for i in xrange(len(stages)):
+        stage = stages[i]
+        buffer.append('%s_osh_stage = %s' % (indent, i))
+        if stage.kind == 'head':
+            buffer.append('%s_osh_counts[%s] += 1' % (indent, i))
+            buffer.append('%sif _osh_counts[%s] > %r:' % (indent, i, stage.n))
+            buffer.append('%s    continue' % indent)
+        else:
+            buffer.append('%s%s, = _osh_x' % (indent, ', '.join(stage.args)))
+            if stage.kind == 'f':
+                buffer.append('%s_osh_x = (' % indent)
+                buffer.append(stage.expression)
+                buffer.append('%s)' % indent)
+                buffer.append('%sif not isinstance(_osh_x, _osh_sequence):' % indent)
+                buffer.append('%s    _osh_x = (_osh_x,)' % indent)
+            else:
+                buffer.append('%sif not (' % indent)
+                buffer.append(stage.expression)
+                buffer.append('%s):' % indent)
+                buffer.append('%s    continue' % indent)
+    buffer.extend(['            _osh_append(_osh_x)',
+                   '        except _osh_killer:',
+                   '            raise',
+                   '        except Exception, _osh_exception:',
+                   '            _osh_handler(_osh_exception, _osh_stage, _osh_x)',
+                   '    return _osh_output',
+                   ''])
+    return '\n'.join(buffer)
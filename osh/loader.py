@@ -15,10 +15,35 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
+import sys
+
 import config
 
+# Maps the name of each command and sql adapter distributed with osh to its
+# module, so that it can be loaded without searching for it. Computed on first use.
+_registry = None
+
+def registry():
+    """Returns a dict mapping the names of the commands and sql adapters distributed
+    with osh to their module names.
+    """
+    global _registry
+    if _registry is None:
+        import command
+        import command.sqladapter
+        modules = {}
+        for name in command.__all__:
+            modules[name] = 'command.%s' % name
+        for name in command.sqladapter.__all__:
+            modules[name] = 'command.sqladapter.%s' % name
+        _registry = modules
+    return _registry
+
 def load_and_create(name):
-    for package in (['command', 'command.sqladapter'] + list(config.oshpath)):
+    module_name = registry().get(name, None)
+    if module_name:
+        return _import_and_create(module_name, name)
+    for package in config.oshpath:
         try:
             module_name = '%s.%s' % (package, name)
             return _import_and_create(module_name, name)
@@ -33,7 +58,12 @@ def load_and_create(name):
         raise ImportError("Could not find %s as a python or osh builtin, or on osh.path %s" %
                           (name, config.oshpath))
 
+def load_module(module_name):
+    """Imports and returns the module named C{module_name}, (e.g. C{command.gen}).
+    """
+    # A non-empty fromlist makes __import__ return the named module rather than
+    # the top-level package.
+    return __import__(module_name, globals(), {}, ['__name__'])
+
 def _import_and_create(module_name, name):
-    exec('import %s' % module_name)
-    constructor_call = '%s._%s()' % (module_name, name)
-    return eval(constructor_call)
+    return getattr(load_module(module_name), '_%s' % name)()
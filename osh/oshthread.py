@@ -25,6 +25,7 @@ class _OshThread(threading.Thread):
     _pipeline = None
     _thread_state = None
     _terminating_exception = None
+    _completion_callback = None
     
     def __init__(self, owner, thread_state, pipeline):
         threading.Thread.__init__(self)
@@ -39,11 +40,21 @@ class _OshThread(threading.Thread):
     state = property(lambda self: self._thread_state)
     pipeline = property(lambda self: self._pipeline)
     terminating_exception = property(lambda self: self._terminating_exception)
+
+    def set_completion_callback(self, callback):
+        """C{callback} is called with this thread as its argument, in this thread,
+        when execution of the pipeline ends.
+        """
+        self._completion_callback = callback
             
     def run(self):
         try:
-            # Don't call self._pipeline.setup(): Done by _Fork.execute
-            self._pipeline.execute()
-        except Exception, e:
-            self._terminating_exception = e
+            try:
+                # Don't call self._pipeline.setup(): Done by _Fork.execute
+                self._pipeline.execute()
+            except Exception, e:
+                self._terminating_exception = e
+        finally:
+            if self._completion_callback:
+                self._completion_callback(self)
 
@@ -15,7 +15,9 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
+import heapq
 import threading
+import time
 
 # import trace
 # trace.on('/tmp/trace.txt')
@@ -56,6 +58,8 @@ INFINITY = SpecialValue('INFINITY', 1)
 DEBUG = True
 WRITE_BUFFER_CAPACITY = 1000
 LOCK_WAIT_TIME = 1.0
+# Entries buffered by all inputs of a HeapPriorityQueue, beyond one batch per input.
+BUFFER_BUDGET = 100000
 
 def _describe_list(x):
     n = len(x)
@@ -75,6 +79,7 @@ class PriorityQueue(object):
     _inputs = None
     _first_input = None
     _key = None
+    _closed = False
     
     def __init__(self, key, inputs):
         self._key = key
@@ -131,6 +136,17 @@ class PriorityQueue(object):
     def done(self, index):
         self.add(index, INFINITY)
 
+    def close(self):
+        """Called by the reader to indicate that it will read no more objects.
+        Subsequent (and blocked) calls to add and done raise PriorityQueueClosedException.
+        """
+        self._closed = True
+        for i in xrange(self._inputs):
+            buffer = self._nodes[self._first_input + i]._buffer
+            buffer._lock.acquire()
+            buffer._lock.notifyAll()
+            buffer._lock.release()
+
     def dump(self, label = None):
         if label:
             label = [label]
@@ -328,6 +344,8 @@ class _Buffer(object):
 
     def add(self, input):
         # trace('%s: add %s' % (self, input))
+        if self._priority_queue._closed:
+            raise PriorityQueueClosedException()
         if (self._last_input is not None) and (self._input_node._compare(input, self._last_input) < 0):
             raise PriorityQueueInputOrderingException(self._input_node, input, self._last_input)
         if self._write_blocked():
@@ -335,12 +353,14 @@ class _Buffer(object):
             # If reader is blocking, then release it now. No point waiting for the write
             # to be able to proceed.
             self._lock.notify()
-            while self._write_blocked():
+            while self._write_blocked() and not self._priority_queue._closed:
                 # trace('%s: write blocked' % self)
                 self._lock.wait(LOCK_WAIT_TIME)
             # trace('%s: write unblocked' % self)
             self._lock.notify()
             self._lock.release()
+            if self._priority_queue._closed:
+                raise PriorityQueueClosedException()
         self._write.append(input)
         self._last_input = input
         if input is INFINITY:
@@ -361,6 +381,248 @@ class _Buffer(object):
             self._read_position += 1
         return output
 
+# Merges sorted inputs using a heap of entries, one per input, ordered by key and
+# then input. The key of an object is computed once, when it is added. If the key is
+# None, then objects are their own keys, and entries are (object, source). Otherwise,
+# entries are (key, source, object).
+#
+# Each input buffers entries in a write list, which the reader exchanges for its
+# read list once the read list has been consumed. Inputs share a budget of buffered
+# entries, so that fast inputs can buffer more than slow ones: An input can always
+# add to an empty write list, (so that the reader never waits for a blocked writer),
+# but otherwise blocks while the budget is used up. Waiting is done on conditions
+# sharing one lock, and every change that can unblock a waiter notifies it.
+
+class HeapPriorityQueue(object):
+
+    _key = None
+    _inputs = None
+    _closed = False
+    _lock = None
+    _budget = None
+    _buffered = 0
+    _blocked_writers = None
+
+    def __init__(self, key, inputs, budget = BUFFER_BUDGET):
+        self._key = key
+        self._lock = threading.Lock()
+        self._budget = budget
+        self._blocked_writers = []
+        self._inputs = [_HeapInput(self, source) for source in xrange(inputs)]
+
+    def __repr__(self):
+        return 'HeapPriorityQueue<%s>' % id(self)
+
+    def __iter__(self):
+        inputs = self._inputs
+        heap = []
+        for input in inputs:
+            entry = input.next()
+            if entry is not None:
+                heap.append(entry)
+        heapq.heapify(heap)
+        if self._key is None:
+            object_position = 0
+        else:
+            object_position = 2
+        heappop = heapq.heappop
+        heapreplace = heapq.heapreplace
+        while heap:
+            entry = heap[0]
+            yield entry[object_position]
+            next = inputs[entry[1]].next()
+            if next is None:
+                heappop(heap)
+            else:
+                heapreplace(heap, next)
+
+    def add(self, index, object):
+        self._inputs[index].add([object])
+
+    def add_batch(self, index, objects):
+        self._inputs[index].add(objects)
+
+    def done(self, index):
+        self._inputs[index].done()
+
+    def close(self):
+        """Called by the reader to indicate that it will read no more objects.
+        Subsequent (and blocked) calls to add and done raise PriorityQueueClosedException.
+        """
+        self._lock.acquire()
+        try:
+            self._closed = True
+            for input in self._inputs:
+                input.condition.notifyAll()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Returns a C{MergeStats} for each input, indexed by input.
+        """
+        return [input.stats for input in self._inputs]
+
+    # For use by _HeapInput. Caller must hold the lock.
+
+    def _release(self, entries):
+        self._buffered -= entries
+        if self._blocked_writers and self._buffered < self._budget:
+            for input in self._blocked_writers:
+                input.condition.notify()
+            self._blocked_writers = []
+
+class MergeStats(object):
+    """Describes an input of a C{HeapPriorityQueue}: C{objects} is the number of objects
+    added, C{reader_blocked} is the time in seconds that the reader waited for objects
+    from the input, and C{writer_blocked} is the time in seconds that the input waited
+    for buffer space.
+    """
+
+    objects = 0
+    reader_blocked = 0.0
+    writer_blocked = 0.0
+
+    def __repr__(self):
+        return ('objects: %s, reader blocked: %.3f sec, writer blocked: %.3f sec' %
+                (self.objects, self.reader_blocked, self.writer_blocked))
+
+class _HeapInput(object):
+
+    _priority_queue = None
+    _source = None
+    _write = None # list of entries
+    _read = None # list of entries
+    _read_position = None # position of next entry in _read
+    _last_key = None
+    _last_object = None
+    _empty = True
+    _done = False
+    _reader_waiting = False
+    condition = None
+    stats = None
+
+    def __init__(self, priority_queue, source):
+        self._priority_queue = priority_queue
+        self._source = source
+        self._write = []
+        self._read = []
+        self._read_position = 0
+        self.condition = threading.Condition(priority_queue._lock)
+        self.stats = MergeStats()
+
+    # Called by writer
+
+    def add(self, objects):
+        priority_queue = self._priority_queue
+        if priority_queue._closed:
+            raise PriorityQueueClosedException()
+        if self._done:
+            raise PriorityQueueInputClosedException(self._source)
+        if not objects:
+            return
+        source = self._source
+        key = priority_queue._key
+        if key is None:
+            entries = [(object, source) for object in objects]
+            keys = objects
+        else:
+            entries = [(key(object), source, object) for object in objects]
+            keys = [entry[0] for entry in entries]
+        # Check ordering. Entries preceding an out-of-order object are added.
+        out_of_order = None
+        last_key = self._last_key
+        empty = self._empty
+        for i in xrange(len(keys)):
+            if not empty and keys[i] < last_key:
+                out_of_order = i
+                entries = entries[:i]
+                break
+            last_key = keys[i]
+            empty = False
+        if entries:
+            self._last_key = last_key
+            self._last_object = objects[len(entries) - 1]
+            self._empty = False
+            self._append(entries)
+        if out_of_order is not None:
+            raise PriorityQueueInputOrderingException(source,
+                                                      objects[out_of_order],
+                                                      self._last_object)
+
+    def _append(self, entries):
+        priority_queue = self._priority_queue
+        condition = self.condition
+        condition.acquire()
+        try:
+            if self._write and priority_queue._buffered >= priority_queue._budget:
+                start = time.time()
+                while (self._write and
+                       priority_queue._buffered >= priority_queue._budget and
+                       not priority_queue._closed):
+                    priority_queue._blocked_writers.append(self)
+                    condition.wait()
+                self.stats.writer_blocked += time.time() - start
+            if priority_queue._closed:
+                raise PriorityQueueClosedException()
+            self._write.extend(entries)
+            priority_queue._buffered += len(entries)
+            self.stats.objects += len(entries)
+            if self._reader_waiting:
+                condition.notify()
+        finally:
+            condition.release()
+
+    def done(self):
+        condition = self.condition
+        condition.acquire()
+        try:
+            if self._priority_queue._closed:
+                raise PriorityQueueClosedException()
+            if self._done:
+                raise PriorityQueueInputClosedException(self._source)
+            self._done = True
+            condition.notify()
+        finally:
+            condition.release()
+
+    # Called by reader
+
+    # Returns the next entry, or None if there are no more.
+    def next(self):
+        if self._read_position == len(self._read) and not self._refill():
+            return None
+        entry = self._read[self._read_position]
+        self._read[self._read_position] = None
+        self._read_position += 1
+        return entry
+
+    # Exchanges the consumed read list for the write list, waiting for entries to be
+    # written. Returns False if the input is done.
+    def _refill(self):
+        priority_queue = self._priority_queue
+        condition = self.condition
+        condition.acquire()
+        try:
+            priority_queue._release(len(self._read))
+            self._read = []
+            self._read_position = 0
+            if not self._write and not self._done:
+                start = time.time()
+                self._reader_waiting = True
+                while not self._write and not self._done:
+                    condition.wait()
+                self._reader_waiting = False
+                self.stats.reader_blocked += time.time() - start
+            if not self._write:
+                return False
+            self._read = self._write
+            self._write = []
+            # Release the writer if it is blocked.
+            condition.notify()
+            return True
+        finally:
+            condition.release()
+
 class PriorityQueueInputClosedException(Exception):
 
     def __init__(self, source):
@@ -368,6 +630,11 @@ class PriorityQueueInputClosedException(Exception):
             self,
             'Attempt to call add or done on input stream %s after calling done' % source)
 
+class PriorityQueueClosedException(Exception):
+
+    def __init__(self):
+        Exception.__init__(self, 'Attempt to call add or done after reader closed the queue')
+
 class PriorityQueueInputOrderingException(Exception):
 
     def __init__(self, source, input, last_input):
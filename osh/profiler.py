@@ -0,0 +1,300 @@
+# osh
+# Copyright (C) Jack Orenstein <jao@geophile.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""Per-command profiling, enabled by C{osh -p} or C{osh.api.profile()}.
+
+For each command of each pipeline, including the pipeline copy run by each
+thread of a fork, the profiler records:
+    - Objects received and sent.
+    - Inclusive time: Time spent in the command's execute and receive methods,
+      including time spent by downstream commands processing the command's output.
+    - Exclusive time: Inclusive time minus the time spent downstream.
+Both wall-clock and CPU time are recorded. CPU time is per-thread where the
+platform supports it. Calls to functions passed to commands (e.g. by C{f} and
+C{select}) are also timed, and reported by function spec.
+
+Commands are instrumented by C{Pipeline.setup}, which replaces methods of each
+command instance by timing wrappers. Nothing is instrumented unless
+C{osh.core.profiling} is true. Fusion is not done while profiling, so that
+time can be attributed to each command. Commands of a remote fork run on
+the remote hosts and are not profiled individually.
+"""
+
+import sys
+import threading
+import time
+
+import core
+import function
+
+# Methods that are timed. receive and receive_batch also count input objects.
+_TIMED = ('execute', 'receive', 'receive_batch', 'receive_complete')
+
+_lock = threading.Lock()
+_command_stats = []
+_function_stats = {}
+_stacks = threading.local()
+_MAX_DESCRIPTION = 60
+_original_function_call = None
+
+def start():
+    """Discards stats from a previous run and starts timing function calls.
+    """
+    global _command_stats, _function_stats, _original_function_call
+    _command_stats = []
+    _function_stats = {}
+    if _original_function_call is None:
+        _original_function_call = function._Function.__call__
+        function._Function.__call__ = _profiled_function_call
+
+def stop():
+    """Stops timing function calls.
+    """
+    global _original_function_call
+    if _original_function_call is not None:
+        function._Function.__call__ = _original_function_call
+        _original_function_call = None
+
+def instrument(pipeline):
+    """Instruments the commands of C{pipeline}, which has been set up.
+    """
+    for op in pipeline.ops():
+        if not isinstance(op, core.Pipeline) and op.__dict__.get('_profile_stats') is None:
+            _instrument(op)
+
+def report(file = None):
+    """Prints the profile to C{file} (default: stderr).
+    """
+    if file is None:
+        file = sys.stderr
+    rows = [('command', 'thread', 'in', 'out',
+             'wall incl', 'wall excl', 'cpu incl', 'cpu excl')]
+    for stats in _command_stats:
+        rows.append((stats.description, stats.thread, str(stats.objects_in), str(stats.objects_out),
+                     _seconds(stats.wall_inclusive), _seconds(stats.wall_exclusive),
+                     _seconds(stats.cpu_inclusive), _seconds(stats.cpu_exclusive)))
+    _print_table(file, rows)
+    if _function_stats:
+        rows = [('function', 'calls', 'wall', 'cpu')]
+        function_stats = _function_stats.items()
+        function_stats.sort(key = lambda (spec, stats): stats.wall, reverse = True)
+        for spec, stats in function_stats:
+            rows.append((spec, str(stats.calls), _seconds(stats.wall), _seconds(stats.cpu)))
+        print >>file
+        _print_table(file, rows)
+
+class _CommandStats(object):
+
+    description = None
+    thread = None
+    objects_in = 0
+    objects_out = 0
+    wall_inclusive = 0.0
+    wall_exclusive = 0.0
+    cpu_inclusive = 0.0
+    cpu_exclusive = 0.0
+    lock = None
+
+    def __init__(self, op):
+        self.description = _describe(op)
+        thread_state = _thread_state(op)
+        if thread_state is None:
+            self.thread = ''
+        else:
+            self.thread = str(thread_state)
+        self.lock = threading.Lock()
+
+class _FunctionStats(object):
+
+    calls = 0
+    wall = 0.0
+    cpu = 0.0
+
+# A frame records a call to an instrumented method that hasn't returned yet, and the
+# time spent so far in calls to other instrumented methods made by it.
+class _Frame(object):
+
+    stats = None
+    child_wall = 0.0
+    child_cpu = 0.0
+
+    def __init__(self, stats):
+        self.stats = stats
+
+def _instrument(op):
+    stats = _CommandStats(op)
+    op._profile_stats = stats
+    _lock.acquire()
+    try:
+        _command_stats.append(stats)
+    finally:
+        _lock.release()
+    for name in _TIMED:
+        setattr(op, name, _timed(stats, name, getattr(op, name)))
+    send = op.send
+    send_batch = op.send_batch
+    def counted_send(object):
+        _count_output(stats, 1)
+        send(object)
+    def counted_send_batch(objects):
+        _count_output(stats, len(objects))
+        send_batch(objects)
+    op.send = counted_send
+    op.send_batch = counted_send_batch
+
+def _timed(stats, name, method):
+    if name == 'receive':
+        count = lambda args: 1
+    elif name == 'receive_batch':
+        count = lambda args: len(args[0])
+    else:
+        count = lambda args: 0
+    def timed_method(*args):
+        stack = _stack()
+        # Calls made while the command is already on the stack (e.g. receive_batch
+        # calling receive) contribute exclusive time only.
+        nested = False
+        for frame in stack:
+            if frame.stats is stats:
+                nested = True
+                break
+        frame = _Frame(stats)
+        stack.append(frame)
+        wall_start = time.time()
+        cpu_start = _cpu_time()
+        try:
+            return method(*args)
+        finally:
+            wall = time.time() - wall_start
+            cpu = _cpu_time() - cpu_start
+            stack.pop()
+            if stack:
+                caller = stack[-1]
+                caller.child_wall += wall
+                caller.child_cpu += cpu
+            stats.lock.acquire()
+            try:
+                stats.wall_exclusive += wall - frame.child_wall
+                stats.cpu_exclusive += cpu - frame.child_cpu
+                if not nested:
+                    stats.objects_in += count(args)
+                    stats.wall_inclusive += wall
+                    stats.cpu_inclusive += cpu
+            finally:
+                stats.lock.release()
+    return timed_method
+
+def _count_output(stats, n):
+    stats.lock.acquire()
+    try:
+        stats.objects_out += n
+    finally:
+        stats.lock.release()
+
+def _profiled_function_call(self, *args):
+    wall_start = time.time()
+    cpu_start = _cpu_time()
+    try:
+        return self._function(*args)
+    finally:
+        wall = time.time() - wall_start
+        cpu = _cpu_time() - cpu_start
+        key = _function_key(self)
+        _lock.acquire()
+        try:
+            stats = _function_stats.get(key, None)
+            if stats is None:
+                stats = _FunctionStats()
+                _function_stats[key] = stats
+            stats.calls += 1
+            stats.wall += wall
+            stats.cpu += cpu
+        finally:
+            _lock.release()
+
+def _function_key(f):
+    if f._function_spec is not None:
+        return f._function_spec
+    code = getattr(f._function, 'func_code', None)
+    if code is None:
+        return str(f._function)
+    return '%s (%s:%s)' % (f._function.__name__, code.co_filename, code.co_firstlineno)
+
+def _stack():
+    try:
+        return _stacks.frames
+    except AttributeError:
+        _stacks.frames = []
+        return _stacks.frames
+
+def _describe(op):
+    if isinstance(op, core.Op):
+        description = '%s%s' % (op._command_name(), op.args())
+    else:
+        description = str(op)
+    if len(description) > _MAX_DESCRIPTION:
+        description = description[:_MAX_DESCRIPTION - 3] + '...'
+    return description
+
+def _thread_state(op):
+    parent = op.parent()
+    while parent is not None:
+        thread_state = getattr(parent, '_thread_state', None)
+        if thread_state is not None:
+            return thread_state
+        parent = parent.parent()
+    return None
+
+def _seconds(t):
+    return '%.3f' % t
+
+def _print_table(file, rows):
+    widths = [max([len(row[i]) for row in rows]) for i in xrange(len(rows[0]))]
+    for row in rows:
+        # Left-justify the first two columns (descriptions), right-justify the numbers.
+        buffer = []
+        for i in xrange(len(row)):
+            if i < 2:
+                buffer.append(row[i].ljust(widths[i]))
+            else:
+                buffer.append(row[i].rjust(widths[i]))
+        print >>file, '  '.join(buffer).rstrip()
+
+# Per-thread CPU time, using clock_gettime(CLOCK_THREAD_CPUTIME_ID) on Linux.
+# time.clock() (CPU time for the whole process) is used otherwise.
+def _thread_cpu_time_function():
+    if not sys.platform.startswith('linux'):
+        return time.clock
+    try:
+        import ctypes
+        import ctypes.util
+        class _Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        library = ctypes.util.find_library('rt') or ctypes.util.find_library('c')
+        clock_gettime = ctypes.CDLL(library).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        CLOCK_THREAD_CPUTIME_ID = 3
+        def thread_cpu_time():
+            t = _Timespec()
+            clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(t))
+            return t.tv_sec + t.tv_nsec * 1e-9
+        thread_cpu_time()
+        return thread_cpu_time
+    except Exception:
+        return time.clock
+
+_cpu_time = _thread_cpu_time_function()
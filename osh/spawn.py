@@ -16,19 +16,42 @@
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 import cPickle
+import errno
+import fcntl
+import hashlib
 import os
+import select
 import subprocess
 import sys
+import tempfile
 import threading
 import traceback
 
-# Spawn coordinates with consumer threads (processing process stdout
-# and stderr) through the use of a condition var. It would be simpler to
-# just join the consumer threads, but this seems not to work (python2.2
-# on rh9), sometimes getting stuck in join, requiring the process be killed.
+import wire
+
+# The output streams of all spawned processes, (and of connections to remoteosh
+# agents), are read by one reactor thread, which polls them. Data read is queued
+# for its process, and the thread running the process, (the caller of run), passes
+# the data to the process's output consumers, and finishes the process when its
+# streams reach EOF. So the number of threads doesn't grow with the number of
+# processes, and consumers run in the thread that ran the process, as before.
 
 all_processes = []
 
+# Bytes read at a time from a process's stream.
+_READ_BYTES = 64 * 1024
+
+# Output of a process queued by the reactor is limited to about this many bytes.
+# Beyond that, the reactor stops reading the process's streams until the process's
+# thread catches up.
+MAX_QUEUED_BYTES = 1024 * 1024
+
+# Python 2 runs signal handlers, (e.g. for ctrl-C, see osh.core), only in the main
+# thread, and not while it waits on a lock. So the main thread waits for output with
+# a timeout, (seconds). Other threads wait without one.
+_MAIN_THREAD_WAIT = 1.0
+_main_thread = threading.currentThread()
+
 def kill_all_processes():
     count = 0
     for process in all_processes:
@@ -45,8 +68,8 @@ class Spawn(object):
     _input_provider = None
     _out_consumer = None
     _err_consumer = None
-    _process_completion = None
     _terminating_exception = None
+    _cancelled = False
 
     def __init__(self,
                  command,
@@ -63,7 +86,6 @@ class Spawn(object):
             self._err_consumer = err_consumer
         else:
             self._err_consumer = _ignore_output()
-        self._process_completion = threading.Condition(threading.RLock())
 
     def __repr__(self, label):
         print 'spawn(%s: %s)' % (label, self._command)
@@ -85,35 +107,36 @@ class Spawn(object):
                                                  stderr = subprocess.PIPE,
                                                  close_fds = True)
                 all_processes.append(self)
-                if self._input_provider:
-                    # send input to process
-                    self._input_provider.initialize(self._process.stdin, self)
-                    self._input_provider.run()
-                    # Flush but don't close the stream -- may need to send
-                    # kill signal later.
-                    self._process.stdin.flush()
-                # set up out and err consumers
                 self._out_consumer.initialize(self._process.stdout, self)
-                self._out_consumer.start()
                 self._err_consumer.initialize(self._process.stderr, self)
-                self._err_consumer.start()
+                # Output is read from the start, before sending input, which may be
+                # a stream, so that output doesn't back up.
+                output = OutputDispatcher([self._out_consumer, self._err_consumer])
+                output.start()
+                input_sender = None
+                try:
+                    if self._input_provider:
+                        self._input_provider.initialize(self._process.stdin, self)
+                        input_sender = send_input(self._input_provider)
+                finally:
+                    output.dispatch()
+                if input_sender:
+                    input_sender.join()
             except Exception, e:
                 import traceback
                 traceback.print_exc()
                 self._terminating_exception = e
         finally:
-            # wait for the process and consumer threads to end
+            # The process's streams are closed, so it has ended, or is about to.
             try:
                 if self._process:
                     exitCode = self._process.wait()
-                    self._wait_for_consumers_to_finish()
                     self.close_input_stream()
-                    self._out_consumer.join()
-                    self._err_consumer.join()
             except OSError, e:
                 # Process can disappear before we check exit code
                 pass
-            all_processes.remove(self)
+            if self in all_processes:
+                all_processes.remove(self)
 
     def close_input_stream(self):
         if self._process.stdin:
@@ -123,7 +146,11 @@ class Spawn(object):
 
     def kill(self):
         if self._input_provider:
-            self._input_provider.send_kill(9)
+            try:
+                self._input_provider.send_kill(9)
+            except IOError:
+                # Process has already closed its input
+                pass
         try:
             os.kill(self._process.pid, 9)
         except:
@@ -132,16 +159,6 @@ class Spawn(object):
     def terminating_exception(self):
         return self._terminating_exception
 
-    # for use by this class
-
-    def _wait_for_consumers_to_finish(self):
-        try:
-            self._process_completion.acquire()
-            while not (self._out_consumer.done() and self._err_consumer.done()):
-                self._process_completion.wait(1.0)
-        finally:
-            self._process_completion.release()
-
 class SpawnSSH(Spawn):
 
     def __init__(self,
@@ -151,19 +168,433 @@ class SpawnSSH(Spawn):
                  command,
                  input_provider,
                  out_consumer,
-                 err_consumer):
+                 err_consumer,
+                 idle_timeout = None):
         Spawn.__init__(self,
-                       _ssh_command(user, identity, host, command),
+                       _ssh_command(user, identity, host, command, idle_timeout),
                        input_provider,
                        out_consumer,
                        err_consumer)
 
+class Coprocess(object):
+    """A process that keeps running while input is written to it, (e.g. a shell
+    reading commands). Output is passed to C{out_consumer} and C{err_consumer} by
+    an C{OutputDispatcher}, which may be shared by several coprocesses, e.g.
+    C{OutputDispatcher(coprocess.consumers())}.
+    """
+
+    _command = None
+    _process = None
+    _out_consumer = None
+    _err_consumer = None
+    _terminating_exception = None
+    _cancelled = False
+
+    def __init__(self, command, out_consumer, err_consumer):
+        self._command = command
+        self._out_consumer = out_consumer
+        self._err_consumer = err_consumer
+        self._process = subprocess.Popen(command,
+                                         shell = True,
+                                         stdin = subprocess.PIPE,
+                                         stdout = subprocess.PIPE,
+                                         stderr = subprocess.PIPE,
+                                         close_fds = True)
+        all_processes.append(self)
+        out_consumer.initialize(self._process.stdout, self)
+        err_consumer.initialize(self._process.stderr, self)
+
+    def consumers(self):
+        return [self._out_consumer, self._err_consumer]
+
+    def write(self, data):
+        self._process.stdin.write(data)
+        self._process.stdin.flush()
+
+    def close_input_stream(self):
+        try:
+            self._process.stdin.close()
+        except IOError:
+            # The process has already exited
+            pass
+
+    def wait(self):
+        """Waits for the process to end, after closing its input.
+        """
+        try:
+            self.close_input_stream()
+            self._process.wait()
+        finally:
+            if self in all_processes:
+                all_processes.remove(self)
+
+    def kill(self):
+        try:
+            os.kill(self._process.pid, 9)
+        except OSError:
+            pass
+
+    def terminating_exception(self):
+        return self._terminating_exception
+
+# SSH connection multiplexing
+
+# Seconds that an idle ssh connection is kept open, if not specified by
+# osh.remote.CLUSTER.idle_timeout. 0 disables connection reuse.
+DEFAULT_IDLE_TIMEOUT = 60
+
+class SSHControlPool(object):
+    """Keeps ssh connections open for reuse, using OpenSSH connection multiplexing.
+    The first ssh or scp command to a given (user, identity, host) opens a master
+    connection with a control socket. Later commands, including those of other osh
+    invocations, use the socket instead of connecting again. The master connection
+    closes after being idle for the idle timeout.
+    """
+
+    _directory = None
+    _used = None
+    _lock = None
+
+    def __init__(self, directory = None):
+        """Control sockets are created in C{directory}. The default is a directory
+        in the system temp directory, private to the user.
+        """
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), 'osh-ssh-%s' % os.getuid())
+        self._directory = directory
+        self._used = {}
+        self._lock = threading.Lock()
+
+    def options(self, user, identity, host, idle_timeout = None):
+        """Returns options for ssh or scp to reuse a connection to C{host}.
+        """
+        if idle_timeout is None:
+            idle_timeout = DEFAULT_IDLE_TIMEOUT
+        if not idle_timeout:
+            return ''
+        control_path = self.control_path(user, identity, host)
+        self._lock.acquire()
+        try:
+            if not self._used:
+                self._create_directory()
+            self._used[(user, identity, host)] = control_path
+        finally:
+            self._lock.release()
+        return ('-o ControlMaster=auto -o ControlPath=%s -o ControlPersist=%s' %
+                (control_path, int(idle_timeout)))
+
+    def control_path(self, user, identity, host):
+        # Unix socket paths are limited to about 100 characters, so the path
+        # uses a digest of the connection's identifying information.
+        digest = hashlib.md5('%s\0%s\0%s' % (user, identity, host)).hexdigest()[:16]
+        return os.path.join(self._directory, digest)
+
+    def close_all(self):
+        """Closes master connections used by this process.
+        """
+        self._lock.acquire()
+        try:
+            used = self._used.items()
+            self._used.clear()
+        finally:
+            self._lock.release()
+        for (user, identity, host), control_path in used:
+            if os.path.exists(control_path):
+                Spawn('ssh -o ControlPath=%s -O exit -l %s %s' % (control_path, user, host),
+                      None,
+                      _ignore_output(),
+                      _ignore_output()).run()
+
+    def _create_directory(self):
+        try:
+            os.makedirs(self._directory, 0700)
+        except OSError:
+            pass
+
+ssh_control_pool = SSHControlPool()
+
+def ssh_options(user, identity, host, idle_timeout = None):
+    """Returns options for ssh or scp to connect to C{host} as C{user}, using
+    C{identity} (if not None), and reusing a connection if possible.
+    """
+    options = []
+    if identity:
+        options.append('-i %s' % identity)
+    reuse = ssh_control_pool.options(user, identity, host, idle_timeout)
+    if reuse:
+        options.append(reuse)
+    return ' '.join(options)
+
+# Reading output
+
+class OutputDispatcher(object):
+    """Passes the output of a process to the process's consumers, (C{ObjectOutputConsumer}s
+    and C{LineOutputConsumer}s, already initialized with the process's streams). The
+    streams are read by the reactor, and the output is passed to the consumers by the
+    thread calling C{dispatch}.
+    """
+
+    _consumers = None
+    _condition = None
+    _queue = None
+    _queued_bytes = None
+    _paused = None
+    _open_streams = None
+
+    def __init__(self, consumers):
+        self._consumers = consumers
+        self._condition = threading.Condition()
+        self._queue = []
+        self._queued_bytes = 0
+        self._paused = []
+        self._open_streams = len(consumers)
+
+    def start(self):
+        """Starts reading the streams.
+        """
+        reactor = _reactor()
+        for consumer in self._consumers:
+            reactor.register(consumer.stream().fileno(), self, consumer)
+
+    def dispatch(self, until = None):
+        """Passes output to the consumers until each stream reaches EOF, or until
+        C{until}, (a function, if specified), returns true. It is checked after each
+        piece of output is passed to a consumer.
+        """
+        if until and until():
+            return
+        while self._open_streams > 0:
+            self._condition.acquire()
+            try:
+                while not self._queue:
+                    if threading.currentThread() is _main_thread:
+                        self._condition.wait(_MAIN_THREAD_WAIT)
+                    else:
+                        self._condition.wait()
+                queue = self._queue
+                self._queue = []
+                self._queued_bytes = 0
+                paused = self._paused
+                self._paused = []
+            finally:
+                self._condition.release()
+            for fd in paused:
+                _reactor().resume(fd)
+            for i in xrange(len(queue)):
+                consumer, data = queue[i]
+                if data:
+                    discarding = consumer.discarding()
+                    consumer.feed(data)
+                    if consumer.discarding() and not discarding:
+                        # Stop reading, e.g. after DownstreamDone. The stream may
+                        # never reach EOF if the process's children are still
+                        # writing to it, so it is finished now.
+                        _reactor().cancel(consumer.stream().fileno())
+                else:
+                    consumer.finish()
+                    self._open_streams -= 1
+                if until and until():
+                    self._requeue(queue[i + 1:])
+                    return
+
+    def open_streams(self):
+        """Returns the number of streams that haven't reached EOF.
+        """
+        return self._open_streams
+
+    # Output not yet passed to consumers goes back to the front of the queue.
+    def _requeue(self, queue):
+        if queue:
+            self._condition.acquire()
+            try:
+                self._queue[:0] = queue
+            finally:
+                self._condition.release()
+
+    # For use by the reactor
+
+    # data is '' at EOF. Returns true if the reactor should stop reading the stream
+    # until resumed.
+    def deliver(self, fd, consumer, data):
+        self._condition.acquire()
+        try:
+            self._queue.append((consumer, data))
+            self._queued_bytes += len(data)
+            self._condition.notify()
+            if data and self._queued_bytes > MAX_QUEUED_BYTES:
+                self._paused.append(fd)
+                return True
+            return False
+        finally:
+            self._condition.release()
+
+class _Reactor(threading.Thread):
+
+    _pid = None
+    _poll = None
+    # fd -> (OutputDispatcher, consumer), for streams being read
+    _streams = None
+    # Streams not being read, until resumed
+    _paused = None
+    # Functions to be run by the reactor thread
+    _requests = None
+    _lock = None
+    _wakeup_read = None
+    _wakeup_write = None
+
+    def __init__(self):
+        threading.Thread.__init__(self, name = 'osh-reactor')
+        self.setDaemon(True)
+        self._pid = os.getpid()
+        self._poll = select.poll()
+        self._streams = {}
+        self._paused = {}
+        self._requests = []
+        self._lock = threading.Lock()
+        # Writing to the wakeup pipe interrupts poll, so that requests are handled.
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._poll.register(self._wakeup_read, select.POLLIN)
+
+    pid = property(lambda self: self._pid)
+
+    def register(self, fd, output, consumer):
+        self._request(self._register, fd, output, consumer)
+
+    def resume(self, fd):
+        self._request(self._resume, fd)
+
+    # The stream's EOF is delivered now, unless it has been already.
+    def cancel(self, fd):
+        self._request(self._cancel, fd)
+
+    def run(self):
+        while True:
+            self._handle_requests()
+            try:
+                events = self._poll.poll()
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self._wakeup_read:
+                    self._drain_wakeup()
+                elif fd in self._streams:
+                    try:
+                        self._read(fd)
+                    except:
+                        traceback.print_exc(file = sys.stderr)
+
+    # For use by this class
+
+    def _request(self, function, *args):
+        self._lock.acquire()
+        try:
+            self._requests.append((function, args))
+        finally:
+            self._lock.release()
+        try:
+            os.write(self._wakeup_write, 'x')
+        except OSError, e:
+            # EAGAIN: The pipe is full, so a wakeup is pending anyway.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _handle_requests(self):
+        self._lock.acquire()
+        try:
+            requests = self._requests
+            self._requests = []
+        finally:
+            self._lock.release()
+        for function, args in requests:
+            function(*args)
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _register(self, fd, output, consumer):
+        self._streams[fd] = (output, consumer)
+        self._poll.register(fd, select.POLLIN)
+
+    def _resume(self, fd):
+        stream = self._paused.pop(fd, None)
+        if stream:
+            self._register(fd, *stream)
+
+    def _cancel(self, fd):
+        stream = self._streams.pop(fd, None)
+        if stream:
+            self._poll.unregister(fd)
+        else:
+            stream = self._paused.pop(fd, None)
+        if stream:
+            output, consumer = stream
+            output.deliver(fd, consumer, '')
+
+    def _read(self, fd):
+        output, consumer = self._streams[fd]
+        try:
+            data = os.read(fd, _READ_BYTES)
+        except OSError, e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return
+            # e.g. ECONNRESET from an agent's socket: Treat as EOF.
+            data = ''
+        pause = output.deliver(fd, consumer, data)
+        if pause or not data:
+            self._poll.unregister(fd)
+            del self._streams[fd]
+            if pause:
+                self._paused[fd] = (output, consumer)
+
+_reactor_lock = threading.Lock()
+_the_reactor = None
+
+# Returns the reactor, starting it if necessary. A process forked by osh, (see
+# osh.command.fork), starts its own.
+def _reactor():
+    global _the_reactor
+    _reactor_lock.acquire()
+    try:
+        if _the_reactor is None or _the_reactor.pid != os.getpid():
+            _the_reactor = _Reactor()
+            _the_reactor.start()
+        return _the_reactor
+    finally:
+        _reactor_lock.release()
+
+# Sending input
+
+def send_input(input_provider):
+    """Sends input to a process, using C{input_provider}, (initialized with the process's
+    input stream). The input is sent by the calling thread, unless it is a stream,
+    generating input while the process runs. Then it is sent by a new thread, which
+    is returned, so that the caller can consume the process's output meanwhile.
+    """
+    if input_provider.streaming():
+        thread = threading.Thread(target = input_provider.run)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+    input_provider.run()
+    return None
+
 class _StreamHandler(object):
 
     _handler = None
     _process = None
     _stream = None
     _done = None
+    # Set when the consumer stops passing output to the handler
+    _discarding = False
 
     def __init__(self, handler):
         self._handler = handler
@@ -184,108 +615,175 @@ class _StreamHandler(object):
     def terminating_exception(self, exception):
         self._process._terminating_exception = exception
 
+    def downstream_done(self, exception):
+        # Nobody will read any more output, so stop the process instead of
+        # waiting for it to finish.
+        self.terminating_exception(exception)
+        self._process._cancelled = True
+        try:
+            self._process.kill()
+        except:
+            pass
+
     def done(self):
         return self._done
 
-    def notify_process_of_completion(self):
-        self._process._process_completion.acquire()
-        self._done = True
-        self._process._process_completion.notify()
-        self._process._process_completion.release()
+    def discarding(self):
+        return self._discarding
+
+    # For output consumers: Called with data read from the stream, and at EOF.
+
+    def feed(self, data):
+        if not self._discarding:
+            try:
+                self.consume(data)
+            except error.DownstreamDone, e:
+                self._discarding = True
+                self.downstream_done(e)
+            except Exception, e:
+                self._discarding = True
+                self.terminating_exception(e)
+
+    def finish(self):
+        try:
+            if not self._discarding:
+                try:
+                    self.consume_end()
+                except error.DownstreamDone, e:
+                    self.downstream_done(e)
+                except Exception, e:
+                    self.terminating_exception(e)
+        finally:
+            self.stream().close()
+            self._done = True
+
+    def consume(self, data):
+        assert False
+
+    def consume_end(self):
+        pass
 
 class ObjectInputProvider(_StreamHandler):
 
     _inputs = None
+    _lock = None
+    _output = None
 
+    # inputs: An iterable, which may generate objects while the process runs.
     def __init__(self, handler, inputs):
         _StreamHandler.__init__(self, handler)
         self._inputs = inputs
+        self._lock = threading.Lock()
 
     def initialize(self, stream, process):
         _StreamHandler.initialize(self, process)
-        self._stream = cPickle.Pickler(stream)
+        self._output = stream
+        self._stream = cPickle.Pickler(stream, cPickle.HIGHEST_PROTOCOL)
+
+    # A list or tuple of inputs is sent at once. Otherwise, inputs are a stream.
+    def streaming(self):
+        return not isinstance(self._inputs, (list, tuple))
 
     def run(self):
         try:
             for input in self._inputs:
-                self.handler()(self.stream(), input)
+                self._send(input)
+            # Flush but don't close the stream -- may need to send kill signal later.
+            self._output.flush()
+        except IOError, e:
+            # EPIPE: The process stopped reading input, e.g. because its pipeline
+            # finished early. Its own output reports any problem.
+            if e.errno != errno.EPIPE:
+                self.terminating_exception(e)
         except Exception, e:
             self.terminating_exception(e)
 
     def send_kill(self, kill_signal):
-        self.handler()(self.stream(), kill_signal)
+        self._send(kill_signal)
         self._process.close_input_stream()
 
-class ObjectOutputConsumer(_StreamHandler, threading.Thread):
+    # for use by this class
+
+    # Input and a kill signal may be sent by different threads.
+    def _send(self, object):
+        self._lock.acquire()
+        try:
+            self.handler()(self.stream(), object)
+            # Objects are not referenced by later ones, so the memo would only grow.
+            self.stream().clear_memo()
+        finally:
+            self._lock.release()
 
-    _baseStream = None
+class ObjectOutputConsumer(_StreamHandler):
 
-    def __init__(self, handler):
+    _stats = None
+    _decoder = None
+
+    # stats: osh.wire.WireStats counting bytes read, if not None.
+    def __init__(self, handler, stats = None):
         _StreamHandler.__init__(self, handler)
-        threading.Thread.__init__(self)
+        self._stats = stats
 
     def initialize(self, stream, process):
         _StreamHandler.initialize(self, process)
-        self._baseStream = stream
-        self._stream = cPickle.Unpickler(stream)
-        
-    def run(self):
-        try:
-            try:
-                eof = False
-                while not eof:
-                    try:
-                        object = self.stream().load()
-                        self.handler()(object)
-                    except EOFError, e:
-                        eof = True
-            except Exception, e:
-                self.terminating_exception(e)
-        finally:
-            self._baseStream.close()
-            self.notify_process_of_completion()
+        self._stream = stream
+        # The stream is in either of the formats described in osh.wire.
+        self._decoder = wire.Decoder(self._stats)
+
+    def consume(self, data):
+        handler = self.handler()
+        for object in self._decoder.feed(data):
+            handler(object)
+
+    def consume_end(self):
+        self._decoder.finish()
         
-class LineOutputConsumer(_StreamHandler, threading.Thread):
+class LineOutputConsumer(_StreamHandler):
+
+    # Data following the last complete line
+    _partial_line = ''
 
     def __init__(self, handler):
         _StreamHandler.__init__(self, handler)
-        threading.Thread.__init__(self)
 
     def initialize(self, stream, process):
         _StreamHandler.initialize(self, process)
         self._stream = stream
 
-    def run(self):
-        try:
-            try:
-                eof = False
-                while not eof:
-                    line = self.stream().readline()
-                    if line:
-                        self.handler()(line)
-                    else:
-                        eof = True
-            except Exception, e:
-                self.terminating_exception(e)
-        finally:
-            self.stream().close()
-            self.notify_process_of_completion()
+    def consume(self, data):
+        lines = (self._partial_line + data).split('\n')
+        self._partial_line = lines.pop()
+        for line in lines:
+            self.line(line + '\n')
+
+    def consume_end(self):
+        if self._partial_line:
+            self.line(self._partial_line)
+
+    # For use by this class
+
+    def line(self, line):
+        # Output of a cancelled process, (e.g. complaints about a broken pipe), is
+        # discarded.
+        if not self._process._cancelled:
+            self.handler()(line)
 
 def collect_lines(lines):
     def add_line(line):
         lines.append(line)
     return LineOutputConsumer(lambda line: add_line(line))
 
-def _ssh_command(user, identity, host, command):
-    if identity:
-        return 'ssh %s -i %s -T -o StrictHostKeyChecking=no -l %s "%s" ' % (host,
-                                                                            identity,
-                                                                            user,
-                                                                            command)
-    else:
-        return 'ssh %s -T -o StrictHostKeyChecking=no -l %s "%s" ' % (host,
+def _ssh_command(user, identity, host, command, idle_timeout = None):
+    return 'ssh %s %s -T -o StrictHostKeyChecking=no -l %s "%s" ' % (host,
+                                                                      ssh_options(user,
+                                                                                  identity,
+                                                                                  host,
+                                                                                  idle_timeout),
                                                                       user,
                                                                       command)
             
 def _ignore_output():
     return LineOutputConsumer(lambda line: None)
+
+# Imported last because error imports util, which needs the definitions above.
+import error
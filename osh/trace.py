@@ -15,12 +15,108 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
+"""Tracing of osh internals.
+
+A trace message has a level, (C{ERROR}, C{INFO} or C{DEBUG}), and optionally a
+category, (e.g. C{'objects'}). A message is recorded if its level is at or
+below the current level, and, if categories have been selected, its category is
+one of them. The level is C{OFF} initially, so that nothing is recorded.
+
+Arguments for formatting a message are passed separately, so that formatting is
+done only if the message is recorded, e.g.::
+
+    trace.log(trace.DEBUG, 'objects', 'object: %s', object)
+
+Code tracing in a loop should check C{trace.level} before doing any work to
+prepare a message.
+
+Recorded messages are written to the trace file. In ring buffer mode, the most
+recent messages are kept in memory instead, and are written to the trace file only
+by C{dump}, e.g. when an error occurs.
+"""
+
+import collections
 import sys
+import threading
+import traceback
+
+OFF = 0
+ERROR = 1
+INFO = 2
+DEBUG = 3
 
+level = OFF
+categories = None
 tracefile = None
 
+_tracefile_name = None
+_ring = None
+_lock = threading.Lock()
+
+def configure(trace_level, tracefile_name = None, trace_categories = None, ring = None):
+    """Sets the level at which messages are recorded, and where they go. If
+    C{tracefile_name} is None, then messages go to stdout. If C{trace_categories} is
+    specified, then only messages in these categories are recorded. If C{ring} is
+    specified, then up to C{ring} messages are kept in memory until C{dump} is
+    called.
+    """
+    global level, categories, tracefile, _tracefile_name, _ring
+    _lock.acquire()
+    try:
+        if tracefile and tracefile is not sys.stdout:
+            tracefile.close()
+        tracefile = None
+        _tracefile_name = tracefile_name
+        if trace_categories is None:
+            categories = None
+        else:
+            categories = frozenset(trace_categories)
+        if ring:
+            _ring = collections.deque(maxlen = ring)
+        else:
+            _ring = None
+        level = trace_level
+    finally:
+        _lock.release()
+
+def enabled(message_level, category = None):
+    """Returns true if a message with the given level and category would be recorded.
+    """
+    return message_level <= level and (categories is None or category in categories)
+
+def log(message_level, category, message, *args):
+    """Records C{message % args} if C{message_level} and C{category} are enabled.
+    """
+    if message_level <= level and (categories is None or category in categories):
+        if args:
+            message = message % args
+        _record(message)
+
+def log_exception(category = None):
+    """Records the current exception's traceback at level C{ERROR}.
+    """
+    if ERROR <= level and (categories is None or category in categories):
+        _record(traceback.format_exc().rstrip())
+
+def dump():
+    """In ring buffer mode, writes the messages held in memory to the trace file.
+    """
+    _lock.acquire()
+    try:
+        if _ring:
+            file = _file()
+            for message in _ring:
+                print >>file, message
+            file.flush()
+            _ring.clear()
+    finally:
+        _lock.release()
+
+# Original interface: Messages go to tracefile_name, (stdout if None), regardless
+# of level and category.
+
 def on(tracefile_name, append = False):
-    global tracefile
+    global tracefile, level
     if tracefile is None:
         if tracefile_name:
             if append:
@@ -29,12 +125,39 @@ def on(tracefile_name, append = False):
                 tracefile = open(tracefile_name, 'w')
         else:
             tracefile = sys.stdout
+        level = DEBUG
 
 def off():
-    tracefile.close()
+    global tracefile, level
+    if tracefile and tracefile is not sys.stdout:
+        tracefile.close()
     tracefile = None
+    level = OFF
     
 def trace(message):
-    if tracefile:
-        print >>tracefile, message
-        tracefile.flush()
+    if level:
+        _record(message)
+
+# For use by this module
+
+def _record(message):
+    _lock.acquire()
+    try:
+        if _ring is not None:
+            _ring.append(message)
+        else:
+            file = _file()
+            print >>file, message
+            file.flush()
+    finally:
+        _lock.release()
+
+# Caller must hold _lock
+def _file():
+    global tracefile
+    if tracefile is None:
+        if _tracefile_name:
+            tracefile = open(_tracefile_name, 'w')
+        else:
+            tracefile = sys.stdout
+    return tracefile
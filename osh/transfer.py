@@ -0,0 +1,207 @@
+# osh
+# Copyright (C) Jack Orenstein <jao@geophile.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""Support for C{copyto} and C{copyfrom}: Digests of local and remote files, so that
+only changed files are copied, and reporting of the progress of copying.
+"""
+
+import glob
+import hashlib
+import os
+import sys
+import threading
+
+import osh.core
+
+# Bytes read at a time when computing a digest.
+_BLOCK_SIZE = 1024 * 1024
+
+def digest(path):
+    """Returns the md5 digest of the contents of the file at C{path}, as a hex string.
+    """
+    md5 = hashlib.md5()
+    file = open(path, 'rb')
+    try:
+        block = file.read(_BLOCK_SIZE)
+        while block:
+            md5.update(block)
+            block = file.read(_BLOCK_SIZE)
+    finally:
+        file.close()
+    return md5.hexdigest()
+
+def files(paths, recursive):
+    """Generates the files identified by C{paths}, which may contain wildcards. If
+    C{recursive} is true, then the files in directories, and their subdirectories,
+    are included. Each file is generated as C{(path, relative_path)}, where
+    C{relative_path} is relative to the parent of the path specified.
+    """
+    for pattern in paths:
+        for path in sorted(glob.glob(os.path.expanduser(pattern))):
+            path = path.rstrip('/')
+            base = os.path.dirname(path)
+            if os.path.isdir(path):
+                if recursive:
+                    for dir, dirs, filenames in os.walk(path):
+                        dirs.sort()
+                        for filename in sorted(filenames):
+                            file = os.path.join(dir, filename)
+                            yield file, os.path.relpath(file, base)
+            elif os.path.isfile(path):
+                yield path, os.path.basename(path)
+
+def remote_digests(host, paths, recursive = False):
+    """Returns a dict mapping each file identified by C{paths} on C{host}, (an
+    C{osh.cluster.Host}), to C{(relative_path, size, digest)}. C{paths} are
+    interpreted as by C{files}, on C{host}.
+    """
+    import osh.command.fork
+    digests = {}
+    remote = osh.command.fork._Remote()
+    remote.process_args(osh.core.Pipeline(Digests().process_args(recursive, *paths)))
+    pipeline = osh.core.Pipeline(remote)
+    pipeline.set_thread_state(host)
+    pipeline.setup()
+    pipeline.set_receiver(_DigestCollector(digests))
+    pipeline.execute()
+    pipeline.receive_complete()
+    return digests
+
+class Digests(osh.core.Generator):
+    """Generates C{(path, relative_path, size, digest)} for each file identified by the paths
+    given as arguments, (following a flag indicating a recursive search), as by
+    C{files}. Run on a remote host by C{remote_digests}.
+    """
+
+    _recursive = None
+    _paths = None
+
+    def __init__(self):
+        osh.core.Generator.__init__(self, '', (1, None))
+
+    def doc(self):
+        return Digests.__doc__
+
+    def setup(self):
+        args = self.args()
+        self._recursive = args.next()
+        self._paths = args.remaining()
+
+    def execute(self):
+        for path, relative_path in files(self._paths, self._recursive):
+            try:
+                self.send((path, relative_path, os.path.getsize(path), digest(path)))
+            except (IOError, OSError):
+                # Unreadable, or removed while running
+                pass
+
+class _DigestCollector(object):
+
+    _digests = None
+
+    def __init__(self, digests):
+        self._digests = digests
+
+    def receive(self, object):
+        self._digests[object[0]] = tuple(object[1:])
+
+    def receive_batch(self, objects):
+        for object in objects:
+            self.receive(object)
+
+    def receive_complete(self):
+        pass
+
+class Progress(object):
+    """Tracks copying to or from each host of a cluster. Per-host results, (the number
+    of files checked and copied, bytes copied, and throughput), are shown in a
+    C{progtrack} UI if requested, and are otherwise printed to stderr with verbosity 1
+    or more.
+    """
+
+    # UI columns, following the host
+    _CHECKED = 1
+    _COPIED = 2
+    _THROUGHPUT = 3
+
+    _ui = None
+    _lock = None
+    _results = None
+
+    def __init__(self, title, hosts, track):
+        self._lock = threading.Lock()
+        self._results = {}
+        if track:
+            import osh.command.progtrack as progtrack
+            ui = progtrack.ProgressTrackingUI(title)
+            ui.add_column('host', 25)
+            ui.add_column(['files', 'checked'], 8)
+            ui.add_column(['files', 'copied'], 8)
+            ui.add_column(['MB/sec'], 10)
+            for host in hosts:
+                ui.add_row(host.name)
+            self._ui = ui
+
+    results = property(lambda self: self._results,
+                       doc = """Maps host name to C{(files, copied, bytes, seconds)}.""")
+
+    def start(self):
+        if self._ui:
+            self._ui.start()
+
+    def stop(self):
+        if self._ui:
+            self._ui.stop()
+
+    def checked(self, host, files):
+        if self._ui:
+            self._ui.set(host.name, Progress._CHECKED, str(files))
+
+    # files, copied and bytes are None if not known, (copying without checking
+    # digests).
+    def copied(self, host, files, copied, bytes, seconds):
+        self._lock.acquire()
+        try:
+            self._results[host.name] = (files, copied, bytes, seconds)
+        finally:
+            self._lock.release()
+        if bytes is None:
+            if self._ui:
+                self._ui.ok(host.name, Progress._COPIED)
+            elif osh.core.verbosity >= 1:
+                print >>sys.stderr, '%s: copied in %.2f sec' % (host.name, seconds)
+        else:
+            rate = throughput(bytes, seconds)
+            if self._ui:
+                self._ui.set(host.name, Progress._COPIED, str(copied))
+                self._ui.set(host.name, Progress._THROUGHPUT, '%.2f' % rate)
+            elif osh.core.verbosity >= 1:
+                print >>sys.stderr, ('%s: copied %s of %s files, %s bytes, %.2f MB/sec' %
+                                     (host.name, copied, files, bytes, rate))
+
+    def error(self, host, message):
+        if self._ui:
+            self._ui.error(host.name, Progress._COPIED, message)
+        else:
+            print >>sys.stderr, '%s: %s' % (host.name, message)
+
+def throughput(bytes, seconds):
+    """Returns the throughput in MB/sec of copying C{bytes} in C{seconds}.
+    """
+    if seconds <= 0:
+        return 0.0
+    return bytes / seconds / (1024 * 1024)
@@ -41,23 +41,16 @@ def clone(x):
     unpickler = cPickle.Unpickler(buffer)
     return unpickler.load()
 
-def scp(user, identity, host, flags, source, target):
+def scp(user, identity, host, flags, source, target, idle_timeout = None):
     err_lines = []
     if flags is None:
         flags = ''
-    if identity:
-        scp_command = 'scp %s %s -i %s %s@%s:%s' % (flags,
-                                                    source,
-                                                    identity,
-                                                    user,
-                                                    host,
-                                                    target)
-    else:
-        scp_command = 'scp %s %s %s@%s:%s' % (flags,
-                                              source,
-                                              user,
-                                              host,
-                                              target)
+    scp_command = 'scp %s %s %s %s@%s:%s' % (flags,
+                                             source,
+                                             spawn.ssh_options(user, identity, host, idle_timeout),
+                                             user,
+                                             host,
+                                             target)
     Spawn(scp_command,
           None,
           None,
@@ -65,7 +58,7 @@ def scp(user, identity, host, flags, source, target):
     if len(err_lines) > 0:
         raise Exception(' '.join(err_lines))
 
-def ssh(user, identity, host, command):
+def ssh(user, identity, host, command, idle_timeout = None):
     output = []
     errors = []
     SpawnSSH(user,
@@ -74,7 +67,8 @@ def ssh(user, identity, host, command):
              command,
              None,
              collect_lines(output),
-             collect_lines(errors)).run()
+             collect_lines(errors),
+             idle_timeout).run()
     return output, errors
 
 def quote(s):
@@ -0,0 +1,477 @@
+# osh
+# Copyright (C) Jack Orenstein <jao@geophile.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""Format of the object streams between the client and C{remoteosh}.
+
+In the original format of output from C{remoteosh}, each object is pickled
+separately, (protocol 0). In the framed format, the stream starts with a header,
+C{MAGIC} followed by a version byte. Each frame that follows is a 4-byte,
+big-endian length, followed by a list of objects pickled with the highest
+protocol. A frame is written when the pending objects reach about C{FRAME_BYTES}
+bytes, or when objects have been pending for C{FLUSH_INTERVAL} seconds.
+
+If the client requests compression, then a frame may be compressed by zlib,
+indicated by the high bit of the frame's length. The compression level is adapted
+to the transport: It is raised while writes wait for the transport, and lowered
+while compression takes longer than writing. Frames that don't compress well are
+sent uncompressed, and compression is retried later.
+
+The client requests the framed format by setting the environment variable
+C{OSH_WIRE} to the highest version it understands, in the C{remoteosh} command
+line, and requests compression by setting C{OSH_COMPRESS} to 1. An older
+C{remoteosh} ignores these variables and writes the original format. The client
+recognizes the format from the first byte, (C{MAGIC} does not start like a
+pickle), so an older client never sees the framed format and a newer client can
+read output from either kind of C{remoteosh}.
+
+Input to C{remoteosh} is a sequence of pickled objects: the client's verbosity,
+the pipeline to run, the thread state, and optionally a kill signal. If the
+client sets C{OSH_INPUT} to 1, then input objects for the pipeline follow the
+thread state, as pickled lists of objects, ending with C{None}. (An older
+C{remoteosh} does not accept input.)
+"""
+
+import cPickle
+import cStringIO
+import struct
+import threading
+import time
+import zlib
+
+VERSION = 1
+ENV_VAR = 'OSH_WIRE'
+COMPRESS_ENV_VAR = 'OSH_COMPRESS'
+INPUT_ENV_VAR = 'OSH_INPUT'
+MAGIC = '\x00osh'
+
+# Target size in bytes of a frame.
+FRAME_BYTES = 64 * 1024
+
+# Seconds that objects can wait to be written.
+FLUSH_INTERVAL = 0.1
+
+_LENGTH = struct.Struct('>I')
+_COMPRESSED = 0x80000000
+
+# Compression levels
+_MIN_LEVEL = 1
+_MAX_LEVEL = 9
+_INITIAL_LEVEL = 6
+
+# A frame is sent uncompressed if compression doesn't reduce its size to this
+# fraction of the original. Compression is then skipped for _SKIP_FRAMES frames.
+_MAX_RATIO = 0.9
+_SKIP_FRAMES = 16
+
+def requested_version(environ):
+    """Returns the wire format version to use, given the client's environment
+    variables. 0 denotes the original format.
+    """
+    try:
+        return min(int(environ.get(ENV_VAR, 0)), VERSION)
+    except ValueError:
+        return 0
+
+def requested_compression(environ):
+    """Returns true if the client's environment variables request compression.
+    """
+    return environ.get(COMPRESS_ENV_VAR, '0') not in ('', '0')
+
+def requested_input(environ):
+    """Returns true if the client's environment variables indicate that input for
+    the pipeline will be sent.
+    """
+    return environ.get(INPUT_ENV_VAR, '0') not in ('', '0')
+
+def create_writer(stream, version, compress = False):
+    """Returns a writer of objects to C{stream}, using format C{version}. Frames are
+    compressed if C{compress} is true.
+    """
+    if version >= 1:
+        return FrameWriter(stream, compress = compress)
+    else:
+        return LegacyWriter(stream)
+
+class WireStats(object):
+    """Counts bytes read by C{read_objects}: C{raw_bytes} is the size of the
+    pickled objects and C{wire_bytes} is the size of the data transferred,
+    (smaller if compressed). Only frames are counted.
+    """
+
+    raw_bytes = 0
+    wire_bytes = 0
+
+    def __repr__(self):
+        return 'raw: %s bytes, wire: %s bytes' % (self.raw_bytes, self.wire_bytes)
+
+class LegacyWriter(object):
+    """Writes each object separately, in the original format.
+    """
+
+    _stream = None
+    _pickler = None
+    _lock = None
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._pickler = cPickle.Pickler(stream)
+        self._lock = threading.Lock()
+
+    def write(self, objects):
+        self._lock.acquire()
+        try:
+            dump = self._pickler.dump
+            for object in objects:
+                dump(object)
+        finally:
+            self._lock.release()
+
+    def write_now(self, object):
+        self.write([object])
+        self.flush()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self._stream.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        pass
+
+class FrameWriter(object):
+    """Writes objects in frames. Objects written by C{write} are buffered until the
+    frame is full, C{FLUSH_INTERVAL} has passed, or C{flush} is called. Writes may
+    be done by multiple threads.
+    """
+
+    _stream = None
+    _frame_bytes = None
+    _pending = None
+    _pending_since = None
+    _frame_objects = None
+    _lock = None
+    _flusher = None
+    _compressor = None
+    _closed = False
+
+    def __init__(self,
+                 stream,
+                 frame_bytes = FRAME_BYTES,
+                 flush_interval = FLUSH_INTERVAL,
+                 compress = False):
+        self._stream = stream
+        self._frame_bytes = frame_bytes
+        if compress:
+            self._compressor = _AdaptiveCompressor()
+        self._pending = []
+        # Number of objects in a frame, adjusted to keep frames near frame_bytes.
+        self._frame_objects = 100
+        self._lock = threading.Lock()
+        stream.write(MAGIC + chr(VERSION))
+        stream.flush()
+        if flush_interval:
+            self._flusher = threading.Thread(target = self._flush_periodically,
+                                             args = (flush_interval,))
+            self._flusher.setDaemon(True)
+            self._flusher.start()
+
+    def write(self, objects):
+        self._lock.acquire()
+        try:
+            if not self._pending:
+                self._pending_since = time.time()
+            self._pending.extend(objects)
+            if len(self._pending) >= self._frame_objects:
+                self._write_frame()
+        finally:
+            self._lock.release()
+
+    def write_now(self, object):
+        """Writes C{object}, and any pending objects, immediately.
+        """
+        self._lock.acquire()
+        try:
+            self._pending.append(object)
+            self._write_frame()
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self._write_frame()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Stops periodic flushing. Pending objects are discarded, and the stream is
+        not closed.
+        """
+        self._closed = True
+
+    # For use by this class
+
+    # Caller must hold the lock
+    def _write_frame(self):
+        pending = self._pending
+        if pending:
+            data = cPickle.dumps(pending, cPickle.HIGHEST_PROTOCOL)
+            self._pending = []
+            bytes_per_object = max(1, len(data) / len(pending))
+            self._frame_objects = max(1, self._frame_bytes / bytes_per_object)
+            compressor = self._compressor
+            if compressor:
+                start = time.time()
+                compressed = compressor.compress(data)
+                compress_time = time.time() - start
+                if compressed is None:
+                    length = len(data)
+                else:
+                    data = compressed
+                    length = len(data) | _COMPRESSED
+                start = time.time()
+                self._write(length, data)
+                if compressed is not None:
+                    compressor.adjust(compress_time, time.time() - start)
+            else:
+                self._write(len(data), data)
+
+    def _write(self, length, data):
+        stream = self._stream
+        stream.write(_LENGTH.pack(length))
+        stream.write(data)
+        stream.flush()
+
+    def _flush_periodically(self, interval):
+        try:
+            while not self._closed:
+                time.sleep(interval)
+                self._lock.acquire()
+                try:
+                    if self._pending and time.time() - self._pending_since >= interval:
+                        self._write_frame()
+                finally:
+                    self._lock.release()
+        except (IOError, ValueError):
+            # The stream has been closed
+            pass
+
+def read_objects(stream, stats = None):
+    """Generates the objects written to C{stream}, in either format. Bytes read are
+    counted in C{stats}, (a C{WireStats}), if specified.
+    """
+    first = stream.read(1)
+    if not first:
+        return
+    if first == MAGIC[0]:
+        header = stream.read(len(MAGIC))
+        if header[:-1] != MAGIC[1:] or not header[-1:] or ord(header[-1]) > VERSION:
+            raise WireException('Unrecognized object stream header: %r' % (first + header))
+        if stats is None:
+            stats = WireStats()
+        read = stream.read
+        loads = cPickle.loads
+        decompress = zlib.decompress
+        while True:
+            length = read(_LENGTH.size)
+            if len(length) < _LENGTH.size:
+                if length:
+                    raise WireException('Truncated frame length')
+                return
+            (length,) = _LENGTH.unpack(length)
+            compressed = length & _COMPRESSED
+            length &= ~_COMPRESSED
+            data = read(length)
+            if len(data) < length:
+                raise WireException('Truncated frame')
+            stats.wire_bytes += _LENGTH.size + length
+            if compressed:
+                data = decompress(data)
+            stats.raw_bytes += _LENGTH.size + len(data)
+            for object in loads(data):
+                yield object
+    else:
+        unpickler = cPickle.Unpickler(_Prefixed(first, stream))
+        while True:
+            try:
+                object = unpickler.load()
+            except EOFError:
+                return
+            yield object
+
+class Decoder(object):
+    """Decodes objects written in either format, from data received in pieces,
+    (e.g. by non-blocking reads). Bytes decoded are counted in C{stats}, (a
+    C{WireStats}), if specified.
+    """
+
+    _stats = None
+    _buffer = None
+    # None until the format is known
+    _framed = None
+
+    def __init__(self, stats = None):
+        if stats is None:
+            stats = WireStats()
+        self._stats = stats
+        self._buffer = ''
+
+    def feed(self, data):
+        """Returns the objects completed by C{data}.
+        """
+        buffer = self._buffer + data
+        if self._framed is None:
+            if not buffer:
+                return []
+            if buffer[0] == MAGIC[0]:
+                if len(buffer) < len(MAGIC) + 1:
+                    self._buffer = buffer
+                    return []
+                header = buffer[:len(MAGIC) + 1]
+                if header[:-1] != MAGIC or ord(header[-1]) > VERSION:
+                    raise WireException('Unrecognized object stream header: %r' % header)
+                buffer = buffer[len(MAGIC) + 1:]
+                self._framed = True
+            else:
+                self._framed = False
+        if self._framed:
+            objects, self._buffer = self._frames(buffer)
+        elif '.' in data:
+            # A pickle ends with STOP, '.', so there is nothing to decode otherwise.
+            objects, self._buffer = self._pickles(buffer)
+        else:
+            objects, self._buffer = [], buffer
+        return objects
+
+    def finish(self):
+        """Called at the end of the stream. Raises C{WireException} if the stream
+        ends with an incomplete object.
+        """
+        if self._buffer:
+            if self._framed:
+                raise WireException('Truncated frame')
+            unpickler = cPickle.Unpickler(cStringIO.StringIO(self._buffer))
+            try:
+                unpickler.load()
+            except Exception, e:
+                raise WireException('Truncated object: %s' % e)
+
+    # For use by this class
+
+    def _frames(self, buffer):
+        objects = []
+        stats = self._stats
+        start = 0
+        end = len(buffer)
+        while end - start >= _LENGTH.size:
+            (length,) = _LENGTH.unpack_from(buffer, start)
+            compressed = length & _COMPRESSED
+            length &= ~_COMPRESSED
+            data_start = start + _LENGTH.size
+            if end - data_start < length:
+                break
+            data = buffer[data_start:data_start + length]
+            start = data_start + length
+            stats.wire_bytes += _LENGTH.size + length
+            if compressed:
+                data = zlib.decompress(data)
+            stats.raw_bytes += _LENGTH.size + len(data)
+            objects.extend(cPickle.loads(data))
+        return objects, buffer[start:]
+
+    # The original format has no framing, so an incomplete pickle is recognized by
+    # failing to load. It is loaded again when more data arrives.
+    def _pickles(self, buffer):
+        objects = []
+        input = cStringIO.StringIO(buffer)
+        unpickler = cPickle.Unpickler(input)
+        start = 0
+        while start < len(buffer):
+            try:
+                objects.append(unpickler.load())
+            except Exception:
+                break
+            start = input.tell()
+        return objects, buffer[start:]
+
+class WireException(Exception):
+
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+# Returns prefix, and then the contents of stream.
+class _Prefixed(object):
+
+    _prefix = None
+    _stream = None
+
+    def __init__(self, prefix, stream):
+        self._prefix = prefix
+        self._stream = stream
+
+    def read(self, n):
+        prefix = self._prefix
+        if prefix:
+            self._prefix = ''
+            if n <= len(prefix):
+                self._prefix = prefix[n:]
+                return prefix[:n]
+            return prefix + self._stream.read(n - len(prefix))
+        return self._stream.read(n)
+
+    def readline(self):
+        prefix = self._prefix
+        if prefix:
+            self._prefix = ''
+            if '\n' in prefix:
+                i = prefix.index('\n') + 1
+                self._prefix = prefix[i:]
+                return prefix[:i]
+            return prefix + self._stream.readline()
+        return self._stream.readline()
+
+class _AdaptiveCompressor(object):
+
+    _level = None
+    _skip = None
+
+    def __init__(self):
+        self._level = _INITIAL_LEVEL
+        self._skip = 0
+
+    # Returns the compressed data, or None if data should be sent uncompressed.
+    def compress(self, data):
+        if self._skip > 0:
+            self._skip -= 1
+            return None
+        compressed = zlib.compress(data, self._level)
+        if len(compressed) > len(data) * _MAX_RATIO:
+            self._skip = _SKIP_FRAMES
+            return None
+        return compressed
+
+    # If writing is slower than compression, then the transport is the bottleneck,
+    # so compress harder. If compression is slower than writing, then compress less.
+    def adjust(self, compress_time, write_time):
+        if write_time > 2 * compress_time:
+            self._level = min(self._level + 1, _MAX_LEVEL)
+        elif compress_time > 2 * write_time:
+            self._level = max(self._level - 1, _MIN_LEVEL)
+
+    level = property(lambda self: self._level)
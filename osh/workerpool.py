@@ -0,0 +1,346 @@
+# osh
+# Copyright (C) Jack Orenstein <jao@geophile.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""Pool of workers applying a function to input objects in parallel, used by
+commands with a parallelism option, e.g. C{f -j N}.
+
+Input is submitted in chunks (lists of objects). Each chunk is given a sequence
+number, and processed by one of the workers, which are either threads or child
+processes. Results are returned to the submitting thread. In ordered mode, a
+reorder buffer holds results until all results for earlier chunks have been
+returned, so that output order matches input order. In unordered mode, results
+are returned as soon as they are available. The number of chunks submitted but
+not yet returned is bounded, (submit blocks when the bound is reached), so memory
+use is bounded even if one chunk takes much longer than others.
+
+Worker processes are created by C{os.fork} when the first chunk is submitted,
+so functions, including lambdas, don't need to be pickled. Input chunks and
+results are pickled and sent through pipes.
+"""
+
+import cPickle
+import os
+import Queue
+import signal
+import sys
+import threading
+
+# Time in seconds to wait for a result before checking again. Waiting without a
+# timeout blocks ctrl-c.
+_WAIT = 1.0
+
+# Default bound on chunks submitted but not yet returned, per worker.
+CHUNKS_PER_WORKER = 4
+
+def apply_function(function):
+    """Returns a worker that applies C{function} to each object of a chunk. For each
+    object, the worker's result is C{(True, value)} if C{function} returned C{value},
+    or C{(False, exception)} if C{function} raised C{exception}.
+    """
+    def worker(objects):
+        results = []
+        for object in objects:
+            try:
+                results.append((True, function(*object)))
+            except Exception, e:
+                results.append((False, e))
+        return results
+    return worker
+
+class WorkerPoolException(Exception):
+
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+class WorkerPool(object):
+
+    _worker = None
+    _n_workers = None
+    _processes = None
+    _ordered = None
+    _window = None
+    _workers = None
+    _results = None
+    _next_seq = None
+    _next_to_return = None
+    _inputs = None
+    _pending = None
+    _in_flight = None
+
+    def __init__(self, worker, n_workers, processes = False, ordered = True, window = None):
+        """C{worker} is a function that takes a list of objects, and returns a list of
+        results, (e.g. as created by C{apply_function}). C{n_workers} workers run
+        C{worker}, in child processes if C{processes} is true, in threads otherwise.
+        If C{ordered} is true, then results are returned in submission order.
+        C{window} bounds the number of chunks submitted but not yet returned.
+        """
+        self._worker = worker
+        self._n_workers = n_workers
+        self._processes = processes
+        self._ordered = ordered
+        if window is None:
+            window = CHUNKS_PER_WORKER * n_workers
+        self._window = max(window, 1)
+        self._results = Queue.Queue()
+        self._next_seq = 0
+        self._next_to_return = 0
+        self._inputs = {}
+        self._pending = {}
+        self._in_flight = 0
+
+    def __repr__(self):
+        return 'workerpool<%s>(%s %s)' % (id(self),
+                                          self._n_workers,
+                                          self._processes and 'processes' or 'threads')
+
+    def chunk_size(self, n_objects):
+        """Returns a chunk size for splitting C{n_objects} among the workers.
+        """
+        return max(1, n_objects / (2 * self._n_workers))
+
+    def submit(self, objects):
+        """Submits a chunk for processing. Returns a list of C{(objects, results)}
+        pairs for chunks whose processing has completed, (possibly including the
+        one just submitted). Blocks while the number of chunks submitted but not
+        returned is at the bound.
+        """
+        if self._workers is None:
+            self._start()
+        seq = self._next_seq
+        self._next_seq += 1
+        self._inputs[seq] = objects
+        self._in_flight += 1
+        self._workers[seq % self._n_workers].submit(seq, objects)
+        completed = []
+        self._collect(completed, False)
+        while self._in_flight >= self._window:
+            self._collect(completed, True)
+        return completed
+
+    def drain(self):
+        """Waits for all submitted chunks to be processed, and returns them, (as for
+        C{submit}).
+        """
+        completed = []
+        while self._in_flight > 0:
+            self._collect(completed, True)
+        return completed
+
+    def close(self, kill = False):
+        """Stops the workers. If C{kill} is true, then submitted chunks are abandoned.
+        """
+        if self._workers:
+            for worker in self._workers:
+                worker.close(kill)
+            self._workers = None
+
+    # For use by this class
+
+    def _start(self):
+        workers = []
+        for i in xrange(self._n_workers):
+            if self._processes:
+                workers.append(_ProcessWorker(self._worker, self._results, workers))
+            else:
+                workers.append(_ThreadWorker(self._worker, self._results))
+        self._workers = workers
+
+    # Moves results from the queue to the reorder buffer, and from the reorder buffer
+    # to completed.
+    def _collect(self, completed, block):
+        try:
+            while True:
+                if block:
+                    result = self._results.get(True, _WAIT)
+                    block = False
+                else:
+                    result = self._results.get(False)
+                seq, results = result
+                if seq is None:
+                    # results is an exception
+                    raise results
+                self._pending[seq] = results
+        except Queue.Empty:
+            pass
+        if self._ordered:
+            pending = self._pending
+            while self._next_to_return in pending:
+                seq = self._next_to_return
+                completed.append((self._inputs.pop(seq), pending.pop(seq)))
+                self._next_to_return += 1
+                self._in_flight -= 1
+        else:
+            for seq, results in self._pending.iteritems():
+                completed.append((self._inputs.pop(seq), results))
+                self._in_flight -= 1
+            self._pending.clear()
+
+class _ThreadWorker(threading.Thread):
+
+    _worker = None
+    _tasks = None
+    _results = None
+
+    def __init__(self, worker, results):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._worker = worker
+        self._tasks = Queue.Queue()
+        self._results = results
+        self.start()
+
+    def submit(self, seq, objects):
+        self._tasks.put((seq, objects))
+
+    def close(self, kill):
+        self._tasks.put(None)
+        if not kill:
+            self.join()
+
+    def run(self):
+        worker = self._worker
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            seq, objects = task
+            try:
+                self._results.put((seq, worker(objects)))
+            except Exception, e:
+                self._results.put((None, e))
+
+class _ProcessWorker(object):
+
+    _pid = None
+    _tasks = None
+    _reader = None
+
+    # siblings: Workers created earlier. A child process must close its copies of
+    # their pipes, otherwise a sibling won't see EOF when the pool is closed.
+    def __init__(self, worker, results, siblings):
+        task_read, task_write = os.pipe()
+        result_read, result_write = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.close(task_write)
+            os.close(result_read)
+            for sibling in siblings:
+                sibling._tasks.close()
+            _run_worker_process(worker, task_read, result_write)
+        os.close(task_read)
+        os.close(result_write)
+        self._pid = pid
+        self._tasks = os.fdopen(task_write, 'wb')
+        self._reader = _ResultReader(pid, os.fdopen(result_read, 'rb'), results)
+
+    def submit(self, seq, objects):
+        cPickle.dump((seq, objects), self._tasks, cPickle.HIGHEST_PROTOCOL)
+        self._tasks.flush()
+
+    def close(self, kill):
+        if kill:
+            try:
+                os.kill(self._pid, signal.SIGKILL)
+            except OSError:
+                pass
+        try:
+            self._tasks.close()
+        except IOError:
+            pass
+        try:
+            os.waitpid(self._pid, 0)
+        except OSError:
+            pass
+
+class _ResultReader(threading.Thread):
+
+    _pid = None
+    _input = None
+    _results = None
+
+    def __init__(self, pid, input, results):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._pid = pid
+        self._input = input
+        self._results = results
+        self.start()
+
+    def run(self):
+        input = self._input
+        # The worker sends None when it exits normally.
+        exited = False
+        try:
+            while not exited:
+                try:
+                    result = cPickle.load(input)
+                except EOFError:
+                    break
+                if result is None:
+                    exited = True
+                else:
+                    self._results.put(result)
+        finally:
+            input.close()
+        if not exited:
+            self._results.put((None, WorkerPoolException('Worker process %s died' % self._pid)))
+
+# Runs in a worker process, and does not return.
+def _run_worker_process(worker, task_fd, result_fd):
+    status = 0
+    try:
+        try:
+            tasks = os.fdopen(task_fd, 'rb')
+            results = os.fdopen(result_fd, 'wb')
+            while True:
+                try:
+                    seq, objects = cPickle.load(tasks)
+                except EOFError:
+                    break
+                output = worker(objects)
+                try:
+                    data = cPickle.dumps((seq, output), cPickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    # Probably an exception that can't be pickled
+                    data = cPickle.dumps((seq, [_pickleable_result(r) for r in output]),
+                                         cPickle.HIGHEST_PROTOCOL)
+                results.write(data)
+                results.flush()
+            cPickle.dump(None, results, cPickle.HIGHEST_PROTOCOL)
+            results.close()
+        except:
+            import traceback
+            traceback.print_exc()
+            status = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+def _pickleable_result(result):
+    ok, value = result
+    try:
+        cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        return result
+    except Exception:
+        if ok:
+            raise
+        return (False, Exception('%s: %s' % (value.__class__.__name__, value)))